@@ -0,0 +1,165 @@
+import ipaddress
+import os
+import time
+
+AUTHORISED_IPS_FILE = "authorised_ips.txt"
+AUTHORISED_IPS_CHECK_INTERVAL = 1.0
+
+class AuthorisedIPIndex():
+    """
+    AuthorisedIPIndex holds the authorised IPs in memory so clients are authorised without reading
+    authorised_ips.txt on the accept path. Exact addresses are kept in a set and CIDR ranges in a binary
+    prefix tree per address family, so a lookup is a set lookup or a walk of at most 32 or 128 bits.
+
+    The file is checked at most once every AUTHORISED_IPS_CHECK_INTERVAL seconds and only reparsed
+    when its modification time, size or inode changes.
+
+    Attributes:
+        entries (list): The valid entries from the file, as written
+        _path (str): The path of the authorised IPs file
+        _stat_key (tuple): (mtime_ns, size, inode) of the file when it was last loaded
+        _next_check (float): The monotonic time the file is next checked for changes
+        _exact (frozenset): Exact addresses in their canonical form
+        _trees (dict): IP version to the root node of the prefix tree of its CIDR ranges
+    """
+    def __init__(self, path=AUTHORISED_IPS_FILE):
+        """
+        Args:
+            path (str): The path of the authorised IPs file, one IP address or CIDR range per line
+        """
+        self.entries = []
+        self._path = path
+        self._stat_key = None
+        self._next_check = 0.0
+        self._exact = frozenset()
+        self._trees = {4:None, 6:None}
+        self.refresh()
+
+    def refresh(self, force=False) -> bool:
+        """
+        Reloads the index if the file has changed since it was last loaded.
+
+        Args:
+            force (bool): Check the file now even if it was checked within AUTHORISED_IPS_CHECK_INTERVAL
+
+        Returns:
+            bool: True if the index was reloaded
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        self._next_check = now + AUTHORISED_IPS_CHECK_INTERVAL
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            stat = None
+        stat_key = (stat.st_mtime_ns, stat.st_size, stat.st_ino) if stat else None
+        if stat_key == self._stat_key:
+            return False
+        self.load()
+        self._stat_key = stat_key
+        return True
+
+    def load(self) -> None:
+        """
+        Parses the file into a new exact set and prefix trees and swaps them in. Blank lines, '#' comments
+        and invalid entries are skipped.
+        """
+        entries = []
+        exact = set()
+        trees = {4:None, 6:None}
+        try:
+            with open(self._path, "r") as ips:
+                lines = [line.split("#", 1)[0].strip() for line in ips]
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            try:
+                if "/" in line:
+                    network = self.normalise(ipaddress.ip_network(line, strict=False))
+                    if network.prefixlen == network.max_prefixlen:
+                        exact.add(str(network.network_address))
+                    else:
+                        trees[network.version] = self.insert(trees[network.version], network)
+                elif line:
+                    exact.add(str(self.normalise(ipaddress.ip_address(line))))
+                else:
+                    continue
+            except ValueError:
+                continue
+            entries.append(line)
+        self._exact, self._trees, self.entries = frozenset(exact), trees, entries
+
+    @staticmethod
+    def normalise(address):
+        """
+        Converts IPv4-mapped IPv6 addresses and networks to IPv4 so both forms match the same entries.
+
+        Args:
+            address (IPv4Address|IPv6Address|IPv4Network|IPv6Network): The address or network
+
+        Returns:
+            The IPv4 form if the address is IPv4-mapped, otherwise the address unchanged
+        """
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            return address.ipv4_mapped
+        if (isinstance(address, ipaddress.IPv6Network) and address.prefixlen >= 96 and
+                address.network_address.ipv4_mapped):
+            return ipaddress.ip_network("{}/{}".format(address.network_address.ipv4_mapped, address.prefixlen - 96))
+        return address
+
+    @staticmethod
+    def insert(root, network) -> list:
+        """
+        Adds a CIDR range to a prefix tree. Nodes are [zero child, one child, terminal] lists and
+        a terminal node matches every address below it, so nested ranges are not stored twice.
+
+        Args:
+            root (list): The root node, None for an empty tree
+            network (IPv4Network|IPv6Network): The range to add
+
+        Returns:
+            list: The root node
+        """
+        root = root or [None, None, False]
+        node = root
+        bits = int(network.network_address)
+        for position in range(network.max_prefixlen - 1, network.max_prefixlen - 1 - network.prefixlen, -1):
+            if node[2]:
+                return root
+            bit = (bits >> position) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[0] = node[1] = None
+        node[2] = True
+        return root
+
+    def is_authorised(self, ip) -> bool:
+        """
+        Checks an address against the exact addresses and then the CIDR ranges of its family.
+
+        Args:
+            ip (str): The IP address of the client
+
+        Returns:
+            bool: True if the address is authorised
+        """
+        self.refresh()
+        if ip in self._exact:
+            return True
+        try:
+            address = self.normalise(ipaddress.ip_address(ip))
+        except ValueError:
+            return False
+        if str(address) in self._exact:
+            return True
+        node = self._trees[address.version]
+        bits = int(address)
+        position = address.max_prefixlen - 1
+        while node is not None:
+            if node[2]:
+                return True
+            node = node[(bits >> position) & 1]
+            position -= 1
+        return False
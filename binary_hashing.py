@@ -0,0 +1,109 @@
+"""
+Hashing of binaries, shared by the server, which builds the known good hashes, and the clients, which
+hash their own binaries for integrity scans. It only uses the standard library so it can be copied to
+clients with client.py.
+"""
+
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_READ_SIZE = 1024 * 1024
+
+#Each hashing thread keeps one read buffer, reused for every file it hashes
+_read_buffers = threading.local()
+
+def get_all_binary_full_paths(paths) -> list:
+    """
+    Creates a list of files and their paths from a specified top level directory
+
+    Args:
+        paths (list): The list of the directories specified for hashing
+
+    Returns:
+        list: A list of all files for and paths for hashing
+    """
+    return [binary_path for binary_path, _ in get_all_binary_stat_keys(paths)]
+
+def get_all_binary_stat_keys(paths) -> list:
+    """
+    Creates a list of files and their stat keys from a specified top level directory. The stat key
+    (device, inode, size, mtime_ns, ctime_ns) changes whenever a file is replaced or modified.
+
+    Args:
+        paths (list): The list of the directories specified for hashing
+
+    Returns:
+        list: A list of (file path, stat key) tuples
+    """
+    list_of_all_binaries = []
+    for path in paths:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        list_of_all_binaries.append((entry.path, (stat.st_dev, stat.st_ino, stat.st_size,
+                                                                  stat.st_mtime_ns, stat.st_ctime_ns)))
+                except OSError:
+                    pass
+    return list_of_all_binaries
+
+def hash_binaries(binary_paths, workers, block_size=HASH_READ_SIZE):
+    """
+    Hashes files on a pool of threads and yields the results in the order of binary_paths. hashlib
+    releases the GIL while hashing large blocks, so threads use every core. At most workers * 4 files
+    are in flight, so memory stays bounded however many files there are.
+
+    Args:
+        binary_paths (list): The file paths to hash
+        workers (int): The number of threads to hash with, 1 hashes serially on the calling thread
+        block_size (int): The number of bytes read per block
+
+    Yields:
+        tuple: (file path, hex digest or None if the file could not be read)
+    """
+    if workers <= 1:
+        for binary_path in binary_paths:
+            yield binary_path, calculate_sha256_of_binary(binary_path, block_size)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for binary_path in binary_paths:
+            in_flight.append((binary_path, executor.submit(calculate_sha256_of_binary,
+                                                           binary_path, block_size)))
+            if len(in_flight) >= workers * 4:
+                path, future = in_flight.popleft()
+                yield path, future.result()
+        while in_flight:
+            path, future = in_flight.popleft()
+            yield path, future.result()
+
+def calculate_sha256_of_binary(file_path, block_size=HASH_READ_SIZE) -> str:
+    """
+    Creates a hash of an input file, reading into the calling thread's reusable buffer
+
+    Args:
+        file_path (str): The file path of the file to hash
+        block_size (int): The number of bytes read per block
+
+    Returns:
+        str: Hex digest of hashed file
+    """
+    hash_file_sha256 = hashlib.sha256()
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None or len(buffer) != block_size:
+        buffer = _read_buffers.buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    try:
+        with open(file_path, "rb", buffering=0) as binary:
+            for read in iter(lambda: binary.readinto(buffer), 0):
+                hash_file_sha256.update(view[:read])
+        return hash_file_sha256.hexdigest()
+    except Exception as err:
+            print("Error processing {} due to {}".format(file_path, str(err)))
+            return None
+    finally:
+        view.release()
@@ -3,7 +3,30 @@ import ssl
 import sys
 import os
 import shutil
+import hashlib
+import datetime
+import threading
+import time
+import stat
+import fnmatch
+import json
+import re
 from base64 import b64encode, b64decode
+from protocol import ProtocolStream, MSG_RESPONSE, MSG_CHUNK, MSG_END, MSG_ERROR, TRANSFER_CHUNK_SIZE
+from binary_hashing import get_all_binary_full_paths, hash_binaries
+from delta_sync import block_size_for, generate_signatures, apply_delta
+from profiler import ProfileCapture, PROFILE_STOP_GRACE
+
+RECORD_BATCH_SIZE = 64 * 1024
+PROCESS_TABLE_COLUMNS = ("pid", "ppid", "comm", "state", "utime", "stime", "rss_kb", "start_time")
+TELEMETRY_FLUSH_INTERVAL = 10
+LISTING_COLUMNS = ("path", "type", "size", "mode", "mtime")
+SEARCH_READ_SIZE = 1024 * 1024
+SEARCH_MAX_LINE = 512
+SEARCH_FLUSH_INTERVAL = 1.0
+SEARCH_DEFAULT_LIMIT = 1000
+#Pseudo filesystems whose files can block or never end when read, searches do not enter them
+SEARCH_SKIP_DIRECTORIES = frozenset(("/proc", "/sys", "/dev"))
 
 class Client():
     """
@@ -13,6 +36,12 @@ class Client():
         _server_ip (str): The IP address of the server to connect to
         _server_port (str): The port of the server to connect to
         _socket (socket): The socket used for communication
+        _stream (ProtocolStream): Sends and receives whole messages over the socket
+        _request_id (int): The request ID of the command currently being answered
+        _telemetry_thread (Thread): The thread pushing telemetry samples, None when not subscribed
+        _telemetry_stop (Event): Set to stop the telemetry thread
+        _searches (dict): The request ID of each running search to the Event that cancels it
+        _profile (ProfileCapture): The profile the server asked for, None when not profiling
     """
     def __init__(self):
         """
@@ -21,6 +50,12 @@ class Client():
         self._server_ip = None
         self._server_port = None
         self._socket = None
+        self._stream = None
+        self._request_id = 0
+        self._telemetry_thread = None
+        self._telemetry_stop = threading.Event()
+        self._searches = {}
+        self._profile = None
 
     def get_ip_port_of_server_from_user(self) -> None:
         """
@@ -77,25 +112,295 @@ class Client():
         Connect to the server
         """
         self._socket.connect((self._server_ip, int(self._server_port)))
+        self._stream = ProtocolStream(self._socket)
+
+    def receive_data(self) -> str:
+        """
+        Used to receive a whole message from the server using the negotiated framing.
+
+        Returns:
+            str: The received, decoded data.
+        """
+        message = self._stream.receive_message()
+        self._request_id = message.request_id
+        return message.payload.decode()
 
-    def receive_data(self, stream) -> str:
+    def send_data(self, data, msg_type=MSG_RESPONSE) -> None:
         """
-        Used to receive data from the server and strip the EOM delimiter.
+        Sends a reply to the command currently being answered.
 
         Args:
-            stream (socket): The socket stream to receive data from
+            data (str|bytes): The reply to send
+            msg_type (int): The message type of the reply
+        """
+        self._stream.send_message(data, msg_type=msg_type, request_id=self._request_id)
+
+    def receive_request_message(self):
+        """
+        Receives the next message of the request currently being answered, such as a file chunk.
+        Heartbeats the server sends in the meantime are answered straight away so a long transfer
+        does not get the client disconnected.
 
         Returns:
-            str: The received, decoded data.
+            Message: The next message of the current request.
+        """
+        while True:
+            message = self._stream.receive_message()
+            if message.request_id == self._request_id or not self._stream.framed:
+                return message
+            if message.payload == b"hello":
+                self._stream.send_message("hello", request_id=message.request_id)
+
+    def receive_file_stream(self, data) -> None:
+        """
+        Receives a file the server streams in raw chunks and writes each chunk to disk as it arrives.
+        The stream is always read to the end so the connection stays in step if the file cannot be written.
+
+        Args:
+            data (str): The 'putfile|<name>|<size>' command that starts the stream
+        """
+        _, file_name, file_size = data.split("|", 2)
+        received = 0
+        error = None
+        file = None
+        try:
+            file = open(file_name, "wb")
+        except OSError as err:
+            error = err
+        while True:
+            message = self.receive_request_message()
+            if message.msg_type == MSG_END:
+                break
+            received += len(message.payload)
+            if file and not error:
+                try:
+                    file.write(message.payload)
+                except OSError as err:
+                    error = err
+            print("Receiving {}: {}/{} bytes".format(file_name, received, file_size), end="\r")
+        if file:
+            file.close()
+        if error:
+            print("\nError saving file {}: {}".format(file_name, str(error)))
+            self.send_data("putfile|denied|{}".format(str(error)))
+        else:
+            print("\nFile recieved and saved {}".format(file_name))
+            self.send_data("putfile|ok|{}".format(received))
+
+    def receive_file_delta(self, data) -> None:
         """
-        data = ""
+        Updates a file the client may already have a copy of by sending signatures of its blocks and
+        rebuilding the new version from the server's delta in a temporary file. The temporary file
+        replaces the copy only once its SHA256 matches the server's, and keeps the copy's permissions.
+        The delta is always read to the end so the connection stays in step if the file cannot be written.
+
+        Args:
+            data (str): The 'putdelta|<name>|<size>' command that starts the exchange
+        """
+        _, file_name, file_size = data.split("|", 2)
+        basis = None
+        try:
+            basis = open(file_name, "rb")
+            block_size = block_size_for(os.fstat(basis.fileno()).st_size)
+        except OSError:
+            block_size = 0
+        self.send_data("putdelta|{}".format(block_size))
+        if basis:
+            for batch in generate_signatures(basis, block_size):
+                self.send_data(batch, msg_type=MSG_CHUNK)
+        self.send_data(b"", msg_type=MSG_END)
+
+        temp_name = os.path.join(os.path.dirname(file_name), ".{}.delta".format(os.path.basename(file_name)))
+        hasher = hashlib.sha256()
+        written = 0
+        error = None
+        output = None
+        try:
+            output = open(temp_name, "wb")
+        except OSError as err:
+            error = err
         while True:
-            chunk = stream.recv(1024).decode()
-            data += chunk
-            if "<EOM488965>" in data:
+            message = self.receive_request_message()
+            if message.msg_type == MSG_END:
+                break
+            if output and not error:
+                try:
+                    written += apply_delta(message.payload, basis, output, block_size, hasher)
+                except (OSError, ValueError) as err:
+                    error = err
+            print("Rebuilding {}: {}/{} bytes".format(file_name, written, file_size), end="\r")
+        if basis:
+            basis.close()
+        if output:
+            output.close()
+        if not error and hasher.hexdigest() != message.payload.decode():
+            error = ValueError("SHA256 of the rebuilt file does not match the server")
+        try:
+            if error:
+                raise error
+            if basis:
+                os.chmod(temp_name, os.stat(file_name).st_mode & 0o7777)
+            os.replace(temp_name, file_name)
+        except (OSError, ValueError) as err:
+            if output:
+                os.remove(temp_name)
+            print("\nError updating file {}: {}".format(file_name, str(err)))
+            self.send_data("putdelta|denied|{}".format(str(err)))
+            return
+        print("\nFile updated from delta and saved {}".format(file_name))
+        self.send_data("putdelta|ok|{}".format(written))
+
+    def send_file_stream(self, file_requested) -> None:
+        """
+        Streams a file to the server in raw chunks, reusing one buffer so memory use stays flat.
+
+        Args:
+            file_requested (str): The path of the file the server requested
+        """
+        try:
+            file_to_send = open(file_requested, "rb")
+        except OSError as err:
+            self.send_data(str(err), msg_type=MSG_ERROR)
+            return
+        with file_to_send:
+            file_size = os.fstat(file_to_send.fileno()).st_size
+            self.send_data("getfile|{}".format(file_size))
+            if not self.send_file_chunks(file_to_send, file_requested, 0, file_size):
+                return
+        self.send_data(b"", msg_type=MSG_END)
+        print("\nFile sent to server: {}".format(file_requested))
+
+    def send_file_range(self, data) -> None:
+        """
+        Streams part of a file to the server so an interrupted download can be resumed. The server sends
+        the SHA256 of the bytes it already has, if they no longer match the start of the file the whole
+        file is sent again. The SHA256 of the file up to the end of the range is sent with the end of
+        the stream so the server can check the saved file.
+
+        Args:
+            data (str): The 'getrange|<offset>|<length>|<prefix sha256>|<path>' command, a length of 0 reads to the end
+        """
+        _, offset, length, prefix_digest, file_requested = data.split("|", 4)
+        offset, length = int(offset), int(length)
+        try:
+            file_to_send = open(file_requested, "rb")
+        except OSError as err:
+            self.send_data(str(err), msg_type=MSG_ERROR)
+            return
+        with file_to_send:
+            file_size = os.fstat(file_to_send.fileno()).st_size
+            end = file_size if not length else min(file_size, offset + length)
+            hasher = hashlib.sha256()
+            start = 0
+            if 0 < offset <= end:
+                if self.hash_file_range(file_to_send, hasher, offset) == prefix_digest:
+                    start = offset
+                else:
+                    hasher = hashlib.sha256()
+                    file_to_send.seek(0)
+            self.send_data("getrange|{}|{}".format(file_size, start))
+            if not self.send_file_chunks(file_to_send, file_requested, start, end, hasher):
+                return
+        self.send_data(hasher.hexdigest(), msg_type=MSG_END)
+        print("\nFile sent to server: {} from byte {}".format(file_requested, start))
+
+    @staticmethod
+    def hash_file_range(file, hasher, length) -> str:
+        """
+        Adds the next length bytes of a file to a hash.
+
+        Args:
+            file (file): The open file, positioned at the start of the range
+            hasher (hash): The hashlib object to update
+            length (int): The number of bytes to hash
+
+        Returns:
+            str: The hex digest so far
+        """
+        buffer = bytearray(TRANSFER_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while length > 0:
+            read = file.readinto(view[:min(length, TRANSFER_CHUNK_SIZE)])
+            if not read:
                 break
-        return data.replace("<EOM488965>", "")
+            hasher.update(view[:read])
+            length -= read
+        return hasher.hexdigest()
+
+    def send_file_chunks(self, file, file_requested, start, end, hasher=None) -> bool:
+        """
+        Streams bytes start to end of an open file to the server in raw chunks, reusing one buffer so
+        memory use stays flat. Read errors are reported to the server with MSG_ERROR.
+
+        Args:
+            file (file): The open file, positioned at start
+            file_requested (str): The path of the file, for progress output
+            start (int): The offset of the first byte to send
+            end (int): The offset to stop sending at
+            hasher (hash): A hashlib object updated with every byte sent, or None
+
+        Returns:
+            bool: False if the file could not be read
+        """
+        buffer = bytearray(TRANSFER_CHUNK_SIZE)
+        view = memoryview(buffer)
+        sent = start
+        try:
+            while sent < end:
+                read = file.readinto(view[:min(end - sent, TRANSFER_CHUNK_SIZE)])
+                if not read:
+                    break
+                if hasher:
+                    hasher.update(view[:read])
+                self.send_data(view[:read], msg_type=MSG_CHUNK)
+                sent += read
+                print("Sending {}: {}/{} bytes".format(file_requested, sent, end), end="\r")
+        except OSError as err:
+            self.send_data(str(err), msg_type=MSG_ERROR)
+            return False
+        return True
     
+    def send_binary_hashes(self, paths) -> None:
+        """
+        Hashes the files in each requested directory with the shared binary_hashing engine and streams
+        'path:digest' records back in batches as they are hashed, so the scan is never held in memory.
+
+        Args:
+            paths (list): The directories of binaries to hash
+        """
+        binary_paths = get_all_binary_full_paths([path for path in paths if os.path.isdir(path)])
+        print("Server requested hashes of {} binaries".format(len(binary_paths)))
+        self.send_record_batches("{}:{}\n".format(binary_path, hash_value) for binary_path, hash_value
+                                 in hash_binaries(binary_paths, os.cpu_count() or 1)
+                                 if hash_value is not None)
+
+    def send_record_batches(self, records) -> int:
+        """
+        Streams text records to the server in chunks of about RECORD_BATCH_SIZE bytes as they are
+        produced, followed by MSG_END carrying the number of records, so neither end holds them all.
+
+        Args:
+            records (iterable): Newline terminated records
+
+        Returns:
+            int: The number of records sent
+        """
+        batch = []
+        batch_size = 0
+        count = 0
+        for record in records:
+            batch.append(record)
+            batch_size += len(record)
+            count += 1
+            if batch_size >= RECORD_BATCH_SIZE:
+                self.send_data("".join(batch), msg_type=MSG_CHUNK)
+                batch = []
+                batch_size = 0
+        if batch:
+            self.send_data("".join(batch), msg_type=MSG_CHUNK)
+        self.send_data(str(count), msg_type=MSG_END)
+        return count
+
     @staticmethod
     def get_running_processes() -> list:
         """
@@ -104,14 +409,300 @@ class Client():
         Returns:
             list: A list of running processes
         """
-        process_list = []
-        for i in os.listdir("/proc"):
-            if i.isdigit():
-                with open(f"/proc/{i}/comm", 'r') as comm:
-                    process_name = comm.readline().strip()
-                process_list.append("PID: {}, Name: {}".format(i, process_name))
-        return process_list
+        return ["PID: {}, Name: {}".format(process["pid"], process["comm"]) for process in Client.iter_processes()]
+
+    @staticmethod
+    def iter_processes():
+        """
+        Yields a record for each running process from /proc/<pid>/stat and /proc/<pid>/statm, one process
+        at a time. Processes that exit part way through the scan are skipped.
+
+        Yields:
+            dict: pid, ppid, comm, state, utime and stime in seconds, rss_kb and start_time as a Unix timestamp
+        """
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+        page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+        boot_time = 0
+        with open("/proc/stat", "r") as stat:
+            for line in stat:
+                if line.startswith("btime"):
+                    boot_time = int(line.split()[1])
+                    break
+        with os.scandir("/proc") as entries:
+            for entry in entries:
+                if not entry.name.isdigit():
+                    continue
+                try:
+                    with open(f"/proc/{entry.name}/stat", "rb") as stat:
+                        stat_line = stat.read().decode(errors="replace")
+                    with open(f"/proc/{entry.name}/statm", "rb") as statm:
+                        resident_pages = int(statm.read().split()[1])
+                except (FileNotFoundError, ProcessLookupError, PermissionError, IndexError, ValueError):
+                    continue
+                comm_start, comm_end = stat_line.find("("), stat_line.rfind(")")
+                fields = stat_line[comm_end + 2:].split()
+                try:
+                    yield {"pid":int(entry.name),
+                           "ppid":int(fields[1]),
+                           "comm":stat_line[comm_start + 1:comm_end],
+                           "state":fields[0],
+                           "utime":int(fields[11]) / clock_ticks,
+                           "stime":int(fields[12]) / clock_ticks,
+                           "rss_kb":resident_pages * page_kb,
+                           "start_time":boot_time + int(fields[19]) / clock_ticks}
+                except (IndexError, ValueError):
+                    continue
+
+    def send_process_table(self) -> None:
+        """
+        Streams a tab separated table of the running processes, a header row then one row per process,
+        in batches as /proc is scanned so the time to the first batch does not depend on the number of processes.
+        """
+        rows = ("{pid}\t{ppid}\t{comm}\t{state}\t{utime:.2f}\t{stime:.2f}\t{rss_kb}\t{start}\n".format(
+                    start=datetime.datetime.fromtimestamp(process["start_time"]).strftime("%Y-%m-%d %H:%M:%S"),
+                    **dict(process, comm=process["comm"].replace("\t", " ").replace("\n", " ")))
+                for process in self.iter_processes())
+        self.send_data("\t".join(PROCESS_TABLE_COLUMNS) + "\n", msg_type=MSG_CHUNK)
+        self.send_record_batches(rows)
     
+    def send_tree_listing(self, data) -> None:
+        """
+        Streams a tab separated recursive listing of a directory, a header row then one row per entry,
+        in pages as the tree is walked so neither end holds the listing.
+
+        Args:
+            data (str): The 'listtree|<max depth, 0 for no limit>|<glob>|<path>' command
+        """
+        _, max_depth, pattern, root = data.split("|", 3)
+        if not os.path.isdir(root):
+            self.send_data("{} is not a directory".format(root), msg_type=MSG_ERROR)
+            return
+        print("Server requested a listing of {}".format(root))
+        rows = ("{}\t{}\t{}\t{}\t{}\n".format(self.escape_path(path), kind, size, mode,
+                                             datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S"))
+                for path, kind, size, mode, mtime in self.iter_tree(root, int(max_depth), pattern or "*"))
+        self.send_data("\t".join(LISTING_COLUMNS) + "\n", msg_type=MSG_CHUNK)
+        self.send_record_batches(rows)
+
+    @staticmethod
+    def iter_tree(root, max_depth=0, pattern="*", skip=frozenset()):
+        """
+        Walks a directory tree with os.scandir and yields the entries whose names match a glob pattern.
+        Directories are walked from a stack rather than by recursion, symlinks are listed but not followed
+        and directories that cannot be read are yielded as errors and skipped.
+
+        Args:
+            root (str): The directory to list
+            max_depth (int): The number of levels to list, 1 lists only the entries of root, 0 for no limit
+            pattern (str): The glob the entry names must match, directories are walked whether they match or not
+            skip (frozenset): Directories that are listed but not walked
+
+        Yields:
+            tuple: (path, type, size, mode, mtime), type is 'd', 'f', 'l' or 'o' for other, or 'error' with the
+            reason in place of the mode
+        """
+        stack = [(root, 1)]
+        while stack:
+            directory, depth = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            entry_stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if stat.S_ISDIR(entry_stat.st_mode):
+                            kind = "d"
+                            if (not max_depth or depth < max_depth) and entry.path not in skip:
+                                stack.append((entry.path, depth + 1))
+                        elif stat.S_ISREG(entry_stat.st_mode):
+                            kind = "f"
+                        elif stat.S_ISLNK(entry_stat.st_mode):
+                            kind = "l"
+                        else:
+                            kind = "o"
+                        if fnmatch.fnmatchcase(entry.name, pattern):
+                            yield (entry.path, kind, entry_stat.st_size, stat.filemode(entry_stat.st_mode),
+                                   entry_stat.st_mtime)
+            except OSError as err:
+                yield (directory, "error", 0, err.strerror, 0)
+
+    @staticmethod
+    def escape_path(path) -> str:
+        """
+        Makes a path, or a line of a file as bytes, safe to send as a field of a tab separated row. Tabs
+        and newlines are escaped and bytes that are not valid UTF-8 are written as \\x escapes.
+        """
+        return (path if isinstance(path, bytes) else os.fsencode(path)).decode("utf-8", "backslashreplace").replace("\t", "\\t").replace("\n", "\\n")
+
+    #The following functions search the client's files in a worker thread
+
+    def start_search(self, data) -> None:
+        """
+        Starts a search in its own thread so the client keeps answering the server, including heartbeats
+        and requests to cancel the search, while it runs.
+
+        Args:
+            data (str): The 'search|<JSON options>' command, see iter_search_records for the options
+        """
+        options = json.loads(data.split("|", 1)[1])
+        stop = threading.Event()
+        self._searches[self._request_id] = stop
+        threading.Thread(target=self.run_search, args=(self._request_id, options, stop),
+                         name="ThreadToSearchFiles", daemon=True).start()
+        print("Server started a search of {}".format(options["root"]))
+
+    def cancel_searches(self, request_id=None) -> None:
+        """
+        Cancels a running search, or every running search if no request ID is given. The search sends
+        the matches found so far and ends.
+
+        Args:
+            request_id (int): The request ID of the search command
+        """
+        for search_id, stop in list(self._searches.items()):
+            if request_id is None or search_id == request_id:
+                stop.set()
+
+    def run_search(self, request_id, options, stop) -> None:
+        """
+        Streams the records of a search as chunks of its request, batched up to RECORD_BATCH_SIZE but sent
+        at least every SEARCH_FLUSH_INTERVAL seconds so matches arrive as they are found. The search ends at
+        the match limit, the time limit or when cancelled, and MSG_END carries a JSON summary of the matches,
+        files and bytes searched and why it stopped.
+
+        Args:
+            request_id (int): The request ID of the search command
+            options (dict): The search options
+            stop (Event): Set to cancel the search
+        """
+        summary = {"matches":0, "files":0, "bytes":0, "stopped":""}
+        limit = int(options.get("limit") or SEARCH_DEFAULT_LIMIT)
+        deadline = time.monotonic() + float(options["timeout"]) if options.get("timeout") else None
+        try:
+            try:
+                regex = re.compile(options["regex"].encode()) if options.get("regex") else None
+            except re.error as err:
+                self._stream.send_message("Invalid regex: {}".format(str(err)), msg_type=MSG_ERROR, request_id=request_id)
+                return
+            batch = []
+            batch_size = 0
+            last_flush = time.monotonic()
+            for record in self.iter_search_records(options, regex, summary):
+                if record:
+                    batch.append(record)
+                    batch_size += len(record)
+                    summary["matches"] += 1
+                now = time.monotonic()
+                if batch and (batch_size >= RECORD_BATCH_SIZE or now - last_flush >= SEARCH_FLUSH_INTERVAL):
+                    self._stream.send_message("".join(batch), msg_type=MSG_CHUNK, request_id=request_id)
+                    batch = []
+                    batch_size = 0
+                    last_flush = now
+                if summary["matches"] >= limit:
+                    summary["stopped"] = "limit"
+                elif stop.is_set():
+                    summary["stopped"] = "cancelled"
+                elif deadline and now >= deadline:
+                    summary["stopped"] = "timeout"
+                if summary["stopped"]:
+                    break
+            if batch:
+                self._stream.send_message("".join(batch), msg_type=MSG_CHUNK, request_id=request_id)
+            self._stream.send_message(json.dumps(summary), msg_type=MSG_END, request_id=request_id)
+            print("Search of {} finished with {} matches".format(options["root"], summary["matches"]))
+        except OSError as err:
+            print("Search stopped: {}".format(str(err)))
+        finally:
+            self._searches.pop(request_id, None)
+
+    def iter_search_records(self, options, regex, summary):
+        """
+        Walks the search root and yields a tab separated 'path, size, mtime, line number, line' record for
+        each matching line of each file that passes the filters, or one record without a line per file if
+        there is no regex. None is yielded after each file and each block read so the caller can check for
+        cancellation during long searches.
+
+        Args:
+            options (dict): root, and optionally name (a glob), min_size and max_size in bytes, newer and older
+                in seconds before now, and depth
+            regex (Pattern): A compiled bytes regex the file contents must match, None to match by name only
+            summary (dict): Updated with the number of files and bytes searched
+
+        Yields:
+            str|None: A record, or None
+        """
+        now = time.time()
+        min_size, max_size = options.get("min_size"), options.get("max_size")
+        newer, older = options.get("newer"), options.get("older")
+        for path, kind, size, _, mtime in self.iter_tree(options["root"], int(options.get("depth") or 0),
+                                                         options.get("name") or "*", SEARCH_SKIP_DIRECTORIES):
+            if (kind != "f" or (min_size is not None and size < min_size) or (max_size is not None and size > max_size) or
+                    (newer is not None and mtime < now - newer) or (older is not None and mtime > now - older)):
+                continue
+            summary["files"] += 1
+            prefix = "{}\t{}\t{}\t".format(self.escape_path(path), size,
+                                            datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S"))
+            if regex is None:
+                yield prefix + "\t\n"
+                continue
+            try:
+                for match in self.grep_file(path, regex):
+                    if match is None:
+                        yield None
+                    else:
+                        yield "{}{}\t{}\n".format(prefix, match[0], self.escape_path(match[1].rstrip(b"\r")))
+            except OSError:
+                pass
+            summary["bytes"] += size
+            yield None
+
+    @staticmethod
+    def grep_file(path, regex):
+        """
+        Searches a file for a regex a block at a time, so the regex runs over whole blocks and only the
+        matching lines are handled line by line. Blocks are cut after their last newline so lines are never
+        split, except lines longer than a block. Files with a NUL byte in their first block are treated as
+        binary and reported once if they match.
+
+        Args:
+            path (str): The file to search
+            regex (Pattern): A compiled bytes regex
+
+        Yields:
+            tuple|None: (line number, the first SEARCH_MAX_LINE bytes of the line) for each matching line,
+            line number 0 for a binary file, or None after each block
+        """
+        with open(path, "rb") as file:
+            carry = b""
+            line_number = 1
+            binary = None
+            while True:
+                block = file.read(SEARCH_READ_SIZE)
+                if binary is None:
+                    binary = b"\0" in block[:8192]
+                data = carry + block if carry else block
+                cut = (data.rfind(b"\n") + 1 or len(data)) if block else len(data)
+                chunk, carry = data[:cut], data[cut:]
+                counted = 0
+                last_start = -1
+                for match in regex.finditer(chunk):
+                    if binary:
+                        yield 0, b"Binary file matches"
+                        return
+                    start = chunk.rfind(b"\n", 0, match.start()) + 1
+                    if start == last_start:
+                        continue
+                    last_start = start
+                    end = chunk.find(b"\n", start)
+                    line_number += chunk.count(b"\n", counted, start)
+                    counted = start
+                    yield line_number, chunk[start:min(end if end != -1 else len(chunk), start + SEARCH_MAX_LINE)]
+                line_number += chunk.count(b"\n", counted)
+                if not block:
+                    return
+                yield None
+
     @staticmethod
     def get_cpu_info() -> str:
         """
@@ -180,31 +771,183 @@ class Client():
         free_formatted = "Free disk: {:.2f} GB".format(free / (1024**3))
         return total_formatted + "\n" + used_formatted + "\n" + free_formatted
 
+    #The following functions push telemetry samples to the server once it subscribes
+
+    def start_telemetry(self, data) -> None:
+        """
+        Starts pushing telemetry samples to the server, replacing any earlier subscription.
+
+        Args:
+            data (str): The 'subscribe|<interval seconds>' command
+        """
+        self.stop_telemetry()
+        interval = max(1.0, float(data.split("|")[1]))
+        self._telemetry_stop = threading.Event()
+        self._telemetry_thread = threading.Thread(target=self.publish_telemetry,
+                                                  args=(self._request_id, interval, self._telemetry_stop),
+                                                  name="ThreadToPublishTelemetry", daemon=True)
+        self._telemetry_thread.start()
+        print("Server subscribed to telemetry every {}s".format(interval))
+
+    def stop_telemetry(self) -> None:
+        """
+        Stops pushing telemetry samples and waits for the last batch to be sent.
+        """
+        if self._telemetry_thread:
+            self._telemetry_stop.set()
+            self._telemetry_thread.join()
+            self._telemetry_thread = None
+
+    def publish_telemetry(self, request_id, interval, stop) -> None:
+        """
+        Samples CPU, memory and disk use every interval seconds and sends the samples in batches covering
+        TELEMETRY_FLUSH_INTERVAL seconds, or every sample at longer intervals, as chunks of the subscribe
+        request. The first sample is sent on its own so the server has a reading straight away. The server is never asked for anything, so a subscription costs one message per batch.
+        Each sample is a tab separated 'time, CPU %, memory used %, disk used %, 1 minute load' row.
+
+        Args:
+            request_id (int): The request ID of the subscribe command
+            interval (float): Seconds between samples
+            stop (Event): Set to stop publishing, the remaining samples and MSG_END are then sent
+        """
+        batch = []
+        samples_per_batch = max(1, int(TELEMETRY_FLUSH_INTERVAL // interval))
+        sent_first = False
+        previous_cpu = self.get_cpu_times()
+        next_sample = time.monotonic()
+        try:
+            while not stop.wait(max(0, next_sample + interval - time.monotonic())):
+                next_sample = max(next_sample + interval, time.monotonic() - interval)
+                cpu = self.get_cpu_times()
+                idle, total = cpu[0] - previous_cpu[0], cpu[1] - previous_cpu[1]
+                previous_cpu = cpu
+                total_disk, used_disk, _ = shutil.disk_usage("/")
+                batch.append("{:.3f}\t{:.1f}\t{:.1f}\t{:.1f}\t{:.2f}\n".format(
+                    time.time(), 100 * (1 - idle / total) if total else 0.0, self.get_memory_used_percent(),
+                    100 * used_disk / total_disk, os.getloadavg()[0]))
+                if len(batch) >= samples_per_batch or not sent_first:
+                    self._stream.send_message("".join(batch), msg_type=MSG_CHUNK, request_id=request_id)
+                    batch = []
+                    sent_first = True
+            if batch:
+                self._stream.send_message("".join(batch), msg_type=MSG_CHUNK, request_id=request_id)
+            self._stream.send_message(b"", msg_type=MSG_END, request_id=request_id)
+        except OSError as err:
+            print("Telemetry stopped: {}".format(str(err)))
+
+    @staticmethod
+    def get_cpu_times() -> tuple:
+        """
+        Reads the idle and total CPU time since boot from /proc/stat
+
+        Returns:
+            tuple: (idle ticks, total ticks)
+        """
+        with open("/proc/stat", "r") as stat:
+            ticks = [int(value) for value in stat.readline().split()[1:]]
+        return ticks[3] + ticks[4], sum(ticks[:8])
+
+    @staticmethod
+    def get_memory_used_percent() -> float:
+        """
+        Calculates the percentage of memory in use from /proc/meminfo
+
+        Returns:
+            float: The percentage of memory that is not available
+        """
+        memory = {}
+        with open("/proc/meminfo", "r") as info:
+            for line in info:
+                name, value = line.split(":", 1)
+                if name in ("MemTotal", "MemAvailable"):
+                    memory[name] = int(value.split()[0])
+                    if len(memory) == 2:
+                        break
+        return 100 * (1 - memory["MemAvailable"] / memory["MemTotal"])
+
+    def start_profile(self, data) -> None:
+        """
+        Starts profiling the thread that answers commands, and tracing allocations, until the server asks
+        for the report with 'profile|stop'.
+
+        Args:
+            data (str): The 'profile|start|<seconds>' command
+        """
+        if self._profile:
+            self.send_data("A profile is already running", msg_type=MSG_ERROR)
+            return
+        capture = ProfileCapture(float(data.split("|")[2]))
+        try:
+            capture.start()
+        except ValueError as err:
+            self.send_data(str(err), msg_type=MSG_ERROR)
+            return
+        self._profile = capture
+        self.send_data("profile|started|{}".format(capture.seconds))
+        print("Server started a {}s profile".format(capture.seconds))
+
+    def stop_profile(self) -> None:
+        """
+        Stops the running profile, if it has not expired already, and sends its report.
+        """
+        capture, self._profile = self._profile, None
+        if capture is None:
+            self.send_data("No profile is running", msg_type=MSG_ERROR)
+            return
+        if capture.elapsed is None:
+            capture.stop()
+        self.send_data(capture.report("client {} command thread".format(socket.gethostname())))
+        print("Profile sent to server")
+
+    def expire_profile(self) -> None:
+        """
+        Stops a profile PROFILE_STOP_GRACE seconds after its deadline if the server has not asked for it,
+        so a lost server cannot leave it slowing the client down. The report is kept until it is asked for.
+        """
+        if self._profile and self._profile.elapsed is None and time.time() > self._profile.deadline + PROFILE_STOP_GRACE:
+            self._profile.stop()
+
     def ready_to_receive(self):
         """
         This is the main loop to recieve and process server commands
         """
         while True:
-            data = self.receive_data(self._socket)
+            data = self.receive_data()
+            self.expire_profile()
+
+            if data.startswith("protocol|"):
+                self._stream.accept_protocol(data)
+
+            if data.startswith("compression|"):
+                self._stream.accept_compression(data)
 
             if data == "hello":
-                self._socket.send(str.encode("hello<EOM488965>"))
+                self.send_data("hello")
                 
             if data == "exit":
+                self.stop_telemetry()
+                self.cancel_searches()
                 self._socket.close()
                 sys.exit()
 
+            if data.startswith("subscribe|"):
+                self.start_telemetry(data)
+
+            if data == "unsubscribe":
+                self.stop_telemetry()
+
             if data == "processes":
                 _ = "\n".join(self.get_running_processes())
-                prepared_message = "processes|" + _ + "<EOM488965>"
-                self._socket.send(str.encode(prepared_message))
+                self.send_data("processes|" + _)
+
+            if data == "processtable":
+                self.send_process_table()
 
             if data == "sysinfo":
                 os_ = self.get_os_info()
                 cpu = self.get_cpu_info()
                 memory = self.get_memory_info()
-                prepared_message = ("sysinfo| " + os_ + "\n" + cpu + "\n" + memory + "<EOM488965>")
-                self._socket.send(str.encode(prepared_message))       
+                self.send_data("sysinfo| " + os_ + "\n" + cpu + "\n" + memory)
                 
             if data.startswith("sendfile|"):
                 try:
@@ -215,24 +958,38 @@ class Client():
                         file.write(file_data)
                         print("File recieved and saved {}".format(file_name))
                 except Exception as err:
-                    prepared_message = "send|denied<EOM488965>"
-                    self._socket.send(prepared_message.encode()) 
+                    self.send_data("send|denied")
+
+            if data.startswith("putfile|"):
+                self.receive_file_stream(data)
+
+            if data.startswith("putdelta|"):
+                self.receive_file_delta(data)
+
+            if data.startswith("getfile|"):
+                self.send_file_stream(data.split("|", 1)[1])
+
+            if data.startswith("getrange|"):
+                self.send_file_range(data)
+
+            if data.startswith("hashscan|"):
+                self.send_binary_hashes(data.split("|")[1:])
 
             if data.startswith("checkfile|"):
                 path_to_check = data.split("|")[1]
                 if os.path.isfile(path_to_check) and os.access(path_to_check, os.R_OK):
                     print("Server requested file {}".format(path_to_check))
-                    self._socket.send(str.encode("checkfile|1<EOM488965>"))
+                    self.send_data("checkfile|1")
                 else:
                     print("Server requested file {} but it doesn't exist".format(path_to_check))
-                    self._socket.send(str.encode("checkfile|0<EOM488965>"))
+                    self.send_data("checkfile|0")
     
             if data.startswith("request|"):
                 try:
                     file_requested = data.split("|")[1]
                     with open(f"{file_requested}", 'rb') as file_to_send:
                         fileb64 = b64encode(file_to_send.read())
-                        self._socket.send((b"send|" + fileb64 + b"<EOM488965>"))
+                        self.send_data(b"send|" + fileb64)
                         print("File sent to server: {}".format(file_requested))
                 except Exception as err:
                     print("Error sending file: {}".format(str(err)))
@@ -240,29 +997,36 @@ class Client():
             if data == "disk":
                 try:
                     disk_info = self.get_disk_info()
-                    prepared_message = "diskinfo| " + disk_info + "<EOM488965>"
-                    self._socket.send(prepared_message.encode()) 
+                    self.send_data("diskinfo| " + disk_info)
                 except Exception as err:
                     print(str(err))
 
+            if data.startswith("search|"):
+                self.start_search(data)
+
+            if data.startswith("cancel|"):
+                self.cancel_searches(int(data.split("|")[1]))
+
+            if data.startswith("listtree|"):
+                self.send_tree_listing(data)
+
+            if data.startswith("profile|start|"):
+                self.start_profile(data)
+
+            if data == "profile|stop":
+                self.stop_profile()
+
             if data.startswith("listdir|"):
                 dir_to_list = data.split("|")[1]
                 try:
                     dir_listing = "\n".join(os.listdir(dir_to_list))
-                    prepared_message = "dirlisting| " + dir_listing + "<EOM488965>"
-                    self._socket.send(prepared_message.encode()) 
+                    self.send_data("dirlisting| " + dir_listing)
                 except FileNotFoundError:
-                    dir_listing = "Directory not found"
-                    prepared_message = "dirlisting| " + dir_listing + "<EOM488965>"
-                    self._socket.send(prepared_message.encode())
+                    self.send_data("dirlisting| Directory not found")
                 except PermissionError:
-                    dir_listing = "Permission denied"
-                    prepared_message = "dirlisting| " + dir_listing + "<EOM488965>"
-                    self._socket.send(prepared_message.encode()) 
+                    self.send_data("dirlisting| Permission denied") 
                 except NotADirectoryError:
-                    dir_listing = "Not a directory"
-                    prepared_message = "dirlisting| " + dir_listing + "<EOM488965>"
-                    self._socket.send(prepared_message.encode()) 
+                    self.send_data("dirlisting| Not a directory") 
 
 def main():
     """
@@ -8,10 +8,11 @@ from abc import abstractmethod, ABC
 from server_controller import CreateController, SetupController
 
 class ServerSetup(ABC):
-    def __init__(self, ip):
+    def __init__(self, ip, port=999):
         self._server_ip = ip
-        self._server_port = 999
+        self._server_port = port
         self._socket = None
+        self._tls_context = None
     
     @abstractmethod
     def create_socket(self):
@@ -70,7 +71,7 @@ class CertificateSetup(ABC):
         pass
     
 class CreateServer(ServerSetup, CertificateSetup):
-    def __init__(self, ip, server_logger, controller_instance):
+    def __init__(self, ip, server_logger, controller_instance, port=999, interactive=True):
         """
         Initialises the CreateServer object by setting the server IP, server logger, and controller instance.
         It calls several methods to create certificates, create a socket, enable TLS, bind the socket to an IP and port,
@@ -80,11 +81,15 @@ class CreateServer(ServerSetup, CertificateSetup):
             ip (str): The IP address for the server
             server_logger (object): An instance of the CreateLogger class for logging server events.
             controller_instance (object): An instance of CreateController class for handling client functionality.
+            port (int): The port to listen on, 0 picks a free port.
+            interactive (bool): Run the menu once the controller is serving, False returns instead so the
+                controller can be driven programmatically i.e. by loopback_benchmark.py.
         """
-        ServerSetup.__init__(self, ip)
+        ServerSetup.__init__(self, ip, port)
         CertificateSetup.__init__(self)
         self._server_logger = server_logger
         self._controller_instance = controller_instance
+        self._interactive = interactive
         self.create_certificates()
         self.create_socket()
         self.wrap_socket_tls()
@@ -128,8 +133,9 @@ class CreateServer(ServerSetup, CertificateSetup):
                         
     def wrap_socket_tls(self):
         """
-        Enables TLS for the server by creating a TLS context, loading the server's 
-        certificate and key, and wrapping the socket with the TLS context.
+        Enables TLS for the server by creating a TLS context and loading the server's 
+        certificate and key. The controller's event loop performs the handshake on each
+        authorised connection without blocking the listener.
 
         Raises:
             SSLError: If there is a SSL error.
@@ -138,10 +144,7 @@ class CreateServer(ServerSetup, CertificateSetup):
             context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             context.load_cert_chain(certfile=self._certificate,
                                     keyfile=self._key)
-            self._socket = context.wrap_socket(self._socket, 
-                                               server_side=True,
-                                               do_handshake_on_connect=False
-                                               )
+            self._tls_context = context
             self._server_logger.logger.info("TLS enabled")
         except ssl.SSLError as err:
             self._server_logger.logger.error(str(err))
@@ -172,16 +175,24 @@ class CreateServer(ServerSetup, CertificateSetup):
             SSLError: If there is a SSL error.
         """
         try:
-            self._socket.listen(5)
+            self._socket.listen(socket.SOMAXCONN)
             self._server_logger.logger.info("Socket listening for connections")
         except (ssl.SSLError, socket.error) as err:
             self._server_logger.logger.error(str(err))
             sys.exit()        
 
+    @property
+    def server_port(self) -> int:
+        """
+        Returns the port the server is listening on, the chosen port if it was created with port 0.
+        """
+        return self._socket.getsockname()[1]
+
     def pass_socket_to_controller(self):
         """
-        Creates a new thread to handle client connections and passes the socket 
-        to the controller instance.
+        Creates a new thread running the controller's event loop, which handles every client
+        connection, and passes it the socket and TLS context. The menu then runs on this thread
+        as a front end to the event loop, unless the server is not interactive.
 
         Raises:
             SSLError: If there is an SSL error.
@@ -189,9 +200,11 @@ class CreateServer(ServerSetup, CertificateSetup):
         try:
             handle_client_thread = threading.Thread(
                 target=self._controller_instance.socket_for_controller, 
-                args=(self._socket,), name="ThreadToHandleClients")
+                args=(self._socket, self._tls_context), name="ThreadToHandleClients")
             handle_client_thread.daemon = True
             handle_client_thread.start()
+            self._controller_instance.wait_until_serving()
         except (ssl.SSLError, socket.error) as err:
             self._server_logger.logger.error(str(err))
-        self._controller_instance.display_menu()
\ No newline at end of file
+        if self._interactive:
+            self._controller_instance.display_menu()
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""
+rsync style delta transfer used to update files the client already has an older copy of.
+
+The client splits its copy into fixed size blocks and sends a weak and a strong checksum of each.
+The server slides a window over the new file looking for blocks the client already has, and sends
+the new file as a stream of operations: literal bytes the client does not have, and references to
+runs of the client's own blocks. The client rebuilds the file from the operations in a temporary
+file and renames it over its copy once the SHA256 of the result matches the server's.
+
+The weak checksum is adler32, so whole blocks are checked with zlib at C speed and the window is
+only rolled a byte at a time in Python through regions that have changed.
+"""
+
+import hashlib
+import math
+import struct
+import zlib
+
+DELTA_MIN_BLOCK_SIZE = 2048
+DELTA_MAX_BLOCK_SIZE = 64 * 1024
+DELTA_ROLL_LIMIT = 1024 * 1024
+DELTA_BATCH_SIZE = 256 * 1024
+ADLER_MOD = 65521
+
+SIGNATURE = struct.Struct("!I16s")
+LITERAL = struct.Struct("!cI")
+COPY = struct.Struct("!cII")
+OP_LITERAL = b"L"
+OP_COPY = b"C"
+
+def block_size_for(file_size) -> int:
+    """
+    Picks a block size of roughly the square root of the file size, as rsync does, so the number of
+    signatures and the size of each block grow together.
+
+    Args:
+        file_size (int): The size of the client's copy in bytes.
+
+    Returns:
+        int: The block size, a multiple of 1 KB between DELTA_MIN_BLOCK_SIZE and DELTA_MAX_BLOCK_SIZE.
+    """
+    block_size = int(math.sqrt(file_size)) // 1024 * 1024
+    return max(DELTA_MIN_BLOCK_SIZE, min(DELTA_MAX_BLOCK_SIZE, block_size))
+
+def strong_checksum(block) -> bytes:
+    """
+    Returns the first 16 bytes of the SHA256 of a block.
+    """
+    return hashlib.sha256(block).digest()[:16]
+
+def generate_signatures(file, block_size, batch_size=DELTA_BATCH_SIZE):
+    """
+    Reads a file block by block and yields packed signatures of every whole block. A short final
+    block is not signed and is sent as literal data if it is still needed.
+
+    Args:
+        file (file): The client's copy, opened for binary reading.
+        block_size (int): The block size.
+        batch_size (int): The approximate number of bytes of signatures per yielded batch.
+
+    Yields:
+        bytes: Packed (adler32, strong checksum) signatures in block order.
+    """
+    batch = bytearray()
+    for block in iter(lambda: file.read(block_size), b""):
+        if len(block) < block_size:
+            break
+        batch += SIGNATURE.pack(zlib.adler32(block), strong_checksum(block))
+        if len(batch) >= batch_size:
+            yield bytes(batch)
+            batch.clear()
+    if batch:
+        yield bytes(batch)
+
+def load_signatures(payloads) -> dict:
+    """
+    Builds the lookup table the server searches for blocks the client already has.
+
+    Args:
+        payloads (iterable): The signature batches received from the client.
+
+    Returns:
+        dict: adler32 to a dict of strong checksum to block index.
+    """
+    table = {}
+    index = 0
+    for payload in payloads:
+        for weak, strong in SIGNATURE.iter_unpack(payload):
+            table.setdefault(weak, {}).setdefault(strong, index)
+            index += 1
+    return table
+
+def generate_delta(data, table, block_size, batch_size=DELTA_BATCH_SIZE):
+    """
+    Yields batches of operations that rebuild data from the client's blocks. Each batch only holds
+    whole operations. If no block has matched for DELTA_ROLL_LIMIT bytes the search steps a block at a
+    time instead of a byte at a time, so a file that has completely changed costs about as much as
+    sending it whole.
+
+    Args:
+        data (bytes|mmap): The new file.
+        table (dict): The table returned by load_signatures.
+        block_size (int): The block size the client signed its copy with.
+        batch_size (int): The approximate number of bytes per yielded batch.
+
+    Yields:
+        tuple: (batch of packed operations, literal bytes in the batch)
+    """
+    batch = bytearray()
+    literal_bytes = 0
+    copy_start = copy_count = 0
+    length = len(data)
+    position = literal_start = 0
+    weak = None
+    while table and position + block_size <= length:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        candidates = table.get(weak)
+        index = candidates.get(strong_checksum(data[position:position + block_size])) if candidates else None
+        if index is not None:
+            if literal_start < position:
+                if copy_count:
+                    batch += COPY.pack(OP_COPY, copy_start, copy_count)
+                    copy_count = 0
+                for start in range(literal_start, position, batch_size):
+                    chunk = data[start:min(position, start + batch_size)]
+                    batch += LITERAL.pack(OP_LITERAL, len(chunk)) + chunk
+                    literal_bytes += len(chunk)
+            if copy_count and index == copy_start + copy_count:
+                copy_count += 1
+            else:
+                if copy_count:
+                    batch += COPY.pack(OP_COPY, copy_start, copy_count)
+                copy_start, copy_count = index, 1
+            position += block_size
+            literal_start = position
+            weak = None
+        elif position - literal_start >= DELTA_ROLL_LIMIT:
+            position += block_size
+            weak = None
+        else:
+            if position + block_size >= length:
+                break
+            outgoing, incoming = data[position], data[position + block_size]
+            a = (a - outgoing + incoming) % ADLER_MOD
+            b = (b - block_size * outgoing + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            position += 1
+        if len(batch) >= batch_size:
+            yield bytes(batch), literal_bytes
+            batch.clear()
+            literal_bytes = 0
+    if copy_count:
+        batch += COPY.pack(OP_COPY, copy_start, copy_count)
+    for start in range(literal_start, length, batch_size):
+        chunk = data[start:min(length, start + batch_size)]
+        batch += LITERAL.pack(OP_LITERAL, len(chunk)) + chunk
+        literal_bytes += len(chunk)
+        if len(batch) >= batch_size:
+            yield bytes(batch), literal_bytes
+            batch.clear()
+            literal_bytes = 0
+    if batch:
+        yield bytes(batch), literal_bytes
+
+def apply_delta(payload, basis, output, block_size, hasher) -> int:
+    """
+    Applies one batch of operations, copying referenced blocks from the client's copy.
+
+    Args:
+        payload (bytes): A batch yielded by generate_delta.
+        basis (file): The client's copy opened for binary reading, None if it has no copy.
+        output (file): The file being rebuilt.
+        block_size (int): The block size the client signed its copy with.
+        hasher (hash): A hashlib object updated with every byte written.
+
+    Returns:
+        int: The number of bytes written.
+
+    Raises:
+        ValueError: If the batch is malformed or references a block the client does not have.
+    """
+    view = memoryview(payload)
+    offset = written = 0
+    while offset < len(view):
+        op = bytes(view[offset:offset + 1])
+        if op == OP_LITERAL:
+            _, size = LITERAL.unpack_from(view, offset)
+            offset += LITERAL.size
+            chunk = view[offset:offset + size]
+            if len(chunk) != size:
+                raise ValueError("Truncated literal in delta")
+            offset += size
+        elif op == OP_COPY:
+            _, first_block, block_count = COPY.unpack_from(view, offset)
+            offset += COPY.size
+            if basis is None:
+                raise ValueError("Delta references blocks but there is no existing copy")
+            basis.seek(first_block * block_size)
+            remaining = block_count * block_size
+            while remaining:
+                chunk = basis.read(min(remaining, DELTA_BATCH_SIZE))
+                if not chunk:
+                    raise ValueError("Delta references blocks past the end of the existing copy")
+                output.write(chunk)
+                hasher.update(chunk)
+                remaining -= len(chunk)
+            written += block_count * block_size
+            continue
+        else:
+            raise ValueError("Unknown delta operation {!r}".format(op))
+        output.write(chunk)
+        hasher.update(chunk)
+        written += len(chunk)
+    return written
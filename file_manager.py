@@ -1,7 +1,84 @@
 import os
-import tqdm
-import hashlib
-import sys
+import json
+import threading
+import time
+from authorisation import AuthorisedIPIndex, AUTHORISED_IPS_FILE
+from binary_hashing import get_all_binary_stat_keys, hash_binaries
+
+HASH_CACHE_FILE = "known_good_hash_cache.txt"
+KNOWN_GOOD_HASHES_FILE = "known_good_binary_hashes.txt"
+AUTH_LOG_FILE = "auth.log"
+TAIL_BLOCK_SIZE = 4096
+
+class KnownGoodHashIndex():
+    """
+    KnownGoodHashIndex holds the known good hashes in memory for diffing client scans. Digests are packed
+    into one bytearray and each diff marks seen binaries in a bytearray, so a diff costs O(n) time and one
+    byte per known binary on top of the index.
+
+    Attributes:
+        mtime_ns (int): The modification time of the hashes file the index was loaded from
+        _positions (dict): File path to position in _paths and _digests
+        _paths (list): File paths in the order they were loaded
+        _digests (bytearray): The 32 byte SHA256 digest of each file, packed in position order
+    """
+    def __init__(self, hashes_file=KNOWN_GOOD_HASHES_FILE):
+        """
+        Args:
+            hashes_file (str): A file of 'path:digest' lines
+        """
+        self.mtime_ns = os.stat(hashes_file).st_mtime_ns
+        self._positions = {}
+        self._paths = []
+        self._digests = bytearray()
+        with open(hashes_file, "r") as hash_file:
+            for line in hash_file:
+                binary_path, _, hash_value = line.rstrip("\n").rpartition(":")
+                try:
+                    digest = bytes.fromhex(hash_value)
+                except ValueError:
+                    continue
+                self._positions[binary_path] = len(self._paths)
+                self._paths.append(binary_path)
+                self._digests += digest
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def diff(self, records, report) -> dict:
+        """
+        Compares a client's binary hashes with the known good hashes, writing each difference to the
+        report as it is found.
+
+        Args:
+            records (iterable): 'path:digest' strings from the client
+            report (file): An open text file the differences are written to
+
+        Returns:
+            dict: The number of added, removed, modified and unchanged binaries
+        """
+        counts = {'added':0, 'removed':0, 'modified':0, 'unchanged':0}
+        seen = bytearray(len(self._paths))
+        for record in records:
+            binary_path, _, hash_value = record.rpartition(":")
+            position = self._positions.get(binary_path)
+            if position is None:
+                counts['added'] += 1
+                report.write("ADDED {} {}\n".format(binary_path, hash_value))
+                continue
+            seen[position] = 1
+            known_good = self._digests[position * 32:(position + 1) * 32].hex()
+            if known_good == hash_value:
+                counts['unchanged'] += 1
+            else:
+                counts['modified'] += 1
+                report.write("MODIFIED {} expected {} got {}\n".format(binary_path, known_good, hash_value))
+        position = seen.find(0)
+        while position != -1:
+            counts['removed'] += 1
+            report.write("REMOVED {}\n".format(self._paths[position]))
+            position = seen.find(0, position + 1)
+        return counts
 
 class CreateFileManager():
     """
@@ -11,25 +88,52 @@ class CreateFileManager():
     Attributes:
         _authorised_ips (list): A list for authorised IPs. IPs taken fron authorised_ips.txt
         _self._last_5_auth_messages (list): A list for the last 5 auth messges taken from auth.log
+        _self._auth_log_stat_key (tuple): (size, mtime_ns, inode) of auth.log when it was last tailed
         _self._files_in_send_folder (list): A list to contain filnames of files in the tool_box folder
         _self._binary_paths (list): To hold a list of paths to directories for the known good hashes list
+        _hash_workers (int): The number of threads used to hash binaries
+        _baseline_thread (Thread): The background thread generating the known good hashes
+        _baseline_ready (Event): Set once a known good hashes file has been generated
+        _baseline_finished (Event): Set when a build ends, whether it succeeded or failed
+        _baseline_status (str): 'building', 'ready' or 'failed: <reason>'
+        _baseline_progress (list): [binaries hashed, binaries to hash] for the current build
+        _baseline_summary (str): A summary of the last completed build
+        _known_good_hash_index (KnownGoodHashIndex): The known good hashes loaded for diffing client scans
     """
-    def __init__(self):
-        self._authorised_ips = []
+    def __init__(self, hash_workers=None, full_rehash=False):
+        """
+        Args:
+            hash_workers (int): The number of threads used to hash binaries, defaults to the number of CPUs
+            full_rehash (bool): Ignore the hash cache and rehash every binary at startup
+        """
+        self._authorised_ips = None
         self._last_5_auth_messages = []
+        self._auth_log_stat_key = None
         self._files_in_send_folder = []
         
         #replace with folders of known good binaries i.e["/bin", "/usr/bin", "/sbin", "/usr/sbin"]
         self._binary_paths = ["/usr/bin"] 
+        self._hash_workers = hash_workers or os.cpu_count() or 1
+        self._baseline_thread = None
+        self._baseline_ready = threading.Event()
+        self._baseline_finished = threading.Event()
+        self._baseline_status = "not started"
+        self._baseline_progress = [0, 0]
+        self._baseline_summary = ""
+        self._known_good_hash_index = None
 
         self.load_authorised_ips()
         self.load_auth_messages()
-        self.generate_known_good_hashes()
+        self.start_known_good_hashes(full_rehash)
         self.populate_send_files_folder()
         self.create_downloaded_files_folder()
         self.process_dumps_exists()
         self.sysinfo_dumps_exists()
         self.disk_dumps_exists()
+        self.integrity_reports_exists()
+        self.listings_exists()
+        self.search_results_exists()
+        self.profiles_exists()
 
     @staticmethod
     def create_downloaded_files_folder() -> None:
@@ -41,38 +145,86 @@ class CreateFileManager():
         
     def load_authorised_ips(self) -> None:
         """
-        Reads the authorised_ips.txt file
+        Loads the authorised_ips.txt file into an in memory index
         """
         self.check_authorised_ips_exists()
-        with open("authorised_ips.txt", "r") as ips:
-            self._authorised_ips = [line.strip() for line in ips]
+        self._authorised_ips = AuthorisedIPIndex(AUTHORISED_IPS_FILE)
 
     @staticmethod    
     def check_authorised_ips_exists() -> None:
         """
         Creates an 'authorised_ips.txt' file if one does not exist
         """
-        if not os.path.exists("authorised_ips.txt"):
-            with open("authorised_ips.txt", "w") as file:
+        if not os.path.exists(AUTHORISED_IPS_FILE):
+            with open(AUTHORISED_IPS_FILE, "w") as file:
                 pass
     
     def load_auth_messages(self) -> None:
         """
-        Refreshes the authorisation messages for later slicing
+        Refreshes the last 5 authorisation messages by reading backwards from the end of auth.log, so
+        the cost does not depend on the size of the log. Nothing is read if the log has not changed.
         """
-        with open("auth.log", "r") as auth_messages:
-            self._last_5_auth_messages = [line.strip() for line in auth_messages]
+        try:
+            stat = os.stat(AUTH_LOG_FILE)
+        except FileNotFoundError:
+            self._last_5_auth_messages = []
+            return
+        stat_key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if stat_key == self._auth_log_stat_key:
+            return
+        self._last_5_auth_messages = [line.strip() for line in self.tail_lines(AUTH_LOG_FILE, 5)]
+        self._auth_log_stat_key = stat_key
+
+    @staticmethod
+    def tail_lines(file_path, count, block_size=TAIL_BLOCK_SIZE) -> list:
+        """
+        Reads the last lines of a file by seeking backwards from the end in blocks until enough
+        line breaks have been found.
+
+        Args:
+            file_path (str): The file to read
+            count (int): The number of lines to return
+            block_size (int): The number of bytes read per step backwards
+
+        Returns:
+            list: Up to count lines, oldest first
+        """
+        with open(file_path, "rb") as file:
+            position = file.seek(0, os.SEEK_END)
+            data = b""
+            while position > 0 and data.count(b"\n") <= count:
+                step = min(block_size, position)
+                position -= step
+                file.seek(position)
+                data = file.read(step) + data
+        lines = data.decode(errors="replace").splitlines()
+        if position > 0:
+            lines = lines[1:]
+        return [line for line in lines if line.strip()][-count:]
     
     @property       
     def get_authorised_ips(self) -> list:
         """
-        Refreshes the authorised IPs list
+        Refreshes the authorised IPs list if the file has changed
 
         Returns:
-            list: A list of authorised IPs
+            list: A list of authorised IPs and CIDR ranges
         """
-        self.load_authorised_ips()
-        return self._authorised_ips
+        self._authorised_ips.refresh()
+        return self._authorised_ips.entries
+
+    def is_authorised_ip(self, ip) -> bool:
+        """
+        Checks an IP address against the authorised IPs and CIDR ranges without reading the file,
+        unless it has changed since it was last loaded
+
+        Args:
+            ip (str): The IP address of the client
+
+        Returns:
+            bool: True if the IP address is authorised
+        """
+        return self._authorised_ips.is_authorised(ip)
     
     @property
     def get_last_5_auth_messages(self) -> list:
@@ -83,58 +235,147 @@ class CreateFileManager():
             list: A list containing the last 5 items from the auth.log
         """
         self.load_auth_messages()
-        return self._last_5_auth_messages[-5:]
+        return self._last_5_auth_messages
 
-    def get_all_binary_full_paths(self, paths) -> list:
+    def start_known_good_hashes(self, full=False) -> bool:
         """
-        Creates a list of files and their paths from a specified top level directory
+        Starts generating the known good hashes on a background thread so the server can listen for
+        clients straight away. Progress is reported by baseline_status.
 
         Args:
-            paths (list): The list of the directories specified for hashing
+            full (bool): Ignore the hash cache and rehash every binary
 
         Returns:
-            list: A list of all files for and paths for hashing
-        """
-        list_of_all_binaries_paths = []
-        for path in paths:
-            for binary in os.listdir(path):
-                full_binary_path = os.path.join(path, binary)
-                if os.path.isfile(full_binary_path):
-                    list_of_all_binaries_paths.append(full_binary_path)
-        return list_of_all_binaries_paths
-
-    def generate_known_good_hashes(self) -> None:
-        """
-        Creates a known good hashes file containing file name and hash
-        """
-        binary_paths = self.get_all_binary_full_paths(self._binary_paths)
-        with open ("known_good_binary_hashes.txt", "w") as hash_file:
-            for binary_path in tqdm.tqdm(binary_paths, desc="Generating known good binary hashes...", 
-                                         unit="file", file=sys.stdout):
-                hash_value = self.calculate_sha256_of_binary(binary_path)
-                if hash_value:
-                    hash_file.write("{}:{}".format(binary_path, hash_value))
-    
-    @staticmethod
-    def calculate_sha256_of_binary(file_path) -> str:
+            bool: False if a build is already running
         """
-        Creates a hash of an input file
+        if self._baseline_thread and self._baseline_thread.is_alive():
+            return False
+        self._baseline_status = "building"
+        self._baseline_progress = [0, 0]
+        self._baseline_finished.clear()
+        self._baseline_thread = threading.Thread(target=self.generate_known_good_hashes, args=(full,),
+                                                 name="ThreadToGenerateKnownGoodHashes", daemon=True)
+        self._baseline_thread.start()
+        return True
+
+    def wait_for_known_good_hashes(self, timeout=None) -> bool:
+        """
+        Waits for a known good hashes file to be available, or for the running build to fail.
 
         Args:
-            file_path (str): The file path of the file to hash
+            timeout (float): Seconds to wait, None waits forever and 0 only checks
+
+        Returns:
+            bool: True if a known good hashes file has been generated
+        """
+        if not self._baseline_ready.is_set():
+            self._baseline_finished.wait(timeout)
+        return self._baseline_ready.is_set()
+
+    @property
+    def baseline_status(self) -> str:
+        """
+        Describes the state of the known good hashes for the status banner
 
         Returns:
-            str: Hex digest of hashed file
+            str: i.e. 'building 120/936 binaries' or 'ready, 3 of 936 binaries hashed in 0.4s'
+        """
+        if self._baseline_status == "building":
+            done, total = self._baseline_progress
+            return "building {}/{} binaries".format(done, total)
+        if self._baseline_status == "ready":
+            return "ready, " + self._baseline_summary
+        return self._baseline_status
+
+    def get_known_good_hash_index(self) -> KnownGoodHashIndex:
         """
-        hash_file_sha256 = hashlib.sha256()
+        Returns the in memory index of the known good hashes, reloading it if the hashes file has been regenerated
+
+        Returns:
+            KnownGoodHashIndex: The known good hashes index
+        """
+        index = self._known_good_hash_index
+        if index is None or index.mtime_ns != os.stat(KNOWN_GOOD_HASHES_FILE).st_mtime_ns:
+            index = self._known_good_hash_index = KnownGoodHashIndex()
+        return index
+
+    def generate_known_good_hashes(self, full=False) -> None:
+        """
+        Creates a known good hashes file containing one file name and hash per line, in directory order.
+        Binaries whose stat key matches the hash cache reuse their cached digest, only new or modified
+        binaries are hashed. The file is replaced atomically so readers never see a partial baseline.
+        Any error fails the build, its status reports why and waiters are woken either way.
+
+        Args:
+            full (bool): Ignore the hash cache and rehash every binary
+        """
+        start = time.monotonic()
+        self._baseline_status = "building"
+        self._baseline_finished.clear()
         try:
-            with open(file_path, "rb") as binary:
-                for block in iter(lambda: binary.read(4096), b""):
-                    hash_file_sha256.update(block)
-            return hash_file_sha256.hexdigest()
+            binaries = get_all_binary_stat_keys(self._binary_paths)
+            cache = {} if full else self.load_hash_cache()
+            binaries_to_hash = [binary_path for binary_path, stat_key in binaries
+                                if binary_path not in cache or cache[binary_path][0] != stat_key]
+            self._baseline_progress = [0, len(binaries_to_hash)]
+            hashed = {}
+            for binary_path, hash_value in hash_binaries(binaries_to_hash, self._hash_workers):
+                hashed[binary_path] = hash_value
+                self._baseline_progress[0] += 1
+            new_cache = {}
+            with open (KNOWN_GOOD_HASHES_FILE + ".tmp", "w") as hash_file:
+                for binary_path, stat_key in binaries:
+                    hash_value = hashed[binary_path] if binary_path in hashed else cache[binary_path][1]
+                    if hash_value:
+                        hash_file.write("{}:{}\n".format(binary_path, hash_value))
+                        new_cache[binary_path] = (stat_key, hash_value)
+            os.replace(KNOWN_GOOD_HASHES_FILE + ".tmp", KNOWN_GOOD_HASHES_FILE)
+            self.save_hash_cache(new_cache)
+            self._baseline_summary = "{} of {} binaries hashed in {:.1f}s".format(
+                len(binaries_to_hash), len(binaries), time.monotonic() - start)
+            self._baseline_status = "ready"
+            self._baseline_ready.set()
         except Exception as err:
-                print("Error processing {} due to {}".format(binary, str(err)))
-                return None
+            self._baseline_status = "failed: {}".format(str(err) or type(err).__name__)
+        finally:
+            self._baseline_finished.set()
+
+    @staticmethod
+    def load_hash_cache() -> dict:
+        """
+        Reads the hash cache, one tab separated 'device inode size mtime_ns ctime_ns digest path' record per line
+
+        Returns:
+            dict: File path to (stat key, digest), empty if there is no cache
+        """
+        cache = {}
+        try:
+            with open(HASH_CACHE_FILE, "r") as cache_file:
+                for line in cache_file:
+                    try:
+                        *stat_key, hash_value, binary_path = line.rstrip("\n").split("\t", 6)
+                        cache[binary_path] = (tuple(int(value) for value in stat_key), hash_value)
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return cache
+
+    @staticmethod
+    def save_hash_cache(cache) -> None:
+        """
+        Atomically replaces the hash cache. Paths containing tabs or newlines are not cached and are always rehashed.
+
+        Args:
+            cache (dict): File path to (stat key, digest)
+        """
+        with open(HASH_CACHE_FILE + ".tmp", "w") as cache_file:
+            for binary_path, (stat_key, hash_value) in cache.items():
+                if "\t" in binary_path or "\n" in binary_path:
+                    continue
+                cache_file.write("\t".join(str(value) for value in stat_key) + "\t{}\t{}\n".format(
+                    hash_value, binary_path))
+        os.replace(HASH_CACHE_FILE + ".tmp", HASH_CACHE_FILE)
 
     def populate_send_files_folder(self) -> None:
         """
@@ -175,10 +416,84 @@ class CreateFileManager():
         if os.path.isdir("./downloaded_files"): return
         else: os.mkdir("downloaded_files")
 
+    @staticmethod
+    def load_transfer_journal(journal_path, client_ip, remote_path) -> int:
+        """
+        Reads the journal of an interrupted download to find where to resume from. The journal only
+        counts if it is for the same file on the same client and the partial file holds every byte it records.
+
+        Args:
+            journal_path (str): The journal beside the '.part' file
+            client_ip (str): The IP address of the client the file is downloaded from
+            remote_path (str): The path of the file on the client
+
+        Returns:
+            int: The number of bytes already saved, 0 to start from the beginning
+        """
+        try:
+            with open(journal_path, "r") as journal_file:
+                journal = json.load(journal_file)
+            if journal["client"] != client_ip or journal["path"] != remote_path:
+                return 0
+            received = int(journal["received"])
+            if os.path.getsize(journal_path[:-len(".journal")]) < received:
+                return 0
+            return received
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+
+    @staticmethod
+    def save_transfer_journal(journal_path, client_ip, remote_path, received) -> None:
+        """
+        Records how many bytes of a download have been flushed to the '.part' file. The journal is
+        replaced atomically so an interruption while writing it leaves the previous one intact.
+
+        Args:
+            journal_path (str): The journal beside the '.part' file
+            client_ip (str): The IP address of the client the file is downloaded from
+            remote_path (str): The path of the file on the client
+            received (int): The number of bytes saved
+        """
+        with open(journal_path + ".tmp", "w") as journal_file:
+            json.dump({"client":client_ip, "path":remote_path, "received":received}, journal_file)
+        os.replace(journal_path + ".tmp", journal_path)
+
     @staticmethod
     def disk_dumps_exists() -> None:
         """
         Creates a 'client_disk_dumps' folder if one does not exist
         """
         if os.path.isdir("./client_disk_dumps/"): return
-        else: os.mkdir("client_disk_dumps")
\ No newline at end of file
+        else: os.mkdir("client_disk_dumps")
+
+    @staticmethod
+    def integrity_reports_exists() -> None:
+        """
+        Creates a 'client_integrity_reports' folder if one does not exist
+        """
+        if os.path.isdir("./client_integrity_reports/"): return
+        else: os.mkdir("client_integrity_reports")
+
+    @staticmethod
+    def listings_exists() -> None:
+        """
+        Creates a 'client_listings' folder if one does not exist
+        """
+        if os.path.isdir("./client_listings/"): return
+        else: os.mkdir("client_listings")
+
+    @staticmethod
+    def search_results_exists() -> None:
+        """
+        Creates a 'client_search_results' folder if one does not exist
+        """
+        if os.path.isdir("./client_search_results/"): return
+        else: os.mkdir("client_search_results")
+
+    @staticmethod
+    def profiles_exists() -> None:
+        """
+        Creates a 'profiles' folder if one does not exist
+        """
+        if os.path.isdir("./profiles/"): return
+        else: os.mkdir("profiles")
\ No newline at end of file
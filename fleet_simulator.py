@@ -0,0 +1,399 @@
+"""
+Runs a fleet of simulated clients from one process to find how many connected clients the controller
+can handle. Each simulated client is a coroutine speaking the real protocol over TLS: it negotiates
+framing and compression, answers heartbeats and replies to sysinfo, disk, processes, processtable, listdir
+and telemetry subscriptions with synthetic /proc-like payloads. Clients connect at a set rate, can delay
+every reply and are disconnected and reconnected at random to simulate churn.
+
+Progress is printed every REPORT_INTERVAL seconds and a JSON summary at the end. With --serve a server
+is started in a child process on a free port, so its sessions, CPU time and memory are reported too.
+
+Usage:
+    python3 fleet_simulator.py --serve --clients 2000 --connect-rate 200 --duration 120
+    python3 fleet_simulator.py --host 192.168.50.98 --port 999 --clients 500 --latency 20 --churn 5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import ssl
+import sys
+import tempfile
+import time
+from collections import Counter
+from client import PROCESS_TABLE_COLUMNS, RECORD_BATCH_SIZE, TELEMETRY_FLUSH_INTERVAL
+from loopback_benchmark import parse_size, percentile, resource_usage
+from protocol import AsyncProtocolStream, ProtocolError, MSG_CHUNK, MSG_END, MSG_ERROR, NEGOTIATION_TIMEOUT
+
+REPORT_INTERVAL = 5
+PROCESS_NAMES = ("systemd", "sshd", "cron", "rsyslogd", "nginx", "postgres", "python3", "bash", "containerd", "kworker/0:1")
+
+def parse_args():
+    """
+    Parses the command line arguments.
+
+    Returns:
+        Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Simulate a fleet of clients against a server")
+    parser.add_argument("--host", default="127.0.0.1", help="The server to connect to")
+    parser.add_argument("--port", type=int, default=999, help="The server port")
+    parser.add_argument("--serve", action="store_true", help="Start a server on a free local port in a child process")
+    parser.add_argument("--clients", type=int, default=100, help="The number of simulated clients")
+    parser.add_argument("--connect-rate", type=float, default=50, help="New clients connected per second")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run for once every client has started")
+    parser.add_argument("--payload-size", default="16K", help="Approximate size of process and directory listings i.e. 16K 1M")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds each client waits before replying")
+    parser.add_argument("--jitter", type=float, default=0, help="Standard deviation of the reply delay in milliseconds")
+    parser.add_argument("--churn", type=float, default=0, help="Disconnects per second across the fleet, each reconnects")
+    parser.add_argument("--reconnect-delay", type=float, default=1.0, help="Seconds a client waits before reconnecting")
+    parser.add_argument("--output", help="Save the JSON summary to this file instead of printing it")
+    return parser.parse_args()
+
+def build_payloads(payload_size) -> dict:
+    """
+    Builds the synthetic replies once, every simulated client sends the same ones.
+
+    Args:
+        payload_size (int): The approximate size in bytes of the process and directory listings.
+
+    Returns:
+        dict: Command to reply, 'processtable' holds a list of batches and the number of rows.
+    """
+    boot_time = time.time() - 86400
+    process_lines, table_rows, names = [], [], []
+    size = pid = 0
+    while size < payload_size:
+        pid += 1
+        name = PROCESS_NAMES[pid % len(PROCESS_NAMES)]
+        process_lines.append("PID: {}, Name: {}".format(pid, name))
+        table_rows.append("{}\t{}\t{}\tS\t{:.2f}\t{:.2f}\t{}\t{}\n".format(
+            pid, max(0, pid - 1) % 50, name, random.random() * 100, random.random() * 10, random.randint(0, 500000),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(boot_time + pid))))
+        names.append("file_{:06d}.log".format(pid))
+        size += len(table_rows[-1])
+    batches, batch = [], ""
+    for row in table_rows:
+        batch += row
+        if len(batch) >= RECORD_BATCH_SIZE:
+            batches.append(batch)
+            batch = ""
+    if batch:
+        batches.append(batch)
+    return {'sysinfo':"sysinfo| \"Simulated Linux 1.0\"\n\"1.0\"\nModel Name: Simulated CPU\nMhz: 2000.000\nCores: 4\n"
+                      "MemTotal:        8000000 kB\nMemFree:         4000000 kB\nMemAvailable:    6000000 kB",
+            'disk':"diskinfo| Total disk: 100.00 GB\nUsed disk: 40.00 GB\nFree disk: 60.00 GB",
+            'processes':"processes|" + "\n".join(process_lines),
+            'processtable':(["\t".join(PROCESS_TABLE_COLUMNS) + "\n"] + batches, len(table_rows)),
+            'listdir':"dirlisting| " + "\n".join(names)}
+
+class FleetStats():
+    """
+    FleetStats holds the counters and samples shared by every simulated client.
+
+    Attributes:
+        connected (int): Clients connected and negotiated now.
+        peak_connected (int): The most clients connected at once.
+        counters (Counter): Connects, failures, disconnects and commands answered by name.
+        connect_times (list): Seconds from connecting to finishing negotiation, per connection.
+        heartbeat_gaps (list): Seconds between consecutive heartbeats received by a client.
+    """
+    def __init__(self):
+        self.connected = 0
+        self.peak_connected = 0
+        self.counters = Counter()
+        self.connect_times = []
+        self.heartbeat_gaps = []
+
+    def client_connected(self, seconds) -> None:
+        self.connected += 1
+        self.peak_connected = max(self.peak_connected, self.connected)
+        self.counters['connects'] += 1
+        self.connect_times.append(seconds)
+
+    def summary(self) -> dict:
+        """
+        Returns the counters and the p50 and p99 of the samples.
+        """
+        connect_times, heartbeat_gaps = sorted(self.connect_times), sorted(self.heartbeat_gaps)
+        summary = {'connected':self.connected, 'peak_connected':self.peak_connected, 'counters':dict(self.counters)}
+        if connect_times:
+            summary['connect_p50_ms'] = round(percentile(connect_times, 50) * 1000, 2)
+            summary['connect_p99_ms'] = round(percentile(connect_times, 99) * 1000, 2)
+        if heartbeat_gaps:
+            summary['heartbeat_gap_p50_s'] = round(percentile(heartbeat_gaps, 50), 3)
+            summary['heartbeat_gap_p99_s'] = round(percentile(heartbeat_gaps, 99), 3)
+        return summary
+
+class SimulatedClient():
+    """
+    SimulatedClient is one fake agent. It stays connected until the server closes the connection or its
+    random lifetime runs out, then reconnects after --reconnect-delay seconds.
+
+    Attributes:
+        _args (Namespace): The parsed arguments.
+        _payloads (dict): The replies built by build_payloads.
+        _stats (FleetStats): The shared statistics.
+        _tls_context (SSLContext): The client TLS context.
+        _telemetry (tuple): (task, request ID) of the current telemetry subscription, None if not subscribed.
+        _last_heartbeat (float): The monotonic time of the last heartbeat, None before the first.
+    """
+    def __init__(self, args, payloads, stats, tls_context):
+        self._args = args
+        self._payloads = payloads
+        self._stats = stats
+        self._tls_context = tls_context
+        self._telemetry = None
+        self._last_heartbeat = None
+
+    async def run(self) -> None:
+        """
+        Connects, serves and reconnects until cancelled.
+        """
+        while True:
+            lifetime = random.expovariate(self._args.churn / self._args.clients) if self._args.churn else None
+            await self.connect_and_serve(lifetime)
+            await asyncio.sleep(self._args.reconnect_delay)
+
+    async def connect_and_serve(self, lifetime) -> None:
+        """
+        Connects over TLS, negotiates the framed protocol and answers commands for lifetime seconds.
+
+        Args:
+            lifetime (float): Seconds to stay connected, None to stay until the server disconnects.
+        """
+        start = time.perf_counter()
+        connected = False
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(self._args.host, self._args.port, ssl=self._tls_context)
+            stream = AsyncProtocolStream(reader, writer)
+            offer = await asyncio.wait_for(stream.receive_message(), NEGOTIATION_TIMEOUT)
+            await stream.accept_protocol(offer.payload.decode())
+            self._stats.client_connected(time.perf_counter() - start)
+            connected = True
+            self._last_heartbeat = None
+            await asyncio.wait_for(self.serve(stream), lifetime)
+            self._stats.counters['server_disconnects'] += 1
+        except asyncio.TimeoutError:
+            self._stats.counters['churn_disconnects' if connected else 'connect_failures'] += 1
+        except (ConnectionError, OSError, ProtocolError, ValueError):
+            self._stats.counters['server_disconnects' if connected else 'connect_failures'] += 1
+        finally:
+            self.stop_telemetry()
+            if writer:
+                writer.close()
+            if connected:
+                self._stats.connected -= 1
+
+    async def serve(self, stream) -> None:
+        """
+        Answers commands until the server closes the connection or sends 'exit'.
+        """
+        while True:
+            try:
+                message = await stream.receive_message()
+            except ConnectionError:
+                return
+            command = message.payload.decode(errors="replace")
+            if command == "exit":
+                return
+            if command.startswith("compression|"):
+                stream.accept_compression(command)
+                continue
+            if self._args.latency or self._args.jitter:
+                await asyncio.sleep(max(0, random.gauss(self._args.latency, self._args.jitter)) / 1000)
+            await self.answer(stream, message.request_id, command)
+
+    async def answer(self, stream, request_id, command) -> None:
+        """
+        Sends the synthetic reply to a command. Commands the simulator does not support are answered with
+        MSG_ERROR so the server does not wait for them.
+
+        Args:
+            stream (AsyncProtocolStream): The connection.
+            request_id (int): The request ID of the command.
+            command (str): The decoded command.
+        """
+        name = command.split("|", 1)[0]
+        self._stats.counters["command:" + name] += 1
+        if name == "hello":
+            now = time.monotonic()
+            if self._last_heartbeat is not None:
+                self._stats.heartbeat_gaps.append(now - self._last_heartbeat)
+            self._last_heartbeat = now
+            await stream.send_message("hello", request_id=request_id)
+        elif name in ("sysinfo", "disk", "processes", "listdir"):
+            await stream.send_message(self._payloads[name], request_id=request_id)
+        elif name == "processtable":
+            batches, count = self._payloads['processtable']
+            for batch in batches:
+                await stream.send_message(batch, msg_type=MSG_CHUNK, request_id=request_id)
+            await stream.send_message(str(count), msg_type=MSG_END, request_id=request_id)
+        elif name == "subscribe":
+            self.stop_telemetry()
+            task = asyncio.get_running_loop().create_task(
+                self.publish_telemetry(stream, request_id, max(1.0, float(command.split("|")[1]))))
+            self._telemetry = (task, request_id)
+        elif name == "unsubscribe":
+            if self._telemetry:
+                subscription_id = self._telemetry[1]
+                self.stop_telemetry()
+                await stream.send_message(b"", msg_type=MSG_END, request_id=subscription_id)
+        else:
+            await stream.send_message("{} is not supported by the simulated client".format(name),
+                                      msg_type=MSG_ERROR, request_id=request_id)
+
+    async def publish_telemetry(self, stream, request_id, interval) -> None:
+        """
+        Pushes random telemetry samples in batches like Client.publish_telemetry.
+        """
+        samples_per_batch = max(1, int(TELEMETRY_FLUSH_INTERVAL // interval))
+        batch = []
+        sent_first = False
+        while True:
+            batch.append("{:.3f}\t{:.1f}\t{:.1f}\t{:.1f}\t{:.2f}\n".format(
+                time.time(), random.uniform(0, 100), random.uniform(20, 80), 40.0, random.uniform(0, 4)))
+            if len(batch) >= samples_per_batch or not sent_first:
+                await stream.send_message("".join(batch), msg_type=MSG_CHUNK, request_id=request_id)
+                batch = []
+                sent_first = True
+            await asyncio.sleep(interval)
+
+    def stop_telemetry(self) -> None:
+        if self._telemetry:
+            self._telemetry[0].cancel()
+            self._telemetry = None
+
+def serve(pipe):
+    """
+    The child process started by --serve. Runs a non-interactive server on a free port in a temporary
+    folder and answers ('stats',) with its sessions, CPU time and peak RSS until sent ('exit',).
+
+    Args:
+        pipe (Connection): Sends the port once serving, then answers requests.
+    """
+    from create_server import CreateServer
+    from file_manager import CreateFileManager
+    from log_controller import CreateLogger
+    from server_controller import CreateController
+    folder = tempfile.mkdtemp(prefix="fleet_simulator_")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        os.chdir(folder)
+        with open("authorised_ips.txt", "w") as authorised_ips:
+            authorised_ips.write("127.0.0.1\n")
+        server_logger = CreateLogger("server")
+        file_manager = CreateFileManager()
+        controller = CreateController(server_logger, CreateLogger("auth"), file_manager)
+        server = CreateServer("127.0.0.1", server_logger, controller, port=0, interactive=False)
+        file_manager.wait_for_known_good_hashes()
+        pipe.send(server.server_port)
+        while pipe.recv()[0] == "stats":
+            cpu, rss = resource_usage()
+            pipe.send({'sessions':len(controller._sessions), 'cpu_seconds':round(cpu, 2), 'peak_rss_mb':round(rss, 1)})
+    os.chdir("/")
+    shutil.rmtree(folder, ignore_errors=True)
+
+def raise_open_file_limit() -> int:
+    """
+    Raises the soft limit on open files to the hard limit, each client needs a socket.
+
+    Returns:
+        int: The new limit.
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+async def simulate(args, server_pipe) -> dict:
+    """
+    Starts the clients at --connect-rate, reports progress every REPORT_INTERVAL seconds and stops
+    --duration seconds after the last client has started.
+
+    Args:
+        args (Namespace): The parsed arguments.
+        server_pipe (Connection): The pipe to the --serve child process, None for an external server.
+
+    Returns:
+        dict: The summary.
+    """
+    loop = asyncio.get_running_loop()
+    tls_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    tls_context.check_hostname = False
+    tls_context.verify_mode = ssl.CERT_NONE
+    stats = FleetStats()
+    payloads = build_payloads(parse_size(args.payload_size))
+    tasks = []
+    start = time.monotonic()
+
+    async def server_stats():
+        if server_pipe is None:
+            return None
+        def request():
+            server_pipe.send(("stats",))
+            return server_pipe.recv()
+        return await loop.run_in_executor(None, request)
+
+    async def report():
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            server = await server_stats()
+            print("{:7.1f}s started {:>6} connected {:>6} peak {:>6} failures {:>5} disconnects {:>5}{}".format(
+                time.monotonic() - start, len(tasks), stats.connected, stats.peak_connected,
+                stats.counters['connect_failures'], stats.counters['server_disconnects'],
+                "  server sessions {sessions} cpu {cpu_seconds}s rss {peak_rss_mb}MB".format(**server) if server else ""),
+                file=sys.stderr)
+
+    reporter = loop.create_task(report())
+    try:
+        for _ in range(args.clients):
+            tasks.append(loop.create_task(SimulatedClient(args, payloads, stats, tls_context).run()))
+            await asyncio.sleep(1 / args.connect_rate)
+        await asyncio.sleep(args.duration)
+        summary = stats.summary()
+        summary['server'] = await server_stats()
+    finally:
+        reporter.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    cpu, rss = resource_usage()
+    summary.update({'clients':args.clients, 'connect_rate':args.connect_rate, 'duration':args.duration,
+                    'payload_size':args.payload_size, 'latency_ms':args.latency, 'churn':args.churn,
+                    'simulator_cpu_seconds':round(cpu, 2), 'simulator_peak_rss_mb':round(rss, 1)})
+    return summary
+
+def main():
+    """
+    Runs the simulation and prints or saves the JSON summary.
+    """
+    args = parse_args()
+    limit = raise_open_file_limit()
+    if args.clients + 64 > limit:
+        print("warning: {} clients may exceed the open file limit of {}".format(args.clients, limit), file=sys.stderr)
+    server_pipe = server_process = None
+    if args.serve:
+        server_pipe, child_pipe = multiprocessing.Pipe()
+        server_process = multiprocessing.get_context("spawn").Process(target=serve, args=(child_pipe,), daemon=True)
+        server_process.start()
+        args.host, args.port = "127.0.0.1", server_pipe.recv()
+    try:
+        summary = asyncio.run(simulate(args, server_pipe))
+    finally:
+        if server_process:
+            server_pipe.send(("exit",))
+            server_process.join(5)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(summary, output_file, indent=2)
+    else:
+        print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    main()
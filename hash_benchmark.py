@@ -0,0 +1,104 @@
+"""
+Compares the original serial baseline hashing (one thread, a read(4096) loop) with the threaded engine
+shared by CreateFileManager.generate_known_good_hashes and the client integrity scan.
+
+Usage:
+    python3 hash_benchmark.py --paths /usr/bin /usr/sbin --workers 2 4 8
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from binary_hashing import get_all_binary_full_paths, hash_binaries, HASH_READ_SIZE
+
+BASELINE_BLOCK_SIZE = 4096
+
+def parse_args():
+    """
+    Parses the command line arguments.
+
+    Returns:
+        Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark known good hash generation")
+    parser.add_argument("--paths", nargs="+", default=["/usr/bin"], help="Directories of binaries to hash")
+    parser.add_argument("--workers", nargs="+", type=int, default=[os.cpu_count() or 1],
+                        help="Worker counts to benchmark the threaded engine with")
+    parser.add_argument("--no-warmup", action="store_true",
+                        help="Skip the untimed pass that loads the files into the page cache")
+    return parser.parse_args()
+
+def baseline_sha256_of_binary(file_path) -> str:
+    """
+    The original hashing of CreateFileManager.calculate_sha256_of_binary, a new 4 KB bytes object per read.
+
+    Args:
+        file_path (str): The file path of the file to hash
+
+    Returns:
+        str: Hex digest of hashed file
+    """
+    hash_file_sha256 = hashlib.sha256()
+    try:
+        with open(file_path, "rb") as binary:
+            for block in iter(lambda: binary.read(BASELINE_BLOCK_SIZE), b""):
+                hash_file_sha256.update(block)
+        return hash_file_sha256.hexdigest()
+    except Exception as err:
+            print("Error processing {} due to {}".format(file_path, str(err)))
+            return None
+
+def run_baseline(binary_paths) -> tuple:
+    """
+    Hashes every file once with the original serial loop.
+
+    Args:
+        binary_paths (list): The files to hash.
+
+    Returns:
+        tuple: (elapsed seconds, list of (path, digest))
+    """
+    start = time.perf_counter()
+    results = [(binary_path, baseline_sha256_of_binary(binary_path)) for binary_path in binary_paths]
+    return time.perf_counter() - start, results
+
+def run(binary_paths, workers, block_size) -> tuple:
+    """
+    Hashes every file once with the threaded engine.
+
+    Args:
+        binary_paths (list): The files to hash.
+        workers (int): The number of hashing threads.
+        block_size (int): The number of bytes read per block.
+
+    Returns:
+        tuple: (elapsed seconds, list of (path, digest))
+    """
+    start = time.perf_counter()
+    results = list(hash_binaries(binary_paths, workers, block_size))
+    return time.perf_counter() - start, results
+
+def main():
+    """
+    Runs the serial baseline and the threaded engine and prints the throughput of each.
+    """
+    args = parse_args()
+    binary_paths = get_all_binary_full_paths(args.paths)
+    total_bytes = sum(os.path.getsize(path) for path in binary_paths)
+    print("{} files, {:.1f} MB".format(len(binary_paths), total_bytes / 1024**2))
+    if not args.no_warmup:
+        run(binary_paths, os.cpu_count() or 1, HASH_READ_SIZE)
+
+    serial_time, serial_results = run_baseline(binary_paths)
+    print("baseline 4 KB read()     : {:7.2f}s {:8.1f} MB/s".format(
+        serial_time, total_bytes / 1024**2 / serial_time))
+    for workers in args.workers:
+        elapsed, results = run(binary_paths, workers, HASH_READ_SIZE)
+        if results != serial_results:
+            print("warning: results with {} workers differ from the serial baseline".format(workers))
+        print("threaded {:3d} workers 1 MB : {:7.2f}s {:8.1f} MB/s  x{:.2f}".format(
+            workers, elapsed, total_bytes / 1024**2 / elapsed, serial_time / elapsed))
+
+if __name__ == '__main__':
+    main()
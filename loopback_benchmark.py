@@ -0,0 +1,359 @@
+"""
+Benchmarks the controller commands end to end over TLS on 127.0.0.1. A real server is started with
+CreateServer and CreateController in a temporary folder with freshly generated certificates, and real
+Client instances run in a child process so the CPU time and memory of each side are measured separately.
+
+Each command is run by one thread per client, every thread driving its own client, and the results
+are printed, or saved with --output, as JSON.
+
+Usage:
+    python3 loopback_benchmark.py --clients 1 8 --sizes 64K 16M --entries 1000 100000 --iterations 20
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from client import Client
+from create_server import CreateServer
+from file_manager import CreateFileManager
+from log_controller import CreateLogger
+from server_controller import CreateController
+
+COMMANDS = ("heartbeat", "sysinfo", "disk", "processes", "listdir", "tree", "put", "get")
+SIZED_COMMANDS = ("put", "get")
+LISTING_COMMANDS = ("listdir", "tree")
+SIZE_UNITS = {'K':1024, 'M':1024**2, 'G':1024**3}
+CONNECT_TIMEOUT = 30
+
+def parse_args():
+    """
+    Parses the command line arguments.
+
+    Returns:
+        Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark controller commands over loopback TLS")
+    parser.add_argument("--clients", nargs="+", type=int, default=[1], help="Numbers of connected clients to run each command with")
+    parser.add_argument("--commands", nargs="+", choices=COMMANDS, default=list(COMMANDS), help="Commands to benchmark")
+    parser.add_argument("--sizes", nargs="+", default=["64K", "4M"], help="File sizes for put and get i.e. 64K 16M 1G")
+    parser.add_argument("--entries", nargs="+", type=int, default=[1000], help="Directory sizes for listdir and tree")
+    parser.add_argument("--iterations", type=int, default=20, help="Times each client runs each command")
+    parser.add_argument("--output", help="Save the JSON results to this file instead of printing them")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary server folder")
+    return parser.parse_args()
+
+def parse_size(size) -> int:
+    """
+    Converts a size such as 64K or 16M to bytes.
+    """
+    unit = SIZE_UNITS.get(size[-1:].upper(), 1)
+    return int(float(size[:-1] if unit > 1 else size) * unit)
+
+def resource_usage() -> tuple:
+    """
+    Returns the CPU seconds used by this process and its peak resident set size in MB.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+def percentile(sorted_values, percent) -> float:
+    """
+    Returns the nearest rank percentile of a sorted list.
+    """
+    return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(percent / 100 * len(sorted_values)) - 1))]
+
+def run_clients(port, pipe):
+    """
+    The child process hosting the clients. It connects clients when asked and reports its resource use,
+    so the client side is measured apart from the server.
+
+    Args:
+        port (int): The port of the server.
+        pipe (Connection): Receives ('connect', count), ('usage',) and ('exit',) and answers each.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        clients = []
+        while True:
+            command = pipe.recv()
+            if command[0] == "connect":
+                while len(clients) < command[1]:
+                    client = Client()
+                    client._server_ip, client._server_port = "127.0.0.1", port
+                    client.create_client_socket()
+                    client.wrap_socket_tls()
+                    client.connect_to_server()
+                    threading.Thread(target=client.ready_to_receive, daemon=True).start()
+                    clients.append(client)
+                pipe.send(len(clients))
+            elif command[0] == "usage":
+                pipe.send(resource_usage())
+            else:
+                return
+
+class LoopbackBenchmark():
+    """
+    LoopbackBenchmark runs a server and a client process on 127.0.0.1 and times controller commands.
+
+    Attributes:
+        _args (Namespace): The parsed arguments.
+        _folder (str): The temporary folder the server runs in.
+        _controller (CreateController): The controller of the server.
+        _server (CreateServer): The server.
+        _pipe (Connection): The pipe to the client process.
+        _client_process (Process): The client process.
+    """
+    def __init__(self, args):
+        """
+        Args:
+            args (Namespace): The parsed arguments.
+        """
+        self._args = args
+        self._folder = None
+        self._controller = None
+        self._server = None
+        self._pipe = None
+        self._client_process = None
+
+    def start(self) -> None:
+        """
+        Starts the server in a temporary folder, waits for its known good hashes so hashing does not run
+        during the benchmark, and starts the client process.
+        """
+        self._folder = tempfile.mkdtemp(prefix="loopback_benchmark_")
+        os.chdir(self._folder)
+        with open("authorised_ips.txt", "w") as authorised_ips:
+            authorised_ips.write("127.0.0.1\n")
+        server_logger = CreateLogger("server")
+        file_manager = CreateFileManager()
+        self._controller = CreateController(server_logger, CreateLogger("auth"), file_manager)
+        self._server = CreateServer("127.0.0.1", server_logger, self._controller, port=0, interactive=False)
+        file_manager.wait_for_known_good_hashes()
+        self._pipe, child_pipe = multiprocessing.Pipe()
+        self._client_process = multiprocessing.get_context("spawn").Process(
+            target=run_clients, args=(self._server.server_port, child_pipe), daemon=True)
+        self._client_process.start()
+
+    def stop(self) -> None:
+        """
+        Stops the client process and removes the temporary folder unless --keep was given.
+        """
+        if self._client_process:
+            self._pipe.send(("exit",))
+            self._client_process.join(5)
+        os.chdir("/")
+        if self._folder and not self._args.keep:
+            shutil.rmtree(self._folder, ignore_errors=True)
+
+    def connect(self, count) -> list:
+        """
+        Connects clients until count are connected and have negotiated the framed protocol.
+
+        Returns:
+            list: The session IDs of the clients.
+        """
+        self._pipe.send(("connect", count))
+        self._pipe.recv()
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while time.monotonic() < deadline:
+            sessions = self._controller._sessions.snapshot()
+            if len(sessions) >= count and all(session.stream.framed for session in sessions):
+                return [session.session_id for session in sessions[:count]]
+            time.sleep(0.05)
+        raise TimeoutError("{} clients did not connect within {}s".format(count, CONNECT_TIMEOUT))
+
+    def client_usage(self) -> tuple:
+        """
+        Returns the CPU seconds and peak RSS in MB of the client process.
+        """
+        self._pipe.send(("usage",))
+        return self._pipe.recv()
+
+    def cases(self):
+        """
+        Yields the command, payload label, operation and bytes moved per operation of each case. Payload
+        files and directories are created before the case is yielded.
+
+        Yields:
+            tuple: (command, payload, function taking a session ID and client index, bytes per operation)
+        """
+        controller = self._controller
+        for command in self._args.commands:
+            if command == "heartbeat":
+                yield command, "", lambda client_id, index: controller.run_in_loop(
+                    controller.ping_client(controller.get_session(client_id))), 0
+            elif command == "sysinfo":
+                yield command, "", lambda client_id, index: controller.get_client_sysinfo(client_id), 0
+            elif command == "disk":
+                yield command, "", lambda client_id, index: controller.get_client_disk_info(client_id), 0
+            elif command == "processes":
+                yield command, "", lambda client_id, index: controller.get_client_processes(client_id), 0
+            elif command in LISTING_COMMANDS:
+                for entries in self._args.entries:
+                    directory = self.create_directory(entries)
+                    if command == "listdir":
+                        yield command, "{} entries".format(entries), \
+                            lambda client_id, index, directory=directory: controller.get_dir_listing(client_id, directory), 0
+                    else:
+                        yield command, "{} entries".format(entries), \
+                            lambda client_id, index, directory=directory: controller.get_tree_listing(client_id, directory), 0
+            else:
+                for size in self._args.sizes:
+                    file_size = parse_size(size)
+                    if command == "put":
+                        yield command, size, lambda client_id, index, size=size: controller.stream_file_to_client(
+                            client_id, self.create_payload(size, index)), file_size
+                    else:
+                        yield command, size, lambda client_id, index, size=size: self.get_file(client_id, size, index), file_size
+
+    def create_payload(self, size, index) -> str:
+        """
+        Creates a file of random bytes in the 'tool_box' folder for a client, once per size and client.
+
+        Returns:
+            str: The filename of the payload in the 'tool_box' folder.
+        """
+        filename = "benchmark_{}_{}.bin".format(size, index)
+        if not os.path.exists(os.path.join("tool_box", filename)):
+            with open(os.path.join("tool_box", filename), "wb") as payload:
+                remaining = parse_size(size)
+                while remaining:
+                    block = os.urandom(min(remaining, 1024**2))
+                    payload.write(block)
+                    remaining -= len(block)
+        return filename
+
+    def get_file(self, client_id, size, index) -> None:
+        """
+        Downloads a payload from a client and deletes the download so the next one is not resumed.
+        """
+        filename = self.create_payload(size, index)
+        save_path = os.path.join("downloaded_files", filename)
+        self._controller.stream_file_from_client(client_id, os.path.join(self._folder, "tool_box", filename), save_path)
+        os.remove(save_path)
+
+    def create_directory(self, entries) -> str:
+        """
+        Creates a directory of empty files for the listing commands, once per size.
+
+        Returns:
+            str: The full path of the directory.
+        """
+        directory = os.path.join(self._folder, "benchmark_listing_{}".format(entries))
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+            for number in range(entries):
+                open(os.path.join(directory, "file_{}".format(number)), "w").close()
+        return directory
+
+    def run_case(self, operation, client_ids) -> dict:
+        """
+        Runs an operation --iterations times on each client, every client from its own thread, after one
+        untimed run per client to create payloads and warm caches.
+
+        Args:
+            operation (function): Takes a session ID and a client index.
+            client_ids (list): The session IDs of the clients.
+
+        Returns:
+            dict: The latencies in seconds, the wall time, the number of errors and the resource use of each side.
+        """
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        start_barrier = threading.Barrier(len(client_ids) + 1)
+
+        def drive(client_id, index):
+            try:
+                operation(client_id, index)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            start_barrier.wait()
+            timings = []
+            for _ in range(self._args.iterations):
+                start = time.perf_counter()
+                try:
+                    operation(client_id, index)
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+                timings.append(time.perf_counter() - start)
+            with lock:
+                latencies.extend(timings)
+
+        threads = [threading.Thread(target=drive, args=(client_id, index), daemon=True)
+                   for index, client_id in enumerate(client_ids)]
+        for thread in threads:
+            thread.start()
+        start_barrier.wait()
+        server_before, client_before = resource_usage(), self.client_usage()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        server_after, client_after = resource_usage(), self.client_usage()
+        return {'latencies':sorted(latencies), 'elapsed':elapsed, 'errors':errors[0],
+                'server_cpu':server_after[0] - server_before[0], 'client_cpu':client_after[0] - client_before[0],
+                'server_rss':server_after[1], 'client_rss':client_after[1]}
+
+    def run(self) -> list:
+        """
+        Runs every case with each number of clients.
+
+        Returns:
+            list: A result dict per case.
+        """
+        results = []
+        for clients in sorted(set(self._args.clients)):
+            client_ids = self.connect(clients)
+            for command, payload, operation, payload_bytes in self.cases():
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    measured = self.run_case(operation, client_ids)
+                operations = len(measured['latencies'])
+                result = {'command':command, 'payload':payload, 'clients':clients, 'operations':operations,
+                          'errors':measured['errors'], 'seconds':round(measured['elapsed'], 4),
+                          'operations_per_second':round(operations / measured['elapsed'], 2),
+                          'p50_ms':round(percentile(measured['latencies'], 50) * 1000, 3),
+                          'p99_ms':round(percentile(measured['latencies'], 99) * 1000, 3),
+                          'server_cpu_seconds':round(measured['server_cpu'], 3),
+                          'client_cpu_seconds':round(measured['client_cpu'], 3),
+                          'server_peak_rss_mb':round(measured['server_rss'], 1),
+                          'client_peak_rss_mb':round(measured['client_rss'], 1)}
+                if payload_bytes:
+                    result['mb_per_second'] = round(operations * payload_bytes / 1024**2 / measured['elapsed'], 2)
+                print("{command:<10} {payload:<14} {clients:>3} clients  p50 {p50_ms:9.3f}ms  p99 {p99_ms:9.3f}ms  "
+                      "{operations_per_second:9.2f} ops/s".format(**result), file=sys.stderr)
+                results.append(result)
+        return results
+
+def main():
+    """
+    Runs the benchmark and prints or saves the JSON results.
+    """
+    args = parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    benchmark = LoopbackBenchmark(args)
+    try:
+        benchmark.start()
+        report = {'python':platform.python_version(), 'platform':platform.platform(), 'cpus':os.cpu_count(),
+                  'iterations':args.iterations, 'results':benchmark.run()}
+    finally:
+        benchmark.stop()
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Append-only time-series store for numeric client metrics.
+
+Each client has a folder under client_metrics and each metric two column files in it: <metric>.time
+holds the sample times and <metric>.value the sample values, both as native float64 arrays. Samples
+are only ever appended in time order, so the time column is its own index. A range query binary
+searches it through a memory map and aggregates the matching slice of the value column without
+parsing anything, so a query costs O(log n) plus the samples in range.
+"""
+
+import bisect
+import mmap
+import os
+import threading
+from array import array
+from collections import namedtuple
+
+METRICS_FOLDER = "client_metrics"
+SAMPLE_SIZE = array("d").itemsize
+
+#Lines of the sysinfo and disk dumps to record, by prefix. The first number on the line is the value.
+DUMP_METRICS = {'sysinfo':(('mem_total_kb', 'MemTotal:'),
+                           ('mem_free_kb', 'MemFree:'),
+                           ('mem_available_kb', 'MemAvailable:')),
+                'disk':(('disk_total_gb', 'Total disk:'),
+                        ('disk_used_gb', 'Used disk:'),
+                        ('disk_free_gb', 'Free disk:'))}
+
+Bucket = namedtuple("Bucket", ["start", "count", "minimum", "mean", "maximum"])
+
+def parse_dump_metrics(action_type, data) -> dict:
+    """
+    Extracts the numeric metrics from a sysinfo or disk dump.
+
+    Args:
+        action_type (str): 'sysinfo' or 'disk', other dumps have no metrics.
+        data (str): The dump text.
+
+    Returns:
+        dict: Metric name to value.
+    """
+    metrics = {}
+    for line in data.splitlines():
+        line = line.strip()
+        for metric, prefix in DUMP_METRICS.get(action_type, ()):
+            if line.startswith(prefix):
+                try:
+                    metrics[metric] = float(line[len(prefix):].split()[0])
+                except (IndexError, ValueError):
+                    pass
+    return metrics
+
+class MetricStore():
+    """
+    MetricStore appends samples to, and queries, the per client, per metric column files. It is safe to
+    use from the menu thread and the event loop at the same time.
+
+    Attributes:
+        _root (str): The folder holding a folder per client.
+        _lock (Lock): Serialises appends.
+        _last_times (dict): (client, metric) to the time of the newest stored sample.
+    """
+    def __init__(self, root=METRICS_FOLDER):
+        """
+        Args:
+            root (str): The folder to keep the metrics in, created if it does not exist.
+        """
+        self._root = root
+        self._lock = threading.Lock()
+        self._last_times = {}
+        os.makedirs(root, exist_ok=True)
+
+    def metric_path(self, client, metric) -> str:
+        """
+        Returns the path of a metric's column files without the '.time' or '.value' extension.
+        """
+        return os.path.join(self._root, client, metric)
+
+    def append(self, client, metric, samples) -> int:
+        """
+        Appends samples to a metric. Samples older than the newest stored sample are dropped so the
+        time column stays sorted.
+
+        Args:
+            client (str): The IP address of the client.
+            metric (str): The metric name, i.e. 'cpu'.
+            samples (iterable): (time, value) pairs in time order.
+
+        Returns:
+            int: The number of samples stored.
+        """
+        with self._lock:
+            last_time = self.get_last_time(client, metric)
+            times, values = array("d"), array("d")
+            for sample_time, value in samples:
+                if sample_time >= last_time:
+                    times.append(sample_time)
+                    values.append(value)
+                    last_time = sample_time
+            if not times:
+                return 0
+            path = self.metric_path(client, metric)
+            with open(path + ".value", "ab") as value_file:
+                values.tofile(value_file)
+            with open(path + ".time", "ab") as time_file:
+                times.tofile(time_file)
+            self._last_times[(client, metric)] = last_time
+            return len(times)
+
+    def append_metrics(self, client, sample_time, metrics) -> None:
+        """
+        Appends one sample to each of several metrics.
+
+        Args:
+            client (str): The IP address of the client.
+            sample_time (float): The Unix time of the sample.
+            metrics (dict): Metric name to value.
+        """
+        for metric, value in metrics.items():
+            self.append(client, metric, ((sample_time, value),))
+
+    def get_last_time(self, client, metric) -> float:
+        """
+        Returns the time of the newest stored sample of a metric. The first call for a metric repairs
+        the column files if an append was interrupted between writing the values and the times.
+        """
+        last_time = self._last_times.get((client, metric))
+        if last_time is not None:
+            return last_time
+        path = self.metric_path(client, metric)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            count = min(os.path.getsize(path + ".time"), os.path.getsize(path + ".value")) // SAMPLE_SIZE
+        except FileNotFoundError:
+            count = 0
+        last_time = float("-inf")
+        for extension in (".time", ".value"):
+            if os.path.exists(path + extension):
+                with open(path + extension, "r+b") as column:
+                    column.truncate(count * SAMPLE_SIZE)
+        if count:
+            with open(path + ".time", "rb") as time_file:
+                time_file.seek((count - 1) * SAMPLE_SIZE)
+                last_time = array("d", time_file.read(SAMPLE_SIZE))[0]
+        self._last_times[(client, metric)] = last_time
+        return last_time
+
+    def query(self, client, metric, start, end, buckets=None) -> list:
+        """
+        Returns the samples of a metric between two times, or summaries of them in equal width buckets.
+
+        Args:
+            client (str): The IP address of the client.
+            metric (str): The metric name.
+            start (float): The Unix time to start from, inclusive.
+            end (float): The Unix time to end at, exclusive.
+            buckets (int): The number of buckets to downsample to, None returns every sample.
+
+        Returns:
+            list: (time, value) pairs, or a Bucket per bucket that holds samples.
+        """
+        path = self.metric_path(client, metric)
+        try:
+            time_file, value_file = open(path + ".time", "rb"), open(path + ".value", "rb")
+        except FileNotFoundError:
+            return []
+        with time_file, value_file:
+            count = min(os.fstat(time_file.fileno()).st_size, os.fstat(value_file.fileno()).st_size) // SAMPLE_SIZE
+            if not count:
+                return []
+            with mmap.mmap(time_file.fileno(), count * SAMPLE_SIZE, access=mmap.ACCESS_READ) as time_map, \
+                    mmap.mmap(value_file.fileno(), count * SAMPLE_SIZE, access=mmap.ACCESS_READ) as value_map:
+                times, values = memoryview(time_map).cast("d"), memoryview(value_map).cast("d")
+                try:
+                    first, last = bisect.bisect_left(times, start), bisect.bisect_left(times, end)
+                    if not buckets:
+                        return list(zip(times[first:last].tolist(), values[first:last].tolist()))
+                    return self.downsample(times, values, first, last, start, end, buckets)
+                finally:
+                    times.release()
+                    values.release()
+
+    @staticmethod
+    def downsample(times, values, first, last, start, end, buckets) -> list:
+        """
+        Summarises the samples between two indexes in buckets of equal time width. Bucket boundaries are
+        found by binary search, so only the samples in range are visited.
+
+        Args:
+            times (memoryview): The time column.
+            values (memoryview): The value column.
+            first (int): The index of the first sample in range.
+            last (int): The index after the last sample in range.
+            start (float): The start of the first bucket.
+            end (float): The end of the last bucket.
+            buckets (int): The number of buckets.
+
+        Returns:
+            list: A Bucket for each bucket that holds samples.
+        """
+        width = (end - start) / buckets
+        summaries = []
+        lower = first
+        for bucket in range(buckets):
+            bucket_end = start + (bucket + 1) * width
+            upper = last if bucket == buckets - 1 else bisect.bisect_left(times, bucket_end, lower, last)
+            if upper > lower:
+                bucket_values = values[lower:upper]
+                summaries.append(Bucket(start + bucket * width, upper - lower, min(bucket_values),
+                                        sum(bucket_values) / (upper - lower), max(bucket_values)))
+            lower = upper
+        return summaries
+
+    def clients(self) -> list:
+        """
+        Returns the clients that have stored metrics.
+        """
+        return sorted(entry.name for entry in os.scandir(self._root) if entry.is_dir())
+
+    def metrics(self, client) -> list:
+        """
+        Returns the metrics stored for a client.
+        """
+        try:
+            return sorted(entry.name[:-len(".time")] for entry in os.scandir(os.path.join(self._root, client))
+                          if entry.name.endswith(".time"))
+        except FileNotFoundError:
+            return []
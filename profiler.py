@@ -0,0 +1,130 @@
+"""
+On demand profiles of a running server or client.
+
+A ProfileCapture records cProfile stats of the thread it is started on, and tracemalloc allocations of
+the whole process, until it is stopped, then renders them as a text report. It is started and stopped on
+the thread to profile: the server's event loop thread, which owns every client connection, or the
+client's command thread. From Python 3.12 cProfile records every thread of the process. tracemalloc
+slows allocation down while it traces, so captures are bounded by PROFILE_MAX_SECONDS.
+"""
+
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+PROFILES_FOLDER = "profiles"
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 25
+#Seconds past its deadline a client stops a profile on its own, in case the server never asks for the report
+PROFILE_STOP_GRACE = 60
+
+#Captures running in this process share tracemalloc, the last one to stop stops it if a capture started it
+_tracing_lock = threading.Lock()
+_tracing = {'captures':0, 'started':False}
+
+class ProfileCapture():
+    """
+    ProfileCapture is one time bounded profile.
+
+    Attributes:
+        seconds (float): How long the capture should run.
+        started (float): The wall clock time the capture started, None until started.
+        elapsed (float): The seconds the capture ran, None until stopped.
+        _monotonic_start (float): The monotonic time the capture started, used for elapsed.
+        _profile (Profile): The cProfile profiler.
+        _allocations (list): The top tracemalloc statistics by line, taken when stopped.
+        _traced (tuple): (current, peak) bytes traced by tracemalloc, taken when stopped.
+    """
+    def __init__(self, seconds=PROFILE_DEFAULT_SECONDS):
+        """
+        Args:
+            seconds (float): How long the capture should run, limited to PROFILE_MAX_SECONDS.
+        """
+        self.seconds = min(seconds, PROFILE_MAX_SECONDS)
+        self.started = None
+        self.elapsed = None
+        self._monotonic_start = None
+        self._profile = cProfile.Profile()
+        self._allocations = []
+        self._traced = (0, 0)
+
+    @property
+    def deadline(self) -> float:
+        """
+        Returns the wall clock time the capture should be stopped at.
+        """
+        return self.started + self.seconds
+
+    def start(self) -> None:
+        """
+        Starts profiling the calling thread and tracing allocations. Allocations already being traced by
+        something other than a capture are left tracing when the capture stops.
+
+        Raises:
+            ValueError: If another profiler is already active, only raised from Python 3.12.
+        """
+        self._profile.enable()
+        with _tracing_lock:
+            if not _tracing['captures'] and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing['started'] = True
+            _tracing['captures'] += 1
+            tracemalloc.reset_peak()
+        self.started = time.time()
+        self._monotonic_start = time.monotonic()
+
+    def stop(self) -> None:
+        """
+        Stops profiling, it must be called on the thread that started the capture. The allocations still
+        held that were made during the capture are kept, the modules of the profiler itself are left out.
+        """
+        self._profile.disable()
+        self.elapsed = time.monotonic() - self._monotonic_start
+        with _tracing_lock:
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__)))
+                self._allocations = snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]
+                self._traced = tracemalloc.get_traced_memory()
+            _tracing['captures'] -= 1
+            if not _tracing['captures'] and _tracing['started']:
+                tracemalloc.stop()
+                _tracing['started'] = False
+
+    def report(self, title) -> str:
+        """
+        Renders the stopped capture as text: the functions with the most cumulative time, the functions
+        with the most time of their own, and the lines holding the most memory allocated during the capture.
+
+        Args:
+            title (str): What was profiled, i.e. 'server event loop'.
+
+        Returns:
+            str: The report.
+        """
+        output = io.StringIO()
+        output.write("Profile of {} (pid {}, Python {})\nStarted {}, ran {:.1f}s\n".format(
+            title, os.getpid(), sys.version.split()[0],
+            datetime.datetime.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S"), self.elapsed))
+        stats = pstats.Stats(self._profile, stream=output)
+        if stats.total_calls:
+            for order, description in (("cumulative", "cumulative time"), ("tottime", "time spent in the function itself")):
+                output.write("\n=== cProfile, top {} functions by {} ===\n".format(PROFILE_TOP_FUNCTIONS, description))
+                stats.sort_stats(order).print_stats(PROFILE_TOP_FUNCTIONS)
+        else:
+            output.write("\n=== cProfile ===\nNo calls were made on the profiled thread\n")
+        output.write("\n=== tracemalloc, top {} lines by memory allocated during the capture and still held ===\n".format(
+            PROFILE_TOP_ALLOCATIONS))
+        output.write("Traced {:.1f} KB at the end, peak {:.1f} KB\n".format(self._traced[0] / 1024, self._traced[1] / 1024))
+        for statistic in self._allocations:
+            output.write("{}\n".format(statistic))
+        return output.getvalue()
@@ -0,0 +1,790 @@
+"""
+Wire protocol shared by the server and the clients.
+
+Version 1 (legacy) messages are terminated with the EOM delimiter. Version 2 messages carry a
+fixed binary header (magic, version, type, flags, request id and payload length) followed by
+the raw payload, so a receiver knows the exact size up front and can read straight into a
+preallocated buffer. Connections start in legacy mode and are upgraded when both ends agree
+during negotiation.
+
+Framed connections also negotiate payload compression. The client lists the codecs it supports
+in its answer to the protocol offer, the server picks its preferred one and announces it with a
+'compression|<codec>' command. Compressed payloads are marked with the codec's flag bit, so each
+message is decoded on its own and small or incompressible payloads are sent as they are.
+
+ProtocolStream is the blocking implementation used by the clients, AsyncProtocolStream is the
+asyncio implementation used by the server's event loop.
+"""
+
+import asyncio
+import struct
+import socket
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+
+EOM = b"<EOM488965>"
+LEGACY_PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 2
+
+MAGIC = b"PP"
+HEADER = struct.Struct("!2sBBBxIQ")
+MAX_PAYLOAD_SIZE = 256 * 1024 * 1024
+RECV_CHUNK_SIZE = 64 * 1024
+TRANSFER_CHUNK_SIZE = 256 * 1024
+NEGOTIATION_TIMEOUT = 3
+#Seconds a closed legacy request keeps its place in the reply order, after that its reply is presumed never to come
+LEGACY_LATE_REPLY_TIMEOUT = 60
+
+MSG_COMMAND = 1
+MSG_RESPONSE = 2
+MSG_CHUNK = 3
+MSG_END = 4
+MSG_ERROR = 5
+
+FLAG_ZLIB = 0x01
+FLAG_LZ4 = 0x02
+FLAG_ZSTD = 0x04
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_LZ4 | FLAG_ZSTD
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_SAMPLE_SIZE = 4096
+COMPRESSION_MAX_RATIO = 0.9
+#Payloads from this size are compressed on a worker thread by AsyncProtocolStream, so the event loop keeps serving other clients
+COMPRESSION_OFFLOAD_SIZE = 64 * 1024
+COMMAND_NAME_LENGTH = 16
+OTHER_COMMAND = "other"
+
+Message = namedtuple("Message", ["msg_type", "flags", "request_id", "payload"])
+
+class RequestTiming():
+    """
+    RequestTiming follows one request on an instrumented AsyncProtocolStream.
+
+    Attributes:
+        command (str): The command name, see command_name.
+        started (float): The monotonic time the command was sent.
+        answered (float): The monotonic time of the last reply, None until one arrives.
+        failed (bool): True if a reply was MSG_ERROR.
+    """
+    __slots__ = ("command", "started", "answered", "failed")
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.monotonic()
+        self.answered = None
+        self.failed = False
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends data that does not follow the wire protocol.
+    """
+    pass
+
+def _zlib_decompress(payload) -> bytes:
+    """
+    Decompresses a zlib payload, refusing to inflate past the maximum message size.
+    """
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, MAX_PAYLOAD_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Decompressed payload exceeds the maximum message size")
+    return data
+
+#Codec name to (flag, compress, decompress), in order of preference. zlib is always available,
+#zstd and lz4 are used when their packages are installed on both ends.
+CODECS = {}
+try:
+    import zstandard
+    CODECS["zstd"] = (FLAG_ZSTD,
+                      lambda payload: zstandard.ZstdCompressor(level=3).compress(payload),
+                      lambda payload: zstandard.ZstdDecompressor().decompress(payload, max_output_size=MAX_PAYLOAD_SIZE))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    CODECS["lz4"] = (FLAG_LZ4, lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+CODECS["zlib"] = (FLAG_ZLIB, zlib.compress, _zlib_decompress)
+
+def choose_codec(offered) -> str:
+    """
+    Picks the most preferred local codec that the peer also supports.
+
+    Args:
+        offered (list): The codec names the peer supports.
+
+    Returns:
+        str: The codec name, or None if there is no codec in common.
+    """
+    for codec in CODECS:
+        if codec in offered:
+            return codec
+    return None
+
+def compress_payload(codec, payload) -> tuple:
+    """
+    Compresses a payload with the negotiated codec. Payloads under COMPRESSION_THRESHOLD are sent as
+    they are, and large payloads are only compressed if a sample from the start compresses well, so
+    already compressed files cost one small trial instead of a full pass.
+
+    Args:
+        codec (str): The negotiated codec, None disables compression.
+        payload (bytes): The message body.
+
+    Returns:
+        tuple: (payload, flags) where flags holds the codec's flag bit if the payload was compressed.
+    """
+    if codec is None or len(payload) < COMPRESSION_THRESHOLD:
+        return payload, 0
+    flag, compress, _ = CODECS[codec]
+    if len(payload) > COMPRESSION_SAMPLE_SIZE * 2:
+        sample = payload[:COMPRESSION_SAMPLE_SIZE]
+        if len(compress(sample)) > len(sample) * COMPRESSION_MAX_RATIO:
+            return payload, 0
+    compressed = compress(payload)
+    if len(compressed) > len(payload) * COMPRESSION_MAX_RATIO:
+        return payload, 0
+    return compressed, flag
+
+def decompress_payload(flags, payload):
+    """
+    Decompresses a payload marked with a codec flag bit, unmarked payloads are returned untouched.
+
+    Args:
+        flags (int): The message flags.
+        payload (bytes): The message body as received.
+
+    Returns:
+        bytes: The original message body.
+
+    Raises:
+        ProtocolError: If the codec is not supported or the payload is corrupt.
+    """
+    compressed = flags & COMPRESSION_FLAGS
+    if not compressed:
+        return payload
+    for flag, _, decompress in CODECS.values():
+        if flag == compressed:
+            try:
+                return decompress(payload)
+            except ProtocolError:
+                raise
+            except Exception as err:
+                raise ProtocolError("Corrupt compressed payload: {}".format(str(err)))
+    raise ProtocolError("Unsupported compression flags {:#x}".format(compressed))
+
+def build_header(msg_type, flags, request_id, payload_length) -> bytes:
+    """
+    Packs a version 2 message header.
+
+    Args:
+        msg_type (int): One of the MSG_* message types.
+        flags (int): Bit flags for the payload.
+        request_id (int): The request the message belongs to.
+        payload_length (int): The size of the payload in bytes.
+
+    Returns:
+        bytes: The packed header.
+    """
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, msg_type, flags, request_id, payload_length)
+
+def parse_header(header) -> tuple:
+    """
+    Unpacks and validates a version 2 message header.
+
+    Args:
+        header (bytes): HEADER.size bytes read from the wire.
+
+    Returns:
+        tuple: (msg_type, flags, request_id, payload_length)
+
+    Raises:
+        ProtocolError: If the magic, version or payload length is invalid.
+    """
+    magic, version, msg_type, flags, request_id, length = HEADER.unpack(header)
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise ProtocolError("Invalid message header")
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError("Payload of {} bytes exceeds the maximum message size".format(length))
+    return msg_type, flags, request_id, length
+
+def encode_payload(payload) -> bytes:
+    """
+    Converts a str payload to bytes, leaving bytes-like payloads untouched.
+    """
+    if isinstance(payload, str):
+        return payload.encode()
+    return payload
+
+def command_name(payload) -> str:
+    """
+    Returns the name of the command a payload carries, the text before the first '|'. Anything that is
+    not a short lowercase word is named OTHER_COMMAND, so names are safe to use as metric labels.
+    """
+    name = bytes(payload[:COMMAND_NAME_LENGTH + 1]).partition(b"|")[0]
+    if name.isalpha() and name.islower() and len(name) <= COMMAND_NAME_LENGTH:
+        return name.decode()
+    return OTHER_COMMAND
+
+class ProtocolStream():
+    """
+    ProtocolStream wraps a connected (TLS) socket and sends and receives whole messages in
+    either legacy EOM mode or framed mode.
+
+    Attributes:
+        framed (bool): True once version 2 framing has been negotiated.
+        codec (str): The codec used to compress outgoing payloads, None until one is negotiated.
+        _socket (socket): The wrapped socket.
+        _buffer (bytearray): Bytes received past the end of the previous legacy message.
+        _send_lock (Lock): Serialises writers so messages from different threads never interleave.
+    """
+    def __init__(self, sock):
+        self.framed = False
+        self.codec = None
+        self._socket = sock
+        self._buffer = bytearray()
+        self._send_lock = threading.Lock()
+
+    @property
+    def socket(self):
+        return self._socket
+
+    def send_message(self, payload, msg_type=MSG_RESPONSE, flags=0, request_id=0) -> None:
+        """
+        Sends a single message using the negotiated framing.
+
+        Args:
+            payload (str|bytes): The message body.
+            msg_type (int): The message type, ignored in legacy mode.
+            flags (int): The message flags, ignored in legacy mode.
+            request_id (int): The request the message belongs to, ignored in legacy mode.
+        """
+        payload = encode_payload(payload)
+        with self._send_lock:
+            if not self.framed:
+                self._socket.sendall(bytes(payload) + EOM)
+                return
+            payload, compressed = compress_payload(self.codec, payload)
+            flags |= compressed
+            header = build_header(msg_type, flags, request_id, len(payload))
+            if len(payload) <= RECV_CHUNK_SIZE:
+                self._socket.sendall(header + payload)
+            else:
+                self._socket.sendall(header)
+                self._socket.sendall(payload)
+
+    def receive_message(self) -> Message:
+        """
+        Receives a single message using the negotiated framing.
+
+        Returns:
+            Message: The received message. Legacy messages are reported as MSG_RESPONSE with request id 0.
+
+        Raises:
+            ConnectionError: If the peer closes the connection mid message.
+            ProtocolError: If a framed header is invalid.
+        """
+        if not self.framed:
+            return Message(MSG_RESPONSE, 0, 0, self._receive_legacy_payload())
+        header = bytearray(HEADER.size)
+        self._receive_into(memoryview(header))
+        msg_type, flags, request_id, length = parse_header(header)
+        payload = bytearray(length)
+        self._receive_into(memoryview(payload))
+        return Message(msg_type, flags & ~COMPRESSION_FLAGS, request_id, decompress_payload(flags, payload))
+
+    def _receive_legacy_payload(self) -> bytearray:
+        """
+        Reads until the EOM delimiter, only scanning bytes that have not been scanned before.
+        """
+        scan_from = 0
+        while True:
+            position = self._buffer.find(EOM, scan_from)
+            if position != -1:
+                payload = self._buffer[:position]
+                del self._buffer[:position + len(EOM)]
+                return payload
+            scan_from = max(0, len(self._buffer) - len(EOM) + 1)
+            chunk = self._socket.recv(RECV_CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError("Connection closed by peer")
+            self._buffer += chunk
+
+    def _receive_into(self, view) -> None:
+        """
+        Fills the provided memoryview from any buffered bytes first and then directly from the socket.
+        """
+        filled = 0
+        if self._buffer:
+            filled = min(len(self._buffer), len(view))
+            view[:filled] = self._buffer[:filled]
+            del self._buffer[:filled]
+        while filled < len(view):
+            received = self._socket.recv_into(view[filled:])
+            if not received:
+                raise ConnectionError("Connection closed by peer")
+            filled += received
+
+    def offer_protocol(self, timeout=NEGOTIATION_TIMEOUT) -> bool:
+        """
+        Server side negotiation. Offers the framed protocol in legacy framing and upgrades if the
+        client accepts. Legacy clients ignore the offer, so no answer within the timeout keeps legacy mode.
+        If the client lists codecs in its answer, the chosen codec is announced in the first framed message.
+
+        Args:
+            timeout (int): Seconds to wait for the client to answer the offer.
+
+        Returns:
+            bool: True if framed mode was negotiated.
+        """
+        previous_timeout = self._socket.gettimeout()
+        self._socket.settimeout(timeout)
+        try:
+            self.send_message("protocol|{}".format(PROTOCOL_VERSION))
+            reply = self._receive_legacy_payload().decode()
+            self.framed = self.parse_protocol_version(reply) >= PROTOCOL_VERSION
+        except (socket.timeout, ValueError):
+            self.framed = False
+        finally:
+            self._socket.settimeout(previous_timeout)
+        if self.framed:
+            self.codec = choose_codec(self.parse_protocol_codecs(reply))
+            if self.codec:
+                self.send_message("compression|{}".format(self.codec), msg_type=MSG_COMMAND)
+        return self.framed
+
+    def accept_protocol(self, offer) -> bool:
+        """
+        Client side negotiation. Answers a 'protocol|<version>' offer with the highest version both
+        ends support, and the codecs available for compression, then switches framing once the
+        answer has been sent.
+
+        Args:
+            offer (str): The decoded offer received from the server.
+
+        Returns:
+            bool: True if framed mode was negotiated.
+        """
+        version = min(self.parse_protocol_version(offer), PROTOCOL_VERSION)
+        if version >= PROTOCOL_VERSION:
+            self.send_message("protocol|{}|{}".format(version, ",".join(CODECS)))
+        else:
+            self.send_message("protocol|{}".format(version))
+        self.framed = version >= PROTOCOL_VERSION
+        return self.framed
+
+    def accept_compression(self, announcement) -> bool:
+        """
+        Client side compression negotiation. Compresses outgoing payloads with the codec the server
+        announced in a 'compression|<codec>' command.
+
+        Args:
+            announcement (str): The decoded announcement received from the server.
+
+        Returns:
+            bool: True if the codec is supported and outgoing payloads will be compressed.
+        """
+        codec = announcement.split("|", 1)[1]
+        self.codec = codec if codec in CODECS else None
+        return self.codec is not None
+
+    @staticmethod
+    def parse_protocol_version(message) -> int:
+        """
+        Extracts the version from a 'protocol|<version>[|<codecs>]' message.
+
+        Raises:
+            ValueError: If the message is not a protocol message.
+        """
+        command, version = message.split("|")[:2]
+        if command != "protocol":
+            raise ValueError("Not a protocol negotiation message")
+        return int(version)
+
+    @staticmethod
+    def parse_protocol_codecs(message) -> list:
+        """
+        Extracts the comma separated codecs from a 'protocol|<version>|<codecs>' message.
+
+        Returns:
+            list: The codec names, empty if the peer did not list any.
+        """
+        fields = message.split("|")
+        if len(fields) < 3 or not fields[2]:
+            return []
+        return fields[2].split(",")
+
+    def close(self) -> None:
+        self._socket.close()
+
+class AsyncProtocolStream():
+    """
+    AsyncProtocolStream is the asyncio counterpart of ProtocolStream. Once started, a dispatcher task
+    owns the reader and routes every incoming message to the request waiting for it, so any number of
+    coroutines can have requests outstanding on the same connection at once.
+
+    Framed replies are routed by request ID. Legacy clients reply in order and carry no request ID,
+    so each legacy reply is handed to the oldest request that has not been answered yet. A closed
+    legacy request keeps its place for LEGACY_LATE_REPLY_TIMEOUT seconds to absorb a late reply, then it
+    is dropped so a command the client never answered cannot shift every later reply.
+
+    An instrumented stream is given an observer, which is told the bytes of every message and the
+    command it belongs to, and the outcome and latency of every request once it is closed.
+
+    Attributes:
+        framed (bool): True once version 2 framing has been negotiated.
+        codec (str): The codec used to compress outgoing payloads, None until one is negotiated.
+        bytes_sent (int): Bytes written to the connection, including headers and delimiters.
+        bytes_received (int): Bytes read from the connection, including headers and delimiters.
+        last_received (float): The monotonic time the last whole message was received.
+        observer (object): Has count_bytes(command, sent, received) and observe_request(command, outcome,
+            seconds) methods, i.e. a ClientMetrics, None if the stream is not instrumented.
+        _reader (StreamReader): The asyncio stream reader for the connection.
+        _writer (StreamWriter): The asyncio stream writer for the connection.
+        _buffer (bytearray): Bytes received past the end of the previous legacy message.
+        _next_request_id (int): The last request ID handed out on this connection.
+        _pending (dict): Request ID to asyncio.Queue of replies.
+        _unanswered (deque): Legacy request IDs in the order they were sent, awaiting their one reply.
+        _closed_unanswered (dict): Legacy request ID to the monotonic time it was closed without a reply.
+        _dispatcher (Task): The task reading messages from the connection.
+        _closed (bool): True once the connection has been lost or closed.
+        _timings (dict): Request ID to the RequestTiming of each open request, only kept when instrumented.
+    """
+    def __init__(self, reader, writer, observer=None):
+        self.framed = False
+        self.codec = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.last_received = time.monotonic()
+        self.observer = observer
+        self._reader = reader
+        self._writer = writer
+        self._buffer = bytearray()
+        self._next_request_id = 0
+        self._pending = {}
+        self._unanswered = deque()
+        self._closed_unanswered = {}
+        self._dispatcher = None
+        self._closed = False
+        self._timings = {}
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def open_requests(self) -> tuple:
+        """
+        Returns the IDs of the requests still waiting for replies.
+        """
+        return tuple(self._pending)
+
+    async def send_message(self, payload, msg_type=MSG_RESPONSE, flags=0, request_id=0) -> None:
+        """
+        Sends a single message using the negotiated framing and waits for the write buffer to drain.
+        Payloads of COMPRESSION_OFFLOAD_SIZE or more are compressed in the loop's default executor, the
+        codecs release the GIL while they work. The header and payload are written without yielding to
+        the event loop after that, so concurrent senders never interleave.
+
+        Args:
+            payload (str|bytes): The message body. It must not be modified after the call.
+            msg_type (int): The message type, ignored in legacy mode.
+            flags (int): The message flags, ignored in legacy mode.
+            request_id (int): The request the message belongs to, ignored in legacy mode.
+        """
+        payload = encode_payload(payload)
+        if not self.framed:
+            self._writer.write(bytes(payload) + EOM)
+            size = len(payload) + len(EOM)
+        else:
+            if self.codec is not None and len(payload) >= COMPRESSION_OFFLOAD_SIZE:
+                payload, compressed = await asyncio.get_running_loop().run_in_executor(
+                    None, compress_payload, self.codec, payload)
+            else:
+                payload, compressed = compress_payload(self.codec, payload)
+            self._writer.write(build_header(msg_type, flags | compressed, request_id, len(payload)))
+            self._writer.write(payload)
+            size = HEADER.size + len(payload)
+        self.bytes_sent += size
+        if self.observer is not None:
+            timing = self._timings.get(request_id)
+            self.observer.count_bytes(timing.command if timing else OTHER_COMMAND, size, 0)
+        await self._writer.drain()
+
+    async def receive_message(self) -> Message:
+        """
+        Receives a single message using the negotiated framing. Only the dispatcher calls this once it is running.
+
+        Returns:
+            Message: The received message. Legacy messages are reported as MSG_RESPONSE with request id 0.
+
+        Raises:
+            ConnectionError: If the peer closes the connection mid message.
+            ProtocolError: If a framed header is invalid.
+        """
+        if not self.framed:
+            payload = await self._receive_legacy_payload()
+            self.bytes_received += len(payload) + len(EOM)
+            self.last_received = time.monotonic()
+            return Message(MSG_RESPONSE, 0, 0, payload)
+        msg_type, flags, request_id, length = parse_header(await self._read_exactly(HEADER.size))
+        payload = await self._read_exactly(length)
+        self.bytes_received += HEADER.size + length
+        self.last_received = time.monotonic()
+        return Message(msg_type, flags & ~COMPRESSION_FLAGS, request_id, decompress_payload(flags, payload))
+
+    async def _receive_legacy_payload(self) -> bytearray:
+        """
+        Reads until the EOM delimiter, only scanning bytes that have not been scanned before.
+        """
+        scan_from = 0
+        while True:
+            position = self._buffer.find(EOM, scan_from)
+            if position != -1:
+                payload = self._buffer[:position]
+                del self._buffer[:position + len(EOM)]
+                return payload
+            scan_from = max(0, len(self._buffer) - len(EOM) + 1)
+            chunk = await self._reader.read(RECV_CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError("Connection closed by peer")
+            self._buffer += chunk
+
+    async def _read_exactly(self, size) -> bytes:
+        """
+        Reads exactly size bytes, consuming any bytes left over from legacy mode first.
+        """
+        if not self._buffer:
+            try:
+                return await self._reader.readexactly(size)
+            except asyncio.IncompleteReadError:
+                raise ConnectionError("Connection closed by peer")
+        buffered = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        if len(buffered) == size:
+            return buffered
+        return buffered + await self._read_exactly(size - len(buffered))
+
+    async def offer_protocol(self, timeout=NEGOTIATION_TIMEOUT) -> bool:
+        """
+        Server side negotiation, see ProtocolStream.offer_protocol.
+
+        Args:
+            timeout (int): Seconds to wait for the client to answer the offer.
+
+        Returns:
+            bool: True if framed mode was negotiated.
+        """
+        await self.send_message("protocol|{}".format(PROTOCOL_VERSION))
+        try:
+            reply = (await asyncio.wait_for(self._receive_legacy_payload(), timeout)).decode()
+            self.framed = ProtocolStream.parse_protocol_version(reply) >= PROTOCOL_VERSION
+        except (asyncio.TimeoutError, ValueError):
+            self.framed = False
+        if self.framed:
+            self.codec = choose_codec(ProtocolStream.parse_protocol_codecs(reply))
+            if self.codec:
+                await self.send_message("compression|{}".format(self.codec), msg_type=MSG_COMMAND)
+        return self.framed
+
+    async def accept_protocol(self, offer) -> bool:
+        """
+        Client side negotiation, see ProtocolStream.accept_protocol. Used by simulated clients.
+
+        Args:
+            offer (str): The decoded offer received from the server.
+
+        Returns:
+            bool: True if framed mode was negotiated.
+        """
+        version = min(ProtocolStream.parse_protocol_version(offer), PROTOCOL_VERSION)
+        if version >= PROTOCOL_VERSION:
+            await self.send_message("protocol|{}|{}".format(version, ",".join(CODECS)))
+        else:
+            await self.send_message("protocol|{}".format(version))
+        self.framed = version >= PROTOCOL_VERSION
+        return self.framed
+
+    def accept_compression(self, announcement) -> bool:
+        """
+        Client side compression negotiation, see ProtocolStream.accept_compression.
+        """
+        codec = announcement.split("|", 1)[1]
+        self.codec = codec if codec in CODECS else None
+        return self.codec is not None
+
+    def start_dispatcher(self) -> None:
+        """
+        Starts the task that reads messages and routes them to outstanding requests.
+        """
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch_messages())
+
+    async def _dispatch_messages(self) -> None:
+        """
+        Reads messages until the connection is lost, then wakes every outstanding request with a ConnectionError.
+        """
+        try:
+            while True:
+                received = self.bytes_received
+                message = await self.receive_message()
+                if self.framed:
+                    request_id = message.request_id
+                else:
+                    request_id = self._next_unanswered()
+                if self.observer is not None:
+                    self._observe_reply(request_id, message, self.bytes_received - received)
+                queue = self._pending.get(request_id)
+                if queue is not None:
+                    queue.put_nowait(message)
+        except (ConnectionError, ProtocolError, OSError):
+            pass
+        finally:
+            self._closed = True
+            for queue in self._pending.values():
+                queue.put_nowait(None)
+            for request_id in list(self._timings):
+                self._finish_request(request_id, "disconnected")
+
+    def _next_unanswered(self):
+        """
+        Takes the legacy request the next legacy reply belongs to, first dropping closed requests that
+        have waited longer than LEGACY_LATE_REPLY_TIMEOUT for theirs.
+
+        Returns:
+            int: The request ID, or None if no request is waiting for a reply.
+        """
+        stale = self.last_received - LEGACY_LATE_REPLY_TIMEOUT
+        while self._unanswered:
+            request_id = self._unanswered.popleft()
+            closed = self._closed_unanswered.pop(request_id, None)
+            if closed is None or closed > stale:
+                return request_id
+        return None
+
+    def _observe_reply(self, request_id, message, size) -> None:
+        """
+        Counts the bytes of a received message against its request and records when the request was last answered.
+        """
+        timing = self._timings.get(request_id)
+        if timing is None:
+            self.observer.count_bytes(OTHER_COMMAND, 0, size)
+            return
+        timing.answered = self.last_received
+        timing.failed = timing.failed or message.msg_type == MSG_ERROR
+        self.observer.count_bytes(timing.command, 0, size)
+
+    def _finish_request(self, request_id, outcome=None) -> None:
+        """
+        Reports a request to the observer and stops following it. Unless an outcome is given it is
+        'error' if any reply was MSG_ERROR, 'ok' if it was answered and 'noreply' if it was not.
+        Latency is measured to the last reply, so the time the caller took to close it is not counted.
+        """
+        timing = self._timings.pop(request_id, None)
+        if timing is None:
+            return
+        seconds = None if timing.answered is None else timing.answered - timing.started
+        if outcome is None:
+            outcome = "noreply" if seconds is None else "error" if timing.failed else "ok"
+        self.observer.observe_request(timing.command, outcome, seconds)
+
+    async def open_request(self, payload, msg_type=MSG_COMMAND, expect_reply=True) -> int:
+        """
+        Sends a command tagged with a new request ID and registers for its replies.
+
+        Args:
+            payload (str|bytes): The command to send.
+            msg_type (int): The message type of the command.
+            expect_reply (bool): False for commands the client never answers, such as 'exit'.
+
+        Returns:
+            int: The request ID to pass to next_reply and close_request.
+
+        Raises:
+            ConnectionError: If the connection has already been lost.
+        """
+        if self._closed:
+            raise ConnectionError("Connection closed")
+        self._next_request_id = self._next_request_id % (2**32 - 1) + 1
+        request_id = self._next_request_id
+        if expect_reply:
+            self._pending[request_id] = asyncio.Queue()
+            if not self.framed:
+                self._unanswered.append(request_id)
+        if self.observer is not None:
+            payload = encode_payload(payload)
+            self._timings[request_id] = RequestTiming(command_name(payload))
+        try:
+            await self.send_message(payload, msg_type=msg_type, request_id=request_id)
+        except Exception:
+            self._pending.pop(request_id, None)
+            if self.observer is not None:
+                self._finish_request(request_id, "disconnected")
+            raise
+        if not expect_reply and self.observer is not None:
+            self._finish_request(request_id, "sent")
+        return request_id
+
+    async def send_to_request(self, request_id, payload, msg_type=MSG_CHUNK) -> None:
+        """
+        Sends a follow up message, such as a file chunk, that belongs to an open request.
+        """
+        await self.send_message(payload, msg_type=msg_type, request_id=request_id)
+
+    async def next_reply(self, request_id, timeout=None) -> Message:
+        """
+        Waits for the next reply to a request. Legacy requests receive exactly one reply.
+
+        Args:
+            request_id (int): The request ID returned by open_request.
+            timeout (float): Seconds to wait before raising asyncio.TimeoutError, None waits forever.
+
+        Returns:
+            Message: The next reply to the request.
+
+        Raises:
+            ConnectionError: If the connection is lost before a reply arrives.
+        """
+        queue = self._pending.get(request_id)
+        if queue is None:
+            raise ConnectionError("Request {} is not open".format(request_id))
+        if self._closed and queue.empty():
+            raise ConnectionError("Connection closed")
+        message = await asyncio.wait_for(queue.get(), timeout)
+        if message is None:
+            raise ConnectionError("Connection closed")
+        return message
+
+    def close_request(self, request_id) -> None:
+        """
+        Stops routing replies to a request. Late replies to a closed request are discarded. An unanswered
+        legacy request keeps its place in the reply order for LEGACY_LATE_REPLY_TIMEOUT seconds, so a
+        late reply is not handed to a later request, see _next_unanswered.
+        """
+        queue = self._pending.pop(request_id, None)
+        if queue is not None and not self.framed and request_id in self._unanswered:
+            self._closed_unanswered[request_id] = time.monotonic()
+        if self.observer is not None:
+            self._finish_request(request_id)
+
+    async def request(self, payload, timeout=None) -> Message:
+        """
+        Sends a command and waits for its single reply.
+
+        Args:
+            payload (str|bytes): The command to send.
+            timeout (float): Seconds to wait for the reply, None waits forever.
+
+        Returns:
+            Message: The reply.
+        """
+        request_id = await self.open_request(payload)
+        try:
+            return await self.next_reply(request_id, timeout)
+        finally:
+            self.close_request(request_id)
+
+    def close(self) -> None:
+        self._closed = True
+        self._writer.close()
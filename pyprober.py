@@ -1,4 +1,5 @@
 import os
+import argparse
 from log_controller import CreateLogger
 from create_server import CreateServer
 from server_controller import CreateController
@@ -25,16 +26,31 @@ def load_config():
     except Exception as err:
         print("Error loading config.toml: " + str(err))
 
+def parse_args():
+    """
+    Parses the command line arguments.
+
+    Returns:
+        Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="PyProber server")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignore the hash cache and rehash every known good binary at startup")
+    return parser.parse_args()
+
 def main():
     """
     Main function to load the toml config and create all instances required the server.
     """
+    args = parse_args()
     config = load_config()
 
     server_logger = CreateLogger("server")
     auth_logger = CreateLogger("auth")
-    file_manager_instance = CreateFileManager()
-    controller_instance = CreateController(server_logger, auth_logger, file_manager_instance)
+    file_manager_instance = CreateFileManager(config.get('hashing', {}).get('workers'), args.full)
+    metrics = config.get('metrics', {})
+    controller_instance = CreateController(server_logger, auth_logger, file_manager_instance,
+                                           metrics.get('port'), metrics.get('snapshot'), metrics.get('interval', 60))
     server_instance = CreateServer(config['server']['ip'], server_logger, controller_instance)
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import ssl
 import sys
@@ -5,21 +6,46 @@ import threading
 import time
 import os
 import datetime
+import fnmatch
+import hashlib
+import mmap
+import json
+import re
+import shlex
+import tqdm
 from base64 import b64decode, b64encode
 from abc import abstractmethod, ABC
+from contextlib import nullcontext
 from colorama import init, Back, Fore
+from protocol import AsyncProtocolStream, MSG_CHUNK, MSG_END, MSG_ERROR, TRANSFER_CHUNK_SIZE
+from session_manager import SessionRegistry, TELEMETRY_FIELDS
+from metric_store import MetricStore, parse_dump_metrics
+from server_metrics import ServerMetrics, METRICS_HOST, METRICS_SNAPSHOT_INTERVAL
+from snapshot_diff import SnapshotIndex, diff_snapshots, snapshot_time, ADDED, REMOVED
+from delta_sync import load_signatures, generate_delta
+from profiler import ProfileCapture, PROFILES_FOLDER, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS
 
 init(autoreset=True)
 
-#Future work, monkey patch socket.socket.send to apply EOM delimiter on all server sends.
-'''
-EOM = '<EOM488965>'
-def add_eom_delimiter_to_socket_send(send_without_eom):
-    def send_with_eom(self, data):
-        return original_send(self, data + EOM.encode())
-    return send_with_eom
-socket.socket.send = add_eom_delimiter_to_socket_send(socket.socket.send)
-'''
+TLS_HANDSHAKE_TIMEOUT = 10
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 10
+#Seconds a client busy answering a command may go without sending anything before it is counted as dead
+HEARTBEAT_BUSY_TIMEOUT = 300
+FAN_OUT_TIMEOUT = 30
+TELEMETRY_MIN_INTERVAL = 1
+TELEMETRY_MAX_INTERVAL = 3600
+METRICS_DEFAULT_HOURS = 24
+METRICS_DEFAULT_BUCKETS = 24
+LISTING_DISPLAY_ROWS = 200
+SEARCH_DISPLAY_ROWS = 200
+SIZE_UNITS = {'K':1024, 'M':1024**2, 'G':1024**3}
+TRANSFER_JOURNAL_INTERVAL = 8 * 1024 * 1024
+
+#Commands that can be fanned out to every client, with the dump folder and action type used to save replies
+FAN_OUT_COMMANDS = {'sysinfo':('client_sysinfo_dumps', 'sysinfo'),
+                    'disk':('client_disk_dumps', 'disk'),
+                    'processes':('client_process_dumps', 'processes')}
 
 class SetupController(ABC):
     def __init__(self, server_logger, auth_logger, file_manager):
@@ -32,8 +58,10 @@ class SetupController(ABC):
             file_manager (FileManager): An instance of the FileManager class used for managing files.
 
         Attributes:
-            _connection_list (list): An empty list to store connection objects.
-            _address_list (list): An empty list to store address objects.
+            _sessions (SessionRegistry): The connected clients, keyed by session ID.
+            _metrics (ServerMetrics): The server's own counters and histograms, exposed to Prometheus.
+            _metric_store (MetricStore): The time series of numeric client metrics.
+            _snapshots (dict): Dump type to the SnapshotIndex of its dump folder.
             _server_logger (Logger): The provided server_logger object.
             _auth_logger (Logger): The provided auth_logger object.
             _file_manager (FileManager): The provided file_manager object.
@@ -41,8 +69,11 @@ class SetupController(ABC):
             _menu_items (dict): A dictionary containing command descriptions for the main menu.
             _control_client_menu_items (dict): A dictionary containing command descriptions for the control client menu.
         """
-        self._connection_list = []
-        self._address_list = []
+        self._sessions = SessionRegistry()
+        self._metrics = ServerMetrics()
+        self._metrics.add_gauge("sessions", "Connected client sessions.", self._sessions.__len__)
+        self._metric_store = MetricStore()
+        self._snapshots = {action_type:SnapshotIndex(folder, action_type) for folder, action_type in FAN_OUT_COMMANDS.values()}
         self._server_logger = server_logger
         self._auth_logger = auth_logger
         self._file_manager = file_manager
@@ -51,17 +82,27 @@ class SetupController(ABC):
                             'r':'Refresh statistics',
                             'list':'List connected clients',
                             'set':'Interact with cient (set ID) i.e. set 1',
-                            'good':'Regenerate known good hashes file',
+                            'all':'Run sysinfo, disk or processes on every client (all CMD [IP filter]) i.e. all disk 192.168.50.*',
+                            'watch':'Clients push CPU, memory and disk samples (watch SECONDS|stop [IP filter]), watch alone shows the latest',
+                            'metrics':'Query stored client metrics (metrics IP METRIC [HOURS] [BUCKETS]), metrics alone lists them',
+                            'search':'Search client files, streaming matches to ./client_search_results, Ctrl+C cancels (search PATH [grep=REGEX] '
+                                     '[name=GLOB] [min=SIZE] [max=SIZE] [newer=DAYS] [older=DAYS] [depth=N] [limit=N] [timeout=SECONDS] [ip=FILTER])',
+                            'diff':'Compare a client\'s latest snapshot with an earlier one (diff sysinfo|disk|processes IP [N back|YYYYMMDD[HHMMSS]])',
+                            'profile':'Profile the server\'s event loop or a client in the background, saved to ./profiles (profile server|ID [SECONDS])',
+                            'good':'Regenerate known good hashes file, unchanged binaries reuse cached hashes (good --full rehashes all)',
                             'exit':'Shutdown server and send close signal to clients'}
         self._control_client_menu_items = {'help':'Display all commands',
                                         'r':'Refresh statistics',
                                         'kill':'Kill this client connection',
                                         'put':'Send a file to the client',
+                                        'sync':'Send a file to the client, only sending the changes if it already has a copy',
                                         'get':'Download a file from the client',
                                         'processes':'List processes running on the client',
                                         'sysinfo':'Display client OS version, CPU and memory information',
                                         'disk':'Display client disk useage',
                                         'listdir':'List directory on client',
+                                        'tree':'Recursively list a directory on the client with sizes, modes and times, saved to ./client_listings',
+                                        'integrity':'Hash the client binaries and compare them with the known good hashes',
                                         'exit':'Return to main menu'}
 
     @abstractmethod
@@ -75,7 +116,8 @@ class SetupController(ABC):
         pass
     
 class CreateController(SetupController):
-    def __init__(self, server_logger, auth_logger, file_manager):
+    def __init__(self, server_logger, auth_logger, file_manager, metrics_port=None, metrics_snapshot=None,
+                 metrics_interval=METRICS_SNAPSHOT_INTERVAL):
         """
         Initialises the CreateController class with the provided loggers and file manager.
 
@@ -83,77 +125,215 @@ class CreateController(SetupController):
             server_logger (Logger): The logger for server-related logs.
             auth_logger (Logger): The logger for authentication-related logs.
             file_manager (FileManager): The file manager object.
+            metrics_port (int): The localhost port to serve Prometheus metrics on, None to not serve them.
+            metrics_snapshot (str): The file to write the metrics to periodically, None to not write them.
+            metrics_interval (float): Seconds between metrics snapshots.
         """
         super().__init__(server_logger, auth_logger, file_manager)
+        self._metrics_port = metrics_port
+        self._metrics_snapshot = metrics_snapshot
+        self._metrics_interval = metrics_interval
         self._socket = None
-        
-        check_alive_thread = threading.Thread(target=self.check_clients_are_alive, args=())
-        check_alive_thread.daemon = True
-        check_alive_thread.start()
+        self._tls_context = None
+        self._loop = None
+        self._accept_task = None
+        self._connection_tasks = set()
+        self._loop_ready = threading.Event()
+        self._profiles = {}
+        self._last_profile = None
 
-    #The following functions are for connection management
+    #The following functions run the event loop that owns every client connection
 
-    def socket_for_controller(self, socket):
+    def socket_for_controller(self, socket, tls_context):
         """
-        Sets the provided socket as the controller's socket and accepts incoming connections.
+        Runs the controller's event loop on the provided listening socket. This is the target of the
+        thread started by the server, the menu runs on the main thread as a front end to the loop.
 
         Args:
-            socket (Socket): The socket to be set as the controller's socket.
-
-        Raises:
-            SSLError: If there is an SSL error.
-            socket.error: If there is a socket error.
+            socket (Socket): The bound, listening socket to accept clients on.
+            tls_context (SSLContext): The server TLS context used to secure authorised connections.
         """
         self._socket = socket
+        self._tls_context = tls_context
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
         try:
-            while True:
-                conn, address = self._socket.accept()
-                self.authorise_client(conn, address)
-        except (ssl.SSLError, socket.error) as err:
+            self._accept_task = self._loop.create_task(self.serve_clients())
+            self._loop.run_until_complete(self._accept_task)
+        except asyncio.CancelledError:
+            pass
+        except (ssl.SSLError, OSError) as err:
             self._server_logger.logger.error(str(err))
-            
-    def authorise_client(self, conn, address):
+        finally:
+            self._loop_ready.set()
+
+    async def serve_clients(self):
+        """
+        Accepts clients on the event loop and runs the heartbeat and the metrics endpoint until the server
+        is closed. Each accepted connection is authorised and handshaken in its own task so accept is never blocked.
+        """
+        loop = asyncio.get_running_loop()
+        self._socket.setblocking(False)
+        heartbeat = loop.create_task(self.check_clients_are_alive())
+        metrics_server = await self.start_metrics_endpoint()
+        snapshots = loop.create_task(self.write_metrics_snapshots()) if self._metrics_snapshot else None
+        self._loop_ready.set()
+        try:
+            while True:
+                conn, address = await loop.sock_accept(self._socket)
+                task = loop.create_task(self.authorise_client(conn, address))
+                self._connection_tasks.add(task)
+                task.add_done_callback(self._connection_tasks.discard)
+        finally:
+            heartbeat.cancel()
+            if snapshots:
+                snapshots.cancel()
+            if metrics_server:
+                metrics_server.close()
+            self._socket.close()
+
+    async def start_metrics_endpoint(self):
+        """
+        Serves the Prometheus metrics on localhost, so they can be scraped without exposing them to clients.
+
+        Returns:
+            Server: The asyncio server, None if metrics are not served or the port could not be bound.
+        """
+        if not self._metrics_port:
+            return None
+        try:
+            server = await asyncio.start_server(self._metrics.serve_scrape, METRICS_HOST, self._metrics_port)
+        except OSError as err:
+            self._server_logger.logger.error("Metrics endpoint not started: {}".format(str(err)))
+            return None
+        self._server_logger.logger.info("Metrics served on http://{}:{}/metrics".format(METRICS_HOST, self._metrics_port))
+        return server
+
+    async def write_metrics_snapshots(self):
+        """
+        Rewrites the metrics snapshot file every metrics interval until the server is closed. Files are
+        written on the default executor so a slow disk never stalls the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._metrics_interval)
+            try:
+                await loop.run_in_executor(None, self._metrics.write_snapshot, self._metrics_snapshot)
+            except OSError as err:
+                self._server_logger.logger.error("Error writing metrics snapshot: {}".format(str(err)))
+
+    def wait_until_serving(self, timeout=None):
+        """
+        Blocks until the event loop is accepting clients.
+
+        Args:
+            timeout (float): Seconds to wait, None waits forever.
+        """
+        self._loop_ready.wait(timeout)
+
+    def run_in_loop(self, coroutine, timeout=None):
+        """
+        Runs a coroutine on the controller's event loop from the menu thread and waits for its result.
+
+        Args:
+            coroutine (coroutine): The coroutine to run.
+            timeout (float): Seconds to wait for the result, None waits forever.
+
+        Returns:
+            The result of the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    #The following functions are for connection management
+
+    async def authorise_client(self, conn, address):
         """
         Checks if the client's IP address is authorized and adds the connection to the controller if it is,
-        otherwise logs the rejection.
+        otherwise logs the rejection. Rejected clients are closed before any TLS handshake takes place.
 
         Args:
-            conn: The connection object.
+            conn: The accepted, non-blocking socket.
             address: The IP address and port of the client.
 
         Raises:
             Exception: If there is an error authorising the client.
         """
         try:
-            if address[0] in self._file_manager.get_authorised_ips:
-                self.add_authorised_connection_to_controller(conn, address)
+            if self._file_manager.is_authorised_ip(address[0]):
+                await self.add_authorised_connection_to_controller(conn, address)
             else: 
+                self._metrics.observe_connection("rejected")
                 self._auth_logger.logger.info("Client connected and rejected: "
                                               "{}:{}".format(address[0], address[1]))
                 conn.close()
         except Exception as err:
                 self._auth_logger.logger.error("Error authorising client: "
                                     "{}:{}".format(address[0], address[1]))
+                conn.close()
                 
-    def add_authorised_connection_to_controller(self, conn, address):
+    async def add_authorised_connection_to_controller(self, conn, address):
         """
-        Adds an authorised connection to the controller.
+        Performs the TLS handshake and protocol negotiation without blocking the event loop and adds
+        the authorised connection to the controller.
 
         Args:
-            conn: The connection object representing the client connection.
+            conn: The accepted, non-blocking socket.
             address: The address of the client.
 
         Raises:
             Exception: If there is an error adding the client to the controller.
         """
         try:
-            self._connection_list.append(conn) 
-            self._address_list.append(address)
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(reader)
+            transport, _ = await loop.connect_accepted_socket(
+                lambda: protocol, conn, ssl=self._tls_context, ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT)
+            writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+            stream = AsyncProtocolStream(reader, writer, self._metrics.client(address[0]))
+            framed = await stream.offer_protocol()
+            self._metrics.observe_connection("authorised", time.perf_counter() - start)
+            stream.start_dispatcher()
+            session = self._sessions.add(stream, address)
             self._auth_logger.logger.info("Client connected and authorised: " 
                                             "{}:{}".format(address[0], address[1]))
+            self._server_logger.logger.info("Client {}:{} is session {} using {} protocol, compression {}".format(
+                address[0], address[1], session.session_id, "framed" if framed else "legacy EOM", stream.codec or "off"))
         except Exception as err:
+            self._metrics.observe_connection("failed")
             self._auth_logger.logger.error("Error adding authorised client to controller: "
                                             "{}:{}".format(address[0], address[1]))
+            conn.close()
+
+    def remove_client_connection(self, client_id):
+        """
+        Closes a client's connection and removes its session. The IDs of the other sessions are unchanged.
+
+        Args:
+            client_id (int): The session ID of the client.
+        """
+        session = self._sessions.remove(client_id)
+        if session is not None:
+            self._loop.call_soon_threadsafe(session.stream.close)
+
+    def get_session(self, client_id):
+        """
+        Looks up a connected client's session.
+
+        Args:
+            client_id (int): The session ID of the client.
+
+        Returns:
+            ClientSession: The session of the client.
+
+        Raises:
+            ConnectionError: If the client is no longer connected.
+        """
+        session = self._sessions.get(client_id)
+        if session is None:
+            raise ConnectionError("Client {} is not connected".format(client_id))
+        return session
     
     #The following functions are for main menu management
 
@@ -194,8 +374,26 @@ class CreateController(SetupController):
         elif cmd == "r": pass
         elif cmd == "exit": self.shutdown_controller_and_close_clients()
         elif cmd == "list": self.display_connected_clients
-        elif cmd == "good": self._file_manager.generate_known_good_hashes()
+        elif cmd.split(" ")[0] == "good": self.regenerate_known_good_hashes(cmd)
         elif cmd.startswith("set"): self.set_session(cmd)
+        elif cmd.split(" ")[0] == "all": self.fan_out(cmd)
+        elif cmd.split(" ")[0] == "watch": self.watch_clients(cmd)
+        elif cmd.split(" ")[0] == "metrics": self.query_metrics(cmd)
+        elif cmd.split(" ")[0] == "diff": self.diff_client_snapshots(cmd)
+        elif cmd.split(" ")[0] == "search": self.search_clients(cmd)
+        elif cmd.split(" ")[0] == "profile": self.start_profile(cmd)
+
+    def regenerate_known_good_hashes(self, cmd):
+        """
+        Starts rebuilding the known good hashes in the background, 'good --full' ignores the hash cache.
+
+        Args:
+            cmd (str): The user input command.
+        """
+        if self._file_manager.start_known_good_hashes("--full" in cmd.split(" ")):
+            print(Back.GREEN + "Regenerating known good hashes in the background")
+        else:
+            print(Back.YELLOW + "Known good hashes are already being generated")
 
     def display_help(self):
         """
@@ -209,11 +407,28 @@ class CreateController(SetupController):
         Displays the controller statistics.
         """          
         print("\n*** SERVER INFO AND LOGS ***")
-        print("Number of connected clients: {}\n\nLast 5 logged auth attempts:\n{}".format(
+        print("Number of connected clients: {}\nKnown good hashes: {}\n\nLast 5 logged auth attempts:\n{}".format(
             self.number_of_connected_clients,
+            self._file_manager.baseline_status,
             self.format_last_5_auth_messages))
+        if self._profiles or self._last_profile:
+            print("\nProfiles: {}".format(self.format_profiles_status))
         print("*" * 28)
     
+    @property
+    def format_profiles_status(self):
+        """
+        Formats the running profiles and the last profile saved.
+
+        Returns:
+            str: i.e. 'server until 12:00:30, last saved ./profiles/20240101120000_server_profile'
+        """
+        status = ["{} until {}".format(target, datetime.datetime.fromtimestamp(deadline).strftime("%H:%M:%S"))
+                  for target, deadline in list(self._profiles.items())]
+        if self._last_profile:
+            status.append("last saved ./{}/{}".format(PROFILES_FOLDER, self._last_profile))
+        return ", ".join(status)
+
     @property
     def number_of_connected_clients(self):
         """
@@ -222,7 +437,7 @@ class CreateController(SetupController):
         Returns:
             int: The number of connected clients.
         """
-        return len(self._address_list)
+        return len(self._sessions)
     
     @property
     def display_connected_clients(self):
@@ -242,9 +457,12 @@ class CreateController(SetupController):
         """
         Formats and displays the list of connected clients.
         """
-        print(Back.GREEN + "ID - Client")
-        for i, address in enumerate(self._address_list):
-            print(Back.GREEN + "{}  - {}".format(i, address[i]))
+        print(Back.GREEN + "ID - Client - Connected - Heartbeat - Traffic")
+        for session in self._sessions.snapshot():
+            print(Back.GREEN + "{}  - {}:{} - {} - {} - {:.1f} KB sent, {:.1f} KB received".format(
+                session.session_id, session.address[0], session.address[1],
+                datetime.datetime.fromtimestamp(session.connected_at).strftime("%Y-%m-%d %H:%M:%S"),
+                session.rtt, session.bytes_sent / 1024, session.bytes_received / 1024))
 
     @property
     def format_last_5_auth_messages(self):
@@ -254,52 +472,92 @@ class CreateController(SetupController):
         Returns
             str: A string containing the formatted last 5 authentication messages or "None" if there are no messages.
         """
-        if not self._file_manager.get_last_5_auth_messages:
+        last_5_auth_messages = self._file_manager.get_last_5_auth_messages
+        if not last_5_auth_messages:
             return "None"
         else:
             temp = []
-            for _ in self._file_manager.get_last_5_auth_messages:
+            for _ in last_5_auth_messages:
                 temp.append(_.split(' - ')[0] + ' - ' + ' '.join(
                     _.split(" - ")[2].split()))
             return "\n".join(temp)
 
     #The following functions are used to check clients are alive
 
-    def receive_hello_data_from_clients(self, session_id):
+    async def receive_hello_data_from_clients(self, stream):
         """
-        Receives data from a specific client.
+        Sends a hello to a specific client and receives the reply.
 
         Parameters:
-            session_id (int): The ID of the session for receiving data from clients.
+            stream (AsyncProtocolStream): The connection of the client to check.
 
         Returns:
-            str: The received data from the client as a string.
+            str: The received data from the client as a string, or False if the client did not answer in time.
         """
-        data = ""
-        while True:
-            chunk = self._connection_list[session_id].recv(1024).decode("utf-8")
-            if not chunk: return False
-            data += chunk
-            if "<EOM488965>" in data: break
-        return data.replace("<EOM488965>", "")
+        try:
+            reply = await stream.request("hello", timeout=HEARTBEAT_TIMEOUT)
+            return reply.payload.decode("utf-8")
+        except (ConnectionError, asyncio.TimeoutError):
+            return False
       
-    def check_clients_are_alive(self):
+    async def ping_client(self, session):
         """
-        Periodically checks if the connected clients are still alive.
+        Pings one client and records the round trip time if it answers before the deadline. A client that
+        is busy answering a command only reads commands between them, so it is not pinged, it is alive as
+        long as it keeps sending within HEARTBEAT_BUSY_TIMEOUT. A client that sent anything while the ping
+        was outstanding is alive even if the hello reply is late.
+
+        Parameters:
+            session (ClientSession): The session of the client to check.
+
+        Returns:
+            bool: True if the client is alive.
+        """
+        if self.is_client_busy(session):
+            return not session.stream.closed and time.monotonic() - session.last_seen < HEARTBEAT_BUSY_TIMEOUT
+        start = time.perf_counter()
+        if not await self.receive_hello_data_from_clients(session.stream):
+            self._metrics.observe_heartbeat(None)
+            return not session.stream.closed and time.monotonic() - session.last_seen < HEARTBEAT_TIMEOUT
+        rtt = time.perf_counter() - start
+        session.rtt.add_sample(rtt)
+        self._metrics.observe_heartbeat(rtt)
+        return True
+      
+    @staticmethod
+    def is_client_busy(session):
+        """
+        Checks if a client has a command open, other than its telemetry subscription, which is answered
+        from a separate thread on the client.
+
+        Parameters:
+            session (ClientSession): The session of the client to check.
+
+        Returns:
+            bool: True if the client is busy answering a command.
+        """
+        return any(request_id != session.subscription for request_id in session.stream.open_requests)
+
+    async def check_clients_are_alive(self):
         """
+        Periodically checks if the connected clients are still alive. Runs as a task on the event loop
+        alongside the client commands, replies are routed by the connection's dispatcher. Every client is
+        pinged at once with its own deadline, so a sweep takes at most HEARTBEAT_TIMEOUT however many
+        clients are connected. Clients busy streaming a reply are judged on the traffic they send instead,
+        see ping_client. Dead clients are reaped after the sweep from a snapshot of the sessions.
+        """
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time()
         while True:
-            time.sleep(10)
-            if self._connection_list:
-                for i, conn in enumerate(self._connection_list):
-                    try:
-                        self._connection_list[i].send(str.encode('hello<EOM488965>'))
-                        recv_data = self.receive_hello_data_from_clients(i)
-                        if not recv_data: raise Exception
-                    except Exception as err:
-                        self._server_logger.logger.info("Connection closed: {}".format(
-                            self._address_list[i][0]))
-                        del self._address_list[i]
-                        del self._connection_list[i]
+            next_sweep += HEARTBEAT_INTERVAL
+            await asyncio.sleep(max(0, next_sweep - loop.time()))
+            targets = self._sessions.snapshot()
+            alive = await asyncio.gather(*(self.ping_client(session) for session in targets))
+            for session, answered in zip(targets, alive):
+                if not answered:
+                    self._server_logger.logger.info("Connection closed: {}".format(session.address[0]))
+                    self.remove_client_connection(session.session_id)
+            next_sweep = max(next_sweep, loop.time())
 
     #The following functions close connections with clients and 
     #stop the server when the 'exit' command is called on the main menu
@@ -315,14 +573,14 @@ class CreateController(SetupController):
             Socket exception: If there is an error closing a client connection.
         """
         if self.number_of_connected_clients:
-            for i, conn in enumerate(self._connection_list):
+            for session in self._sessions.snapshot():
                 try:
-                    self._connection_list[i].send(str.encode('exit<EOM488965>'))
+                    self.send_data_to_client(session.session_id, "exit", expect_reply=False)
                     time.sleep(1)
-                    conn.close()
+                    self.remove_client_connection(session.session_id)
                     self._server_logger.logger.info("Connection closed due to exit command: {}".format(
-                        self._address_list[i][0]))
-                except socket.error as err:
+                        session.address[0]))
+                except (socket.error, ConnectionError) as err:
                     self._server_logger.logger.error(str(err))
         self.stop_server()
                               
@@ -334,7 +592,7 @@ class CreateController(SetupController):
             ssl.SSLError exception: If there is a SSL error raised it is subsquently logged and the program exits.
         """
         try:
-            self._socket.close()
+            self._loop.call_soon_threadsafe(self._accept_task.cancel)
             self._server_logger.logger.info("Server socket closed successfully")
             time.sleep(1)
             sys.exit()
@@ -360,7 +618,7 @@ class CreateController(SetupController):
         """
         Checks if a session exists based on user input.
 
-        It checks if the entered client ID exists in the range of the address list and returns True if it does.
+        It checks if the entered client ID is a connected session and returns True if it is.
         Otherwise, it prints an error message.
 
         Args:
@@ -369,7 +627,7 @@ class CreateController(SetupController):
         Returns:
             bool: True if the session exists, otherwise prints an error message.
         """
-        if self.get_entered_client_id(user_input) in range(len(self._address_list)): return True
+        if self.get_entered_client_id(user_input) in self._sessions: return True
         else: print(Back.RED + "Client ID does not exist, please enter ID from 'list'")
 
     def get_entered_client_id(self, user_input):
@@ -418,14 +676,14 @@ class CreateController(SetupController):
             Exception: Used to catch a scenario in which a client disconnects while the user is on the client
             command menu. Alerts the user and clears the screen, breaks the loop and returns back to the main menu.
         """
-        print(Back.GREEN + "Connected to client "+ str(self._address_list[client_id][0]))
+        print(Back.GREEN + "Connected to client "+ str(self.get_session(client_id).address[0]))
         self._break_client_control_loop = False
         while True:
             if self._break_client_control_loop:
                 break
             try:
                 self.display_controller_statistics()
-                cmd = input("\nClient " + str(self._address_list[client_id][0] + ": "))
+                cmd = input("\nClient " + str(self.get_session(client_id).address[0] + ": "))
                 os.system("clear")
                 if not self.validate_control_client_input(cmd):
                     print(Back.RED + "Command not recognised, type 'help' for command listing")
@@ -459,11 +717,14 @@ class CreateController(SetupController):
         elif cmd == "exit": self.break_control_client_loop()
         elif cmd == "kill": self.kill_client_connection(client_id)
         elif cmd == "put": self.start_file_send(client_id)
+        elif cmd == "sync": self.start_file_send(client_id, delta=True)
         elif cmd == "get": self.get_file_name_to_download(client_id)
         elif cmd == "processes": self.get_client_processes(client_id)
         elif cmd == "sysinfo": self.get_client_sysinfo(client_id)
         elif cmd == "disk": self.get_client_disk_info(client_id)
         elif cmd == "listdir": self.get_dir_to_list(client_id)
+        elif cmd == "tree": self.get_tree_to_list(client_id)
+        elif cmd == "integrity": self.check_client_binary_integrity(client_id)
         else: pass
 
     def break_control_client_loop(self):
@@ -496,30 +757,172 @@ class CreateController(SetupController):
             client_id (str): The ID of the client for which the disk information is requested.
             dir_to_list (str): The directory to list.
         """
-        construct_data_to_send = "listdir|" + dir_to_list + "<EOM488965>"
-        self._connection_list[client_id].send(str.encode(construct_data_to_send))
-        self.recv_dir_listing_from_client(client_id)
+        request_id = self.send_data_to_client(client_id, "listdir|" + dir_to_list)
+        self.recv_dir_listing_from_client(client_id, request_id)
 
-    def recv_dir_listing_from_client(self, client_id):
+    def recv_dir_listing_from_client(self, client_id, request_id):
         """
         Receives directory listing from the client and displays on screen. Displays 'Nothing received'
         message if no listing is received.
 
         Args:
             client_id (str): The ID of the client for which the disk information is requested.
+            request_id (int): The request ID returned by send_data_to_client.
         
         Raises:
             Exception: Used to catch an issue when a directory listing is not received. This happens on 
             occassion when a 'hello' message is received from the alive check.
         """
         try:
-            recv_data = self.receive_data_from_clients(client_id)
+            recv_data = self.receive_data_from_clients(client_id, request_id)
             if recv_data.startswith("dirlisting|"):
                 dir_listing = recv_data.split("|")[1]
                 print(dir_listing)
         except:
             print(Back.RED + "Nothing received, please try again")
 
+    def get_tree_to_list(self, client_id):
+        """
+        Requests the user to enter a directory to list recursively, the depth and a glob filter, or breaks
+        the loop on the exit command.
+
+        Args:
+            client_id (int): The ID of the client.
+        """
+        if not self.get_session(client_id).stream.framed:
+            print(Back.RED + "Client does not support recursive listings, please update the client")
+            return
+        while True:
+            dir_to_list = input("Enter directory to list recursively or 'exit': ")
+            if dir_to_list == "exit":
+                break
+            max_depth = input("Enter the number of levels to list or leave blank for all: ").strip() or "0"
+            if not max_depth.isdigit():
+                print(Back.RED + "The number of levels must be a whole number")
+                continue
+            pattern = input("Enter a filename glob i.e. *.log or leave blank for all: ").strip() or "*"
+            self.get_tree_listing(client_id, dir_to_list, int(max_depth), pattern)
+
+    def get_tree_listing(self, client_id, dir_to_list, max_depth=0, pattern="*"):
+        """
+        Builds listtree message to send to client and begins the receive functions.
+
+        Args:
+            client_id (int): The ID of the client.
+            dir_to_list (str): The directory to list.
+            max_depth (int): The number of levels to list, 0 for no limit.
+            pattern (str): The glob filenames must match.
+        """
+        request_id = self.send_data_to_client(client_id, "listtree|{}|{}|{}".format(max_depth, pattern, dir_to_list))
+        self.recv_tree_listing_from_client(client_id, request_id)
+
+    def recv_tree_listing_from_client(self, client_id, request_id):
+        """
+        Receives the pages of a recursive listing, appending each to the listing file as it arrives and
+        displaying the first LISTING_DISPLAY_ROWS entries, so large trees are never held in memory.
+
+        Args:
+            client_id (int): The ID of the client.
+            request_id (int): The request ID returned by send_data_to_client.
+        """
+        client_ip = self.get_session(client_id).address[0]
+        full_filename = self.build_filename(client_ip, "tree")
+        displayed = errors = received = 0
+        try:
+            with open(f"./client_listings/{full_filename}", "w") as file:
+                while True:
+                    message = self.receive_message_from_client(client_id, request_id)
+                    if message.msg_type == MSG_END:
+                        break
+                    if message.msg_type == MSG_ERROR:
+                        raise IOError(message.payload.decode())
+                    page = message.payload.decode()
+                    file.write(page)
+                    errors += page.count("\terror\t")
+                    received += page.count("\n")
+                    if displayed < LISTING_DISPLAY_ROWS:
+                        for row in page.splitlines()[:LISTING_DISPLAY_ROWS - displayed]:
+                            try:
+                                path, kind, size, mode, mtime = row.rsplit("\t", 4)
+                            except ValueError:
+                                continue
+                            if path != "path":
+                                print("{} {:>14} {} {}".format(mode if kind != "error" else "error     ",
+                                                               size, mtime, path))
+                                displayed += 1
+                    else:
+                        print("Received {} entries".format(received - 1), end="\r")
+        except (IOError, ConnectionError) as err:
+            self._server_logger.logger.error("Error receiving listing from client {}: {}".format(client_ip, str(err)))
+            print(Back.RED + "Error receiving listing: {}".format(str(err)))
+            return
+        finally:
+            self.close_client_request(client_id, request_id)
+        count = int(message.payload.decode() or 0)
+        if count > displayed:
+            print("\n... {} more entries".format(count - displayed))
+        print((Back.GREEN if not errors else Back.YELLOW) + "{} entries, {} unreadable directories, saved to ./client_listings/{}".format(
+            count, errors, full_filename))
+        self._server_logger.logger.info("Listing of client {} saved to {}".format(client_ip, full_filename))
+
+    #The following functions compare the client binaries with the known good hashes
+
+    def check_client_binary_integrity(self, client_id):
+        """
+        Asks the client to hash the configured binary paths and diffs the streamed records against the
+        known good hashes, writing added, removed and modified binaries to a report as they are found.
+
+        Args:
+            client_id (int): The ID of the client to scan.
+        """
+        if not self.get_session(client_id).stream.framed:
+            print(Back.RED + "Client does not support integrity scans, please update the client")
+            return
+        if not self._file_manager.wait_for_known_good_hashes(0):
+            print(Back.YELLOW + "Known good hashes are still {}, please try again shortly".format(
+                self._file_manager.baseline_status))
+            return
+        index = self._file_manager.get_known_good_hash_index()
+        client_ip = self.get_session(client_id).address[0]
+        print(Back.YELLOW + "Client is hashing {} against {} known good hashes".format(
+            ", ".join(self._file_manager._binary_paths), len(index)))
+        request_id = self.send_data_to_client(client_id, "hashscan|" + "|".join(self._file_manager._binary_paths))
+        full_filename = self.build_filename(client_ip, "integrity")
+        try:
+            with open(f"./client_integrity_reports/{full_filename}", "w") as report:
+                counts = index.diff(self.receive_hash_records_from_client(client_id, request_id), report)
+                report.write("\nAdded: {added}, removed: {removed}, modified: {modified}, "
+                             "unchanged: {unchanged}\n".format(**counts))
+        except (IOError, ConnectionError) as err:
+            self._server_logger.logger.error("Error checking integrity of client {}: {}".format(client_ip, str(err)))
+            print(Back.RED + "Integrity scan failed, please check server.log")
+            return
+        finally:
+            self.close_client_request(client_id, request_id)
+        self._server_logger.logger.info("Integrity report of client {} saved to {}".format(client_ip, full_filename))
+        print((Back.GREEN if not counts['added'] + counts['removed'] + counts['modified'] else Back.RED) +
+              "Added: {added}, removed: {removed}, modified: {modified}, unchanged: {unchanged}".format(**counts))
+        print(Back.GREEN + "Integrity report saved to ./client_integrity_reports/{}".format(full_filename))
+
+    def receive_hash_records_from_client(self, client_id, request_id):
+        """
+        Yields the 'path:digest' records the client streams until the end of the scan.
+
+        Args:
+            client_id (int): The ID of the client.
+            request_id (int): The request ID returned by send_data_to_client.
+
+        Yields:
+            str: A 'path:digest' record.
+        """
+        while True:
+            message = self.receive_message_from_client(client_id, request_id)
+            if message.msg_type == MSG_END:
+                return
+            if message.msg_type == MSG_ERROR:
+                raise IOError(message.payload.decode())
+            yield from message.payload.decode().splitlines()
+
     #The following functions provide disk information request and receive functionality
 
     def get_client_disk_info(self, client_id):
@@ -529,29 +932,28 @@ class CreateController(SetupController):
         Args:
             client_id (str): The ID of the client for which the disk information is requested.
         """
-        construct_data_to_send = "disk<EOM488965>".format(str(client_id))
-        self._connection_list[client_id].send(str.encode(construct_data_to_send))
-        self.recv_disk_information_from_client(client_id)
+        request_id = self.send_data_to_client(client_id, "disk")
+        self.recv_disk_information_from_client(client_id, request_id)
 
-    def recv_disk_information_from_client(self, client_id):
+    def recv_disk_information_from_client(self, client_id, request_id):
         """
         Receives disk information from the client and displays on screen as well as saving to file. 
 
         Args:
             client_id (str): The ID of the client for which the disk information is requested.
+            request_id (int): The request ID returned by send_data_to_client.
 
         Raises:
             IOError exception: To catch an issue writing the file to disk and write to server log.
             Exception: Used to catch all other cases and write to server log.
         """
         try:
-            recv_data = self.receive_data_from_clients(client_id)
-            full_filename = self.build_filename(self._address_list[client_id][0], "disk")
-            with open(f"./client_disk_dumps/{full_filename}", "w") as file:
-                file.write(recv_data.split("|")[1])
+            recv_data = self.receive_data_from_clients(client_id, request_id)
+            full_filename = self.save_client_dump("client_disk_dumps", self.get_session(client_id).address[0], "disk",
+                                                  recv_data.split("|", 1)[1])
             print(Back.GREEN + "Disk information dump saved to ./client_disk_dumps/{}".format(full_filename))
             self._server_logger.logger.info("Disk information dump of client {} saved to {}".format(
-                self._address_list[client_id][0], full_filename))
+                self.get_session(client_id).address[0], full_filename))
             print("\n" + Back.GREEN + recv_data.split("|")[1])
         except IOError as err:
             self._server_logger.logger.error("Error writing disk dump {}".format(str(err)))
@@ -568,25 +970,24 @@ class CreateController(SetupController):
         Args:
             client_id (str): The ID of the client for which the sysinfo information is requested.
         """
-        construct_data_to_send = "sysinfo<EOM488965>".format(str(client_id))
-        self._connection_list[client_id].send(str.encode(construct_data_to_send))  
-        self.recv_sysinfo_from_client(client_id)   
+        request_id = self.send_data_to_client(client_id, "sysinfo")
+        self.recv_sysinfo_from_client(client_id, request_id)   
 
-    def recv_sysinfo_from_client(self, client_id):
+    def recv_sysinfo_from_client(self, client_id, request_id):
         """
         Receives sysinfo information from the client and displays on screen as well as saving to file. 
 
         Args:
             client_id (str): The ID of the client for which the sysinfo information is requested.
+            request_id (int): The request ID returned by send_data_to_client.
         """
         try:
-            recv_data = self.receive_data_from_clients(client_id)
-            full_filename = self.build_filename(self._address_list[client_id][0], "sysinfo")
-            with open(f"./client_sysinfo_dumps/{full_filename}", "w") as file:
-                file.write(recv_data.split("|")[1])
+            recv_data = self.receive_data_from_clients(client_id, request_id)
+            full_filename = self.save_client_dump("client_sysinfo_dumps", self.get_session(client_id).address[0], "sysinfo",
+                                                  recv_data.split("|", 1)[1])
             print(Back.GREEN + "Sysinfo dump saved to ./client_sysinfo_dumps/{}".format(full_filename))
             self._server_logger.logger.info("Sysinfo dump of client {} saved to {}".format(
-                self._address_list[client_id][0], full_filename))
+                self.get_session(client_id).address[0], full_filename))
             print("\n" + Back.GREEN + recv_data.split("|")[1])
         except IOError as err:
             self._server_logger.logger.error("Error writing process dump {}".format(str(err)))
@@ -598,30 +999,65 @@ class CreateController(SetupController):
 
     def get_client_processes(self, client_id):
         """
-        Builds process message to send to client and begins the receive functions.
+        Builds process message to send to client and begins the receive functions. Framed clients
+        stream a process table, legacy clients send a list of names in one reply.
 
         Args:
             client_id (str): The ID of the client for which the process information is requested.
         """
-        construct_data_to_send = "processes<EOM488965>".format(str(client_id))
-        self._connection_list[client_id].send(str.encode(construct_data_to_send))
-        self.recv_proccess_list_from_client(client_id)
+        if self.get_session(client_id).stream.framed:
+            request_id = self.send_data_to_client(client_id, "processtable")
+            self.recv_process_table_from_client(client_id, request_id)
+        else:
+            request_id = self.send_data_to_client(client_id, "processes")
+            self.recv_proccess_list_from_client(client_id, request_id)
+
+    def recv_process_table_from_client(self, client_id, request_id):
+        """
+        Receives the process table the client streams and appends each batch to the dump file as it
+        arrives, so memory use does not depend on the number of processes.
+
+        Args:
+            client_id (int): The ID of the client for which the process information is requested.
+            request_id (int): The request ID returned by send_data_to_client.
+        """
+        client_ip = self.get_session(client_id).address[0]
+        full_filename = self.build_filename(client_ip, "processes")
+        try:
+            with open(f"./client_process_dumps/{full_filename}", "w") as file:
+                while True:
+                    message = self.receive_message_from_client(client_id, request_id)
+                    if message.msg_type == MSG_END:
+                        break
+                    if message.msg_type == MSG_ERROR:
+                        raise IOError(message.payload.decode())
+                    file.write(message.payload.decode())
+            self._snapshots["processes"].add(client_ip, full_filename)
+            self.record_process_count(client_ip, message.payload.decode())
+            print(Back.GREEN + "Process table of {} processes saved to ./client_process_dumps/{}".format(
+                message.payload.decode(), full_filename))
+            self._server_logger.logger.info("Process dump of client {} saved to {}".format(client_ip, full_filename))
+        except (IOError, ConnectionError) as err:
+            self._server_logger.logger.error("Error writing process dump {}".format(str(err)))
+            print(Back.RED + "Error receiving process table, please check server.log")
+        finally:
+            self.close_client_request(client_id, request_id)
 
-    def recv_proccess_list_from_client(self, client_id):
+    def recv_proccess_list_from_client(self, client_id, request_id):
         """
         Receives process information from the client and saves to file. 
 
         Args:
             client_id (str): The ID of the client for which the process information is requested.
+            request_id (int): The request ID returned by send_data_to_client.
         """
         try:
-            recv_data = self.receive_data_from_clients(client_id)
-            full_filename = self.build_filename(self._address_list[client_id][0], "processes")
-            with open(f"./client_process_dumps/{full_filename}", "w") as file:
-                file.write(recv_data.split("|")[1])
+            recv_data = self.receive_data_from_clients(client_id, request_id)
+            full_filename = self.save_client_dump("client_process_dumps", self.get_session(client_id).address[0], "processes",
+                                                  recv_data.split("|", 1)[1])
             print(Back.GREEN + "Process dump saved to ./client_process_dumps/{}".format(full_filename))
             self._server_logger.logger.info("Process dump of client {} saved to {}".format(
-                self._address_list[client_id][0], full_filename))
+                self.get_session(client_id).address[0], full_filename))
             time.sleep(3)
         except IOError as err:
             self._server_logger.logger.error("Error writing process dump {}".format(str(err)))
@@ -629,7 +1065,620 @@ class CreateController(SetupController):
             self._server_logger.logger.error("Error writing process dump {}".format(str(err))) 
             pass
 
-    #Function to build a filename used to save files
+    #The following functions run a command on every connected client at once
+
+    def fan_out(self, user_input):
+        """
+        Parses 'all CMD [IP filter]' and runs the command on every matching client concurrently, saving each
+        reply to its dump folder. Wall time is bounded by the slowest client rather than the sum of all of them.
+
+        Args:
+            user_input (str): The user input, the optional IP filter is a glob pattern i.e. 192.168.50.*
+        """
+        args = user_input.split()
+        if len(args) < 2 or args[1] not in FAN_OUT_COMMANDS:
+            print(Back.RED + "Usage: all <{}> [IP filter]".format("|".join(FAN_OUT_COMMANDS)))
+            return
+        ip_filter = args[2] if len(args) > 2 else "*"
+        start = time.monotonic()
+        results = self.run_in_loop(self.fan_out_command(args[1], ip_filter))
+        if not results:
+            print(Back.RED + "No connected clients match {}".format(ip_filter))
+            return
+        for address, succeeded, outcome in results:
+            print((Back.GREEN if succeeded else Back.RED) + "{}:{} - {}".format(address[0], address[1], outcome))
+        print("\n{} of {} clients answered in {:.2f}s".format(
+            sum(1 for result in results if result[1]), len(results), time.monotonic() - start))
+
+    async def fan_out_command(self, command, ip_filter="*", timeout=FAN_OUT_TIMEOUT):
+        """
+        Sends a command to every client whose IP matches the filter at once and gathers the replies.
+
+        Args:
+            command (str): One of the FAN_OUT_COMMANDS.
+            ip_filter (str): A glob pattern matched against client IP addresses.
+            timeout (float): Seconds to wait for each client.
+
+        Returns:
+            list: A (address, succeeded, outcome) tuple per matching client.
+        """
+        targets = [session for session in self._sessions.snapshot() if fnmatch.fnmatch(session.address[0], ip_filter)]
+        return await asyncio.gather(*(self.fan_out_to_client(session.stream, session.address, command, timeout)
+                                      for session in targets))
+
+    async def fan_out_to_client(self, stream, address, command, timeout):
+        """
+        Runs a fanned out command on one client and saves the reply as soon as it arrives.
+
+        Args:
+            stream (AsyncProtocolStream): The connection of the client.
+            address (tuple): The IP address and port of the client.
+            command (str): One of the FAN_OUT_COMMANDS.
+            timeout (float): Seconds to wait for the reply.
+
+        Returns:
+            tuple: (address, succeeded, outcome)
+        """
+        folder, action_type = FAN_OUT_COMMANDS[command]
+        try:
+            if command == "processes" and stream.framed:
+                full_filename = await self.fan_out_process_table(stream, address, timeout)
+            else:
+                reply = await stream.request(command, timeout=timeout)
+                full_filename = self.save_client_dump(folder, address[0], action_type,
+                                                      reply.payload.decode().split("|", 1)[1])
+            self._server_logger.logger.info("{} dump of client {} saved to {}".format(
+                action_type.capitalize(), address[0], full_filename))
+            return address, True, "saved to ./{}/{}".format(folder, full_filename)
+        except asyncio.TimeoutError:
+            return address, False, "no reply within {}s".format(timeout)
+        except (ConnectionError, IndexError, OSError) as err:
+            self._server_logger.logger.error("Error running {} on client {}: {}".format(command, address[0], str(err)))
+            return address, False, "error: {}".format(str(err))
+
+    async def fan_out_process_table(self, stream, address, timeout):
+        """
+        Receives a streamed process table from one client during a fan out, writing each batch to the
+        dump file as it arrives.
+
+        Args:
+            stream (AsyncProtocolStream): The connection of the client.
+            address (tuple): The IP address and port of the client.
+            timeout (float): Seconds to wait for each batch.
+
+        Returns:
+            str: The filename the dump was saved to.
+
+        Raises:
+            IOError: If the client reports an error.
+        """
+        full_filename = self.build_filename(address[0], "processes")
+        request_id = await stream.open_request("processtable")
+        try:
+            with open(f"./client_process_dumps/{full_filename}", "w") as file:
+                while True:
+                    message = await stream.next_reply(request_id, timeout)
+                    if message.msg_type == MSG_END:
+                        self._snapshots["processes"].add(address[0], full_filename)
+                        self.record_process_count(address[0], message.payload.decode())
+                        return full_filename
+                    if message.msg_type == MSG_ERROR:
+                        raise IOError(message.payload.decode())
+                    file.write(message.payload.decode())
+        finally:
+            stream.close_request(request_id)
+
+    #The following functions search the files of every matching client at once
+
+    def search_clients(self, user_input):
+        """
+        Parses 'search PATH [key=value ...]' and runs the search on every matching client at once. The
+        clients search in a worker thread and stream back only the matches, which are displayed and saved
+        as they arrive. Ctrl+C cancels the search on every client and keeps the matches found so far.
+
+        Args:
+            user_input (str): The user input.
+        """
+        try:
+            options, ip_filter = self.parse_search_options(shlex.split(user_input)[1:])
+        except (ValueError, re.error) as err:
+            print(Back.RED + "Invalid search: {}".format(str(err)))
+            return
+        searches = {}
+        start = time.monotonic()
+        future = asyncio.run_coroutine_threadsafe(
+            self.search_all_clients("search|" + json.dumps(options), ip_filter, searches), self._loop)
+        try:
+            results = future.result()
+        except KeyboardInterrupt:
+            print(Back.YELLOW + "\nCancelling search...")
+            self.run_in_loop(self.cancel_searches(searches))
+            results = future.result()
+        if not results:
+            print(Back.RED + "No connected clients that support searches match {}".format(ip_filter))
+            return
+        for address, succeeded, outcome in results:
+            print((Back.GREEN if succeeded else Back.RED) + "{}:{} - {}".format(address[0], address[1], outcome))
+        print("\n{} of {} clients searched in {:.2f}s".format(
+            sum(1 for result in results if result[1]), len(results), time.monotonic() - start))
+
+    @staticmethod
+    def parse_search_options(args) -> tuple:
+        """
+        Converts the arguments of the search command into the options sent to the clients.
+
+        Args:
+            args (list): PATH then key=value arguments.
+
+        Returns:
+            tuple: (options dict, IP filter)
+
+        Raises:
+            ValueError: If the arguments are invalid.
+            re.error: If the regex is invalid.
+        """
+        if not args or "=" in args[0]:
+            raise ValueError("a path to search is required")
+        options = {'root':args[0]}
+        ip_filter = "*"
+        for arg in args[1:]:
+            key, separator, value = arg.partition("=")
+            if not separator:
+                raise ValueError("expected key=value, got {}".format(arg))
+            if key == "grep":
+                re.compile(value.encode())
+                options['regex'] = value
+            elif key == "name":
+                options['name'] = value
+            elif key in ("min", "max"):
+                unit = SIZE_UNITS.get(value[-1:].upper(), 1)
+                options[key + "_size"] = int(float(value[:-1] if unit > 1 else value) * unit)
+            elif key in ("newer", "older"):
+                options[key] = float(value) * 86400
+            elif key in ("depth", "limit", "timeout"):
+                options[key] = int(value)
+            elif key == "ip":
+                ip_filter = value
+            else:
+                raise ValueError("unknown option {}".format(key))
+        return options, ip_filter
+
+    async def search_all_clients(self, command, ip_filter, searches):
+        """
+        Sends a search to every framed client whose IP matches the filter and gathers the outcomes.
+
+        Args:
+            command (str): The search command.
+            ip_filter (str): A glob pattern matched against client IP addresses.
+            searches (dict): Filled with the stream of each running search to its request ID, for cancel_searches.
+
+        Returns:
+            list: A (address, succeeded, outcome) tuple per client searched.
+        """
+        targets = [session for session in self._sessions.snapshot()
+                   if fnmatch.fnmatch(session.address[0], ip_filter) and session.stream.framed]
+        displayed = [0]
+        return await asyncio.gather(*(self.search_client(session, command, searches, displayed)
+                                      for session in targets))
+
+    async def search_client(self, session, command, searches, displayed):
+        """
+        Runs a search on one client, appending each batch of matches to its results file and displaying
+        the first SEARCH_DISPLAY_ROWS matches across all clients.
+
+        Args:
+            session (ClientSession): The client.
+            command (str): The search command.
+            searches (dict): The running searches, this search is added until it ends.
+            displayed (list): The number of matches displayed so far, shared by every client searched.
+
+        Returns:
+            tuple: (address, succeeded, outcome)
+        """
+        stream, address = session.stream, session.address
+        full_filename = self.build_filename(address[0], "search")
+        try:
+            request_id = await stream.open_request(command)
+        except ConnectionError as err:
+            return address, False, "error: {}".format(str(err))
+        searches[stream] = request_id
+        try:
+            with open(f"./client_search_results/{full_filename}", "w") as file:
+                while True:
+                    message = await stream.next_reply(request_id)
+                    if message.msg_type == MSG_END:
+                        break
+                    if message.msg_type == MSG_ERROR:
+                        raise IOError(message.payload.decode())
+                    page = message.payload.decode()
+                    file.write(page)
+                    for row in page.splitlines()[:max(0, SEARCH_DISPLAY_ROWS - displayed[0])]:
+                        try:
+                            path, size, mtime, line_number, line = row.split("\t", 4)
+                        except ValueError:
+                            continue
+                        print("{} {}:{} {}".format(address[0], path, line_number, line) if line_number else
+                              "{} {} {} bytes {}".format(address[0], path, size, mtime))
+                        displayed[0] += 1
+        except (ConnectionError, OSError) as err:
+            self._server_logger.logger.error("Error searching client {}: {}".format(address[0], str(err)))
+            return address, False, "error: {}".format(str(err))
+        finally:
+            searches.pop(stream, None)
+            stream.close_request(request_id)
+        summary = json.loads(message.payload.decode())
+        self._server_logger.logger.info("Search results of client {} saved to {}".format(address[0], full_filename))
+        return address, True, "{} matches in {} files ({:.1f} MB searched){}, saved to ./client_search_results/{}".format(
+            summary['matches'], summary['files'], summary['bytes'] / 1024**2,
+            ", stopped at the " + summary['stopped'] if summary['stopped'] in ("limit", "timeout") else
+            ", cancelled" if summary['stopped'] else "", full_filename)
+
+    async def cancel_searches(self, searches):
+        """
+        Asks every client with a running search to stop it. Each client then sends the matches found so far
+        and ends the search as usual.
+
+        Args:
+            searches (dict): The stream of each running search to its request ID.
+        """
+        for stream, request_id in list(searches.items()):
+            try:
+                await stream.open_request("cancel|{}".format(request_id), expect_reply=False)
+            except ConnectionError:
+                continue
+
+    #The following functions subscribe clients to push telemetry samples
+
+    def watch_clients(self, user_input):
+        """
+        Parses 'watch [SECONDS|stop] [IP filter]'. With an interval every matching client is subscribed to
+        push samples at that interval, 'stop' unsubscribes them and no arguments shows the latest sample of
+        every subscribed client.
+
+        Args:
+            user_input (str): The user input, the optional IP filter is a glob pattern i.e. 192.168.50.*
+        """
+        args = user_input.split()
+        if len(args) == 1:
+            self.display_telemetry()
+            return
+        ip_filter = args[2] if len(args) > 2 else "*"
+        if args[1] == "stop":
+            stopped = self.run_in_loop(self.unsubscribe_clients(ip_filter))
+            print(Back.GREEN + "Stopped telemetry from {} clients".format(stopped))
+            return
+        try:
+            interval = float(args[1])
+        except ValueError:
+            interval = 0
+        if not TELEMETRY_MIN_INTERVAL <= interval <= TELEMETRY_MAX_INTERVAL:
+            print(Back.RED + "Usage: watch <{}-{} seconds|stop> [IP filter]".format(TELEMETRY_MIN_INTERVAL,
+                                                                                   TELEMETRY_MAX_INTERVAL))
+            return
+        subscribed, skipped = self.run_in_loop(self.subscribe_clients(interval, ip_filter))
+        print(Back.GREEN + "{} clients pushing telemetry every {}s".format(subscribed, interval))
+        if skipped:
+            print(Back.YELLOW + "{} legacy clients do not support telemetry, please update them".format(skipped))
+
+    def display_telemetry(self):
+        """
+        Displays the latest telemetry sample of every subscribed client.
+        """
+        sessions = [session for session in self._sessions.snapshot() if session.telemetry]
+        if not sessions:
+            print(Back.RED + "No telemetry received, start it with 'watch SECONDS'")
+            return
+        print(Back.GREEN + "ID - Client - Sampled - CPU - Memory - Disk - Load")
+        for session in sessions:
+            sample_time, cpu, memory, disk, load = session.telemetry[-1]
+            print(Back.GREEN + "{}  - {} - {} - {:.1f}% - {:.1f}% - {:.1f}% - {:.2f}".format(
+                session.session_id, session.address[0],
+                datetime.datetime.fromtimestamp(sample_time).strftime("%H:%M:%S"), cpu, memory, disk, load))
+
+    async def subscribe_clients(self, interval, ip_filter="*"):
+        """
+        Subscribes every framed client whose IP matches the filter, resubscribing clients that are already
+        pushing so the new interval takes effect.
+
+        Args:
+            interval (float): Seconds between samples.
+            ip_filter (str): A glob pattern matched against client IP addresses.
+
+        Returns:
+            tuple: (clients subscribed, legacy clients skipped)
+        """
+        subscribed = skipped = 0
+        for session in self._sessions.snapshot():
+            if not fnmatch.fnmatch(session.address[0], ip_filter):
+                continue
+            if not session.stream.framed:
+                skipped += 1
+                continue
+            try:
+                request_id = await session.stream.open_request("subscribe|{}".format(interval))
+            except (ConnectionError, OSError):
+                continue
+            session.subscription = request_id
+            task = asyncio.get_running_loop().create_task(self.receive_telemetry(session, request_id))
+            self._connection_tasks.add(task)
+            task.add_done_callback(self._connection_tasks.discard)
+            subscribed += 1
+        return subscribed, skipped
+
+    async def unsubscribe_clients(self, ip_filter="*"):
+        """
+        Stops telemetry from every subscribed client whose IP matches the filter. Each client sends its
+        remaining samples and ends the subscription.
+
+        Args:
+            ip_filter (str): A glob pattern matched against client IP addresses.
+
+        Returns:
+            int: The number of clients unsubscribed.
+        """
+        stopped = 0
+        for session in self._sessions.snapshot():
+            if session.subscription is not None and fnmatch.fnmatch(session.address[0], ip_filter):
+                try:
+                    await session.stream.open_request("unsubscribe", expect_reply=False)
+                    stopped += 1
+                except (ConnectionError, OSError):
+                    pass
+        return stopped
+
+    async def receive_telemetry(self, session, request_id):
+        """
+        Stores the samples a client pushes for a subscription until the client ends it or disconnects.
+        A client that is resubscribed ends its previous subscription, which then stops here.
+
+        Args:
+            session (ClientSession): The session of the subscribed client.
+            request_id (int): The request ID of the subscribe command.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                message = await session.stream.next_reply(request_id)
+                if message.msg_type != MSG_CHUNK:
+                    break
+                samples = []
+                for line in message.payload.decode().splitlines():
+                    try:
+                        sample = tuple(float(value) for value in line.split("\t"))
+                    except ValueError:
+                        continue
+                    if len(sample) == len(TELEMETRY_FIELDS):
+                        samples.append(sample)
+                session.telemetry.extend(samples)
+                await loop.run_in_executor(None, self.store_telemetry, session.address[0], samples)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            session.stream.close_request(request_id)
+            if session.subscription == request_id:
+                session.subscription = None
+
+    def store_telemetry(self, client_ip, samples):
+        """
+        Appends a batch of telemetry samples to the metric store, one series per field.
+
+        Args:
+            client_ip (str): The IP address of the client.
+            samples (list): TELEMETRY_FIELDS tuples.
+        """
+        for position, metric in enumerate(TELEMETRY_FIELDS[1:], 1):
+            self._metric_store.append(client_ip, metric, ((sample[0], sample[position]) for sample in samples))
+
+    #The following functions query the metric store
+
+    def query_metrics(self, user_input):
+        """
+        Parses 'metrics [IP METRIC [HOURS] [BUCKETS]]' and displays the metric over the last HOURS hours
+        summarised in BUCKETS buckets. With no arguments lists the stored clients and metrics.
+
+        Args:
+            user_input (str): The user input.
+        """
+        args = user_input.split()
+        if len(args) == 1:
+            clients = self._metric_store.clients()
+            if not clients:
+                print(Back.RED + "No metrics stored, they are recorded from 'watch' and client dumps")
+            for client_ip in clients:
+                print(Back.GREEN + "{} - {}".format(client_ip, ", ".join(self._metric_store.metrics(client_ip))))
+            return
+        try:
+            client_ip, metric = args[1], args[2]
+            hours = float(args[3]) if len(args) > 3 else METRICS_DEFAULT_HOURS
+            buckets = int(args[4]) if len(args) > 4 else METRICS_DEFAULT_BUCKETS
+            if hours <= 0 or buckets <= 0:
+                raise ValueError
+        except (IndexError, ValueError):
+            print(Back.RED + "Usage: metrics <IP> <metric> [hours] [buckets]")
+            return
+        end = time.time()
+        start_query = time.perf_counter()
+        summaries = self._metric_store.query(client_ip, metric, end - hours * 3600, end, buckets)
+        elapsed = time.perf_counter() - start_query
+        if not summaries:
+            print(Back.RED + "No {} samples for {} in the last {} hours".format(metric, client_ip, hours))
+            return
+        print(Back.GREEN + "Bucket start - Samples - Min - Mean - Max")
+        for summary in summaries:
+            print(Back.GREEN + "{} - {} - {:.2f} - {:.2f} - {:.2f}".format(
+                datetime.datetime.fromtimestamp(summary.start).strftime("%Y-%m-%d %H:%M:%S"),
+                summary.count, summary.minimum, summary.mean, summary.maximum))
+        print("\n{} samples in {:.1f}ms".format(sum(summary.count for summary in summaries), elapsed * 1000))
+
+    #The following functions compare snapshots of a client
+
+    def diff_client_snapshots(self, user_input):
+        """
+        Parses 'diff TYPE IP [BASELINE]' and displays what changed between the client's latest snapshot
+        and the baseline, by default the snapshot before it.
+
+        Args:
+            user_input (str): The user input, BASELINE is a number of snapshots back or a timestamp prefix.
+        """
+        args = user_input.split()
+        if len(args) < 3 or args[1] not in self._snapshots:
+            print(Back.RED + "Usage: diff <{}> <IP> [snapshots back|YYYYMMDD[HHMMSS]]".format("|".join(self._snapshots)))
+            return
+        index = self._snapshots[args[1]]
+        try:
+            baseline_file, latest_file = index.find_pair(args[2], args[3] if len(args) > 3 else "1")
+            baseline, latest = index.read(baseline_file), index.read(latest_file)
+        except ValueError:
+            print(Back.RED + "The baseline must be a number of snapshots back or a timestamp i.e. 20240101")
+            return
+        except (LookupError, OSError) as err:
+            print(Back.RED + str(err))
+            return
+        elapsed = snapshot_time(latest_file) - snapshot_time(baseline_file)
+        changes = diff_snapshots(args[1], baseline, latest, elapsed.total_seconds() / 86400 or None)
+        print("{} -> {} ({})".format(baseline_file, latest_file, elapsed))
+        if not changes:
+            print(Back.GREEN + "No changes")
+        colours = {ADDED:Back.GREEN, REMOVED:Back.RED}
+        for kind, description in changes:
+            print(colours.get(kind, Back.YELLOW) + "{} {}".format(kind, description))
+
+    #The following functions profile the server or a client in the background
+
+    def start_profile(self, user_input):
+        """
+        Parses 'profile server|ID [SECONDS]' and starts profiling the server's event loop, or the client
+        with the session ID, in the background. The menu stays usable, so the commands to investigate can
+        be run while the profile captures, and the report is saved to ./profiles when it ends.
+
+        Args:
+            user_input (str): The user input.
+        """
+        args = user_input.split()
+        try:
+            seconds = float(args[2]) if len(args) > 2 else PROFILE_DEFAULT_SECONDS
+        except ValueError:
+            seconds = 0
+        if len(args) < 2 or not 0 < seconds <= PROFILE_MAX_SECONDS:
+            print(Back.RED + "Usage: profile <server|ID> [SECONDS up to {}]".format(PROFILE_MAX_SECONDS))
+            return
+        if args[1] == "server":
+            target = "server"
+        elif self.session_exists(user_input):
+            session = self.get_session(self.get_entered_client_id(user_input))
+            target = "client {} ({})".format(session.session_id, session.address[0])
+        else:
+            return
+        if target in self._profiles:
+            print(Back.YELLOW + "{} is already being profiled".format(target))
+            return
+        self._profiles[target] = time.time() + seconds
+        coroutine = self.profile_server(seconds) if target == "server" else self.profile_client(session, target, seconds)
+        asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        print(Back.GREEN + "Profiling {} for {:g}s in the background, the report will be saved to ./{}".format(
+            target, seconds, PROFILES_FOLDER))
+
+    async def profile_server(self, seconds):
+        """
+        Profiles the event loop thread, which runs every client connection, the heartbeat and the commands
+        sent from the menu, and traces the allocations of the whole process, then saves the report.
+
+        Args:
+            seconds (float): How long to profile for.
+        """
+        loop = asyncio.get_running_loop()
+        capture = ProfileCapture(seconds)
+        try:
+            capture.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                capture.stop()
+            report = await loop.run_in_executor(None, capture.report, "server event loop")
+            await loop.run_in_executor(None, self.save_profile, "server", report)
+        except (ValueError, OSError) as err:
+            self._server_logger.logger.error("Error profiling server: {}".format(str(err)))
+        finally:
+            self._profiles.pop("server", None)
+
+    async def profile_client(self, session, target, seconds):
+        """
+        Asks a client to profile the thread that answers commands, then asks for the report once the
+        seconds are up and saves it.
+
+        Args:
+            session (ClientSession): The client.
+            target (str): The name of the profile in self._profiles.
+            seconds (float): How long to profile for.
+        """
+        stream, client_ip = session.stream, session.address[0]
+        try:
+            reply = await stream.request("profile|start|{:g}".format(seconds), timeout=FAN_OUT_TIMEOUT)
+            if reply.msg_type == MSG_ERROR or not reply.payload.startswith(b"profile|started|"):
+                raise IOError(reply.payload.decode())
+            await asyncio.sleep(seconds)
+            reply = await stream.request("profile|stop", timeout=FAN_OUT_TIMEOUT)
+            if reply.msg_type == MSG_ERROR:
+                raise IOError(reply.payload.decode())
+            await asyncio.get_running_loop().run_in_executor(None, self.save_profile, client_ip, reply.payload.decode())
+        except asyncio.TimeoutError:
+            self._server_logger.logger.error("Error profiling client {}: no reply".format(client_ip))
+        except (ConnectionError, OSError) as err:
+            self._server_logger.logger.error("Error profiling client {}: {}".format(client_ip, str(err)))
+        finally:
+            self._profiles.pop(target, None)
+
+    def save_profile(self, client_id, report):
+        """
+        Saves a profile report to a timestamped file in the profiles folder.
+
+        Args:
+            client_id (str): 'server' or the IP address of the client profiled.
+            report (str): The report.
+        """
+        full_filename = self.build_filename(client_id, "profile")
+        with open(f"./{PROFILES_FOLDER}/{full_filename}", "w") as file:
+            file.write(report)
+        self._last_profile = full_filename
+        self._server_logger.logger.info("Profile of {} saved to {}".format(client_id, full_filename))
+
+    #Functions to build a filename used to save files and save client dumps
+
+    def save_client_dump(self, folder, client_ip, action_type, data):
+        """
+        Saves a client dump to a timestamped file in its dump folder.
+
+        Args:
+            folder (str): The dump folder i.e. client_disk_dumps.
+            client_ip (str): The IP address of the client the dump came from.
+            action_type (str): The command used which will be attached to the filename.
+            data (str): The dump to save.
+
+        Returns:
+            str: The filename the dump was saved to.
+        """
+        full_filename = self.build_filename(client_ip, action_type)
+        with open(f"./{folder}/{full_filename}", "w") as file:
+            file.write(data)
+        self._snapshots[action_type].add(client_ip, full_filename)
+        if action_type == "processes":
+            self.record_process_count(client_ip, len(data.splitlines()))
+        else:
+            self._metric_store.append_metrics(client_ip, time.time(), parse_dump_metrics(action_type, data))
+        return full_filename
+
+    def record_process_count(self, client_ip, count):
+        """
+        Appends the number of processes in a process dump to the metric store.
+
+        Args:
+            client_ip (str): The IP address of the client the dump came from.
+            count (int|str): The number of processes.
+        """
+        try:
+            self._metric_store.append_metrics(client_ip, time.time(), {'process_count':float(count)})
+        except ValueError:
+            pass
 
     @staticmethod
     def build_filename(client_id, action_type):
@@ -647,26 +1696,70 @@ class CreateController(SetupController):
         current_date_time_formatted = current_time+"_"+str(client_id)+"_"+action_type
         return current_date_time_formatted
 
-    #A reusable function to receive data from commands and strip the EOM delimiter
+    #Reusable functions to send commands to and receive data from clients using the negotiated framing
+
+    def send_data_to_client(self, client_id, data, expect_reply=True):
+        """
+        Sends a command to a client on the event loop, tagged with a new request ID.
+
+        Args:
+            client_id (int): The ID of the client to send the command to.
+            data (str|bytes): The command to send.
+            expect_reply (bool): False for commands the client never answers.
 
-    def receive_data_from_clients(self, client_id):
+        Returns:
+            int: The request ID the command was sent with.
         """
-        Function to remove the EOM delimiter from messages received from commands. 
+        return self.run_in_loop(self.get_session(client_id).stream.open_request(data, expect_reply=expect_reply))
+
+    def send_chunk_to_client(self, client_id, request_id, data, msg_type=MSG_CHUNK):
+        """
+        Sends a follow up message, such as a file chunk, belonging to an open request.
+
+        Args:
+            client_id (int): The ID of the client.
+            request_id (int): The request ID returned by send_data_to_client.
+            data (bytes): The message body.
+            msg_type (int): The message type.
+        """
+        self.run_in_loop(self.get_session(client_id).stream.send_to_request(request_id, data, msg_type))
+
+    def receive_message_from_client(self, client_id, request_id):
+        """
+        Receives the next message for an open request, leaving the request open for streamed replies.
+
+        Args:
+            client_id (int): The ID of the client.
+            request_id (int): The request ID returned by send_data_to_client.
+
+        Returns:
+            Message: The next message for the request.
+        """
+        return self.run_in_loop(self.get_session(client_id).stream.next_reply(request_id))
+
+    def close_client_request(self, client_id, request_id):
+        """
+        Stops routing replies for a request once all of its messages have been received.
+        """
+        self._loop.call_soon_threadsafe(self.get_session(client_id).stream.close_request, request_id)
+
+    def receive_data_from_clients(self, client_id, request_id):
+        """
+        Receives the single reply to a command. Framed messages are read directly into a buffer
+        of the announced size, legacy messages are read until the EOM delimiter.
         This is separate to the function used by the check alive messages. 
 
         Args:
             client_id (str): The ID of the client for which the receive is associated with.
+            request_id (int): The request ID returned by send_data_to_client.
 
         Returns:
-            current_date_time_formatted (str): A filename including the date, cient IP address and action
+            str: The decoded message received from the client.
         """
-        data = ""
-        while True:
-            chunk = self._connection_list[client_id].recv(1024).decode()
-            if not chunk: False
-            data += chunk
-            if "<EOM488965>" in data: break
-        return data.replace("<EOM488965>", "")
+        try:
+            return self.receive_message_from_client(client_id, request_id).payload.decode()
+        finally:
+            self.close_client_request(client_id, request_id)
 
     #A function to display the client control menu
 
@@ -686,39 +1779,40 @@ class CreateController(SetupController):
         Args:
             client_id (str): The ID of the client for which to send the 'exit' message.
         """
+        address = self.get_session(client_id).address
         try:
-            self._connection_list[client_id].send(str.encode('exit<EOM488965>'))
+            self.send_data_to_client(client_id, "exit", expect_reply=False)
             time.sleep(1)
-            self._connection_list[client_id].close()
             self._server_logger.logger.info("Server terminated connection,"
-                                             "with {}:{}".format(self._address_list[client_id][0], self._address_list[client_id][1]))
-            del self._address_list[client_id]
-            del self._connection_list[client_id]
+                                             "with {}:{}".format(address[0], address[1]))
+            self.remove_client_connection(client_id)
             self.break_control_client_loop()
         except:
             self._server_logger.logger.info("Error terminating connection," 
-                                            "with {}:{}".format(self._address_list[client_id][0], self._address_list[client_id][1]))
+                                            "with {}:{}".format(address[0], address[1]))
 
     #The follow functions are used to put a file on the the client
 
-    def start_file_send(self, client_id):
+    def start_file_send(self, client_id, delta=False):
         """
         Calls the file_manager function - populate_send_file_folder which refreshes the files available to send from the 'tool_box' folder.
         Displays the files available to send.
 
         Args:
             client_id (str): The ID of the client.
+            delta (bool): Only send the changes to the client's existing copy.
         """
         self._file_manager.populate_send_files_folder()
-        self.display_files_available_to_send(client_id)
+        self.display_files_available_to_send(client_id, delta)
 
-    def display_files_available_to_send(self, client_id):
+    def display_files_available_to_send(self, client_id, delta=False):
         """
         Checks there are files in the 'tool_box' folder and prints to the screen. If not, tells the user no
         files are available i.e. no files in the 'tool_box' folder.
 
         Args:
             client_id (int): The ID of the client.
+            delta (bool): Only send the changes to the client's existing copy.
         """
         if len(self._file_manager._files_in_send_folder) == 0:
             print(Back.RED + "No files available, please put files in 'tool_box' folder\n")
@@ -729,7 +1823,7 @@ class CreateController(SetupController):
                 print("{}    {}".format(id, file))
             file_id = int(input("\nEnter file ID to send: "))
             if self.check_file_id_exists(file_id):
-                self.send_file_to_client(client_id, self._file_manager._files_in_send_folder[file_id])
+                self.send_file_to_client(client_id, self._file_manager._files_in_send_folder[file_id], delta)
 
     def check_file_id_exists(self, file_id):
         """
@@ -744,32 +1838,120 @@ class CreateController(SetupController):
             print(Back.RED + "\nFile ID does not exist")
             time.sleep(2)
     
-    def send_file_to_client(self, client_id, file_path_to_send):
+    def send_file_to_client(self, client_id, file_path_to_send, delta=False):
         """
         Final step in the send file chain to send the selected file to the client.
 
         Args:
             file_id (str): The ID of the file to send.
             file_path_to_send (str): Full filepath of file to send retrieved by the file_manager
+            delta (bool): Only send the changes to the client's existing copy, framed clients only.
         """
         try:
-            with open(f"./tool_box/{file_path_to_send}", 'rb') as file_to_send:
-                file_name = os.path.basename(file_path_to_send).encode()
-                fileb64 = b64encode(file_to_send.read())                                     
-                construct_data_to_send = b"sendfile|" + file_name + b"|" + fileb64 + b"<EOM488965>"
-                self._connection_list[client_id].send(construct_data_to_send)
-                self._server_logger.logger.info("File {} transferred to {}".format(
-                    file_path_to_send, self._address_list[client_id][0]))
-                time.sleep(2)
-                print(Back.GREEN + "File sent successfully")
-                time.sleep(2)
-                os.system("clear")
+            if delta and self.get_session(client_id).stream.framed:
+                self.delta_file_to_client(client_id, file_path_to_send)
+            elif self.get_session(client_id).stream.framed:
+                self.stream_file_to_client(client_id, file_path_to_send)
+            else:
+                with open(f"./tool_box/{file_path_to_send}", 'rb') as file_to_send:
+                    file_name = os.path.basename(file_path_to_send).encode()
+                    fileb64 = b64encode(file_to_send.read())                                     
+                    self.send_data_to_client(client_id, b"sendfile|" + file_name + b"|" + fileb64,
+                                             expect_reply=False)
+            self._server_logger.logger.info("File {} transferred to {}".format(
+                file_path_to_send, self.get_session(client_id).address[0]))
+            time.sleep(2)
+            print(Back.GREEN + "File sent successfully")
+            time.sleep(2)
+            os.system("clear")
         except Exception as err:
             self._server_logger.logger.info("Error sending file {} to client {}".format(
-                file_path_to_send, self._address_list[client_id][0]))
+                file_path_to_send, self.get_session(client_id).address[0]))
             self._server_logger.logger.info(str(err))
             print(Back.RED + "Error: file not sent. Please check sever.log")
 
+    def stream_file_to_client(self, client_id, file_path_to_send):
+        """
+        Streams a file from the 'tool_box' folder to the client as raw chunks of TRANSFER_CHUNK_SIZE bytes.
+        Each chunk is handed to the event loop and drained before the next is read, so memory use stays
+        flat whatever the file size.
+
+        Args:
+            client_id (int): The ID of the client.
+            file_path_to_send (str): Filename of the file to send from the 'tool_box' folder
+
+        Raises:
+            IOError: If the client reports that the file could not be saved.
+        """
+        full_path = f"./tool_box/{file_path_to_send}"
+        file_size = os.path.getsize(full_path)
+        request_id = self.send_data_to_client(client_id, "putfile|{}|{}".format(
+            os.path.basename(file_path_to_send), file_size))
+        with open(full_path, "rb") as file_to_send, tqdm.tqdm(total=file_size, unit="B", unit_scale=True,
+                                                              desc="Sending", file=sys.stdout) as progress:
+            for chunk in iter(lambda: file_to_send.read(TRANSFER_CHUNK_SIZE), b""):
+                self.send_chunk_to_client(client_id, request_id, chunk)
+                progress.update(len(chunk))
+        self.send_chunk_to_client(client_id, request_id, b"", msg_type=MSG_END)
+        reply = self.receive_data_from_clients(client_id, request_id)
+        if not reply.startswith("putfile|ok"):
+            raise IOError("Client could not save file: {}".format(reply))
+
+    def delta_file_to_client(self, client_id, file_path_to_send):
+        """
+        Updates the client's copy of a file from the 'tool_box' folder rsync style. The client sends
+        signatures of the blocks of its copy, then the file is sent as literal data for the parts the
+        client does not have and references to the blocks it does, followed by the SHA256 of the file.
+        The file is memory mapped so it is never read into memory whole.
+
+        Args:
+            client_id (int): The ID of the client.
+            file_path_to_send (str): Filename of the file to send from the 'tool_box' folder
+
+        Raises:
+            IOError: If the client reports that the file could not be rebuilt.
+        """
+        full_path = f"./tool_box/{file_path_to_send}"
+        file_size = os.path.getsize(full_path)
+        request_id = self.send_data_to_client(client_id, "putdelta|{}|{}".format(
+            os.path.basename(file_path_to_send), file_size))
+        try:
+            block_size = int(self.receive_message_from_client(client_id, request_id).payload.decode().split("|")[1])
+            table = load_signatures(iter(lambda: self.receive_signatures_from_client(client_id, request_id), None))
+            sent = literal = 0
+            with open(full_path, "rb") as file_to_send, \
+                    mmap.mmap(file_to_send.fileno(), 0, access=mmap.ACCESS_READ) if file_size else nullcontext(b"") as data:
+                for batch, literal_bytes in generate_delta(data, table, block_size or 1):
+                    self.send_chunk_to_client(client_id, request_id, batch)
+                    sent += len(batch)
+                    literal += literal_bytes
+                digest = hashlib.sha256(data).hexdigest()
+            self.send_chunk_to_client(client_id, request_id, digest, msg_type=MSG_END)
+            reply = self.receive_message_from_client(client_id, request_id).payload.decode()
+        finally:
+            self.close_client_request(client_id, request_id)
+        if not reply.startswith("putdelta|ok"):
+            raise IOError("Client could not update file: {}".format(reply))
+        reused_blocks = (file_size - literal) // block_size if block_size else 0
+        print(Back.GREEN + "Sent {:.1f} KB for a {:.1f} KB file, {:.1f} KB of literal data and {} reused blocks".format(
+            sent / 1024, file_size / 1024, literal / 1024, reused_blocks))
+
+    def receive_signatures_from_client(self, client_id, request_id):
+        """
+        Receives the next batch of block signatures for a delta, None once the client has sent them all.
+
+        Args:
+            client_id (int): The ID of the client.
+            request_id (int): The request ID returned by send_data_to_client.
+
+        Returns:
+            bytes: A batch of packed signatures, or None at the end of the signatures.
+        """
+        message = self.receive_message_from_client(client_id, request_id)
+        if message.msg_type == MSG_END:
+            return None
+        return message.payload
+
     #The following functions are used to get a file from the client
 
     def get_file_name_to_download(self, client_id):
@@ -793,54 +1975,156 @@ class CreateController(SetupController):
             client_id (str): The ID of the file to send.
             file_path_to_download (str): The full file path of the file to get from the client.
         """
-        construct_data_to_send = "checkfile|" + file_path_to_download + "<EOM488965>"
-        self._connection_list[client_id].send(str.encode(construct_data_to_send))
-        if self.recv_file_check_from_client(client_id):
+        request_id = self.send_data_to_client(client_id, "checkfile|" + file_path_to_download)
+        if self.recv_file_check_from_client(client_id, request_id):
             print(Back.GREEN + "File exists on client")
             self.request_file_from_client(client_id, file_path_to_download)
         else:
             print(Back.RED + "Permission denied or file does not exist on client,"
                   "please try again or 'exit'")
 
-    def recv_file_check_from_client(self, client_id):
+    def recv_file_check_from_client(self, client_id, request_id):
         """
         Receive the check file exists message from the client. The client will send 1 if it exists or 0 if
         it does not (or permission denied).
 
         Args:
             client_id (str): The ID of the file to send.
+            request_id (int): The request ID returned by send_data_to_client.
         """
-        recv_data = self.receive_data_from_clients(client_id)
+        recv_data = self.receive_data_from_clients(client_id, request_id)
         if recv_data.split("|")[1] == "1":
             return True
         else: return False
 
     def request_file_from_client(self, client_id, file_path_to_download):
         """
-        Receive the file from the client after checks. Client will base64 encode, so function will
-        encode back to bytes and base64 decode to handle special characters in original binary encoding.
+        Receive the file from the client after checks. Framed clients stream the raw file in chunks, legacy
+        clients base64 encode, so function will encode back to bytes and base64 decode to handle special
+        characters in original binary encoding.
 
         Args:
             client_id (str): The ID of the file to send.
             file_path_to_download (str): The full file path of the file to get from the client
         """
         print(Back.YELLOW + "Requesting {} from client".format(file_path_to_download))
+        save_path = f"./downloaded_files/{os.path.basename(file_path_to_download)}"
         try:
-            construct_data_to_send = "request|" + file_path_to_download + "<EOM488965>"
-            self._connection_list[client_id].send(str.encode(construct_data_to_send))
-            time.sleep(1)
-            recv_data = self.receive_data_from_clients(client_id)
-            if recv_data.startswith("send|"):
-                recv_data = recv_data.split("|")[1]
-                recv_data = recv_data.encode()
-                recv_data = b64decode(recv_data)
-                with open(f"./downloaded_files/{os.path.basename(file_path_to_download)}", "wb") as file:
-                    file.write(recv_data)
-                    if os.path.exists(f"./downloaded_files/{os.path.basename(file_path_to_download)}"):
-                        print(Back.GREEN + "File received and saved {}".format(
-                            f"./downloaded_files/{os.path.basename(file_path_to_download)}"))
-                    else:
-                        print(Back.RED + "Failed to download, please try again")
+            if self.get_session(client_id).stream.framed:
+                self.stream_file_from_client(client_id, file_path_to_download, save_path)
+            else:
+                request_id = self.send_data_to_client(client_id, "request|" + file_path_to_download)
+                recv_data = self.receive_data_from_clients(client_id, request_id)
+                if recv_data.startswith("send|"):
+                    recv_data = recv_data.split("|")[1]
+                    recv_data = recv_data.encode()
+                    recv_data = b64decode(recv_data)
+                    with open(save_path, "wb") as file:
+                        file.write(recv_data)
+            if os.path.exists(save_path):
+                print(Back.GREEN + "File received and saved {}".format(save_path))
+            else:
+                print(Back.RED + "Failed to download, please try again")
         except Exception as err:
             print(Back.RED + "Error downloading file")
             print(str(err))
+
+    def stream_file_from_client(self, client_id, file_path_to_download, save_path):
+        """
+        Receives a file the client streams as raw chunks into a '.part' file beside save_path, so the
+        whole file is never held in memory. Every TRANSFER_JOURNAL_INTERVAL bytes the partial file is
+        synced to disk and a journal records how much of it is saved, so if the download is interrupted
+        it resumes from there the next time the file is requested from the same client. The file is
+        only renamed to save_path once its SHA256 matches the one sent by the client.
+
+        Args:
+            client_id (int): The ID of the client.
+            file_path_to_download (str): The full file path of the file to get from the client
+            save_path (str): Where to save the file on the server
+
+        Raises:
+            IOError: If the client reports an error reading the file or the checksums do not match.
+        """
+        client_ip = self.get_session(client_id).address[0]
+        part_path = save_path + ".part"
+        journal_path = part_path + ".journal"
+        offset = self._file_manager.load_transfer_journal(journal_path, client_ip, file_path_to_download)
+        with open(part_path, "r+b" if offset else "w+b") as part:
+            part.truncate(offset)
+            hasher = hashlib.sha256()
+            for block in iter(lambda: part.read(TRANSFER_CHUNK_SIZE), b""):
+                hasher.update(block)
+            request_id = self.send_data_to_client(client_id, "getrange|{}|0|{}|{}".format(
+                offset, hasher.hexdigest(), file_path_to_download))
+            received = offset
+            try:
+                reply = self.receive_message_from_client(client_id, request_id)
+                if reply.msg_type == MSG_ERROR:
+                    raise IOError(reply.payload.decode())
+                _, file_size, start = reply.payload.decode().split("|")
+                received = int(start)
+                if received != offset:
+                    part.truncate(received)
+                    hasher = hashlib.sha256()
+                elif offset:
+                    print(Back.YELLOW + "Resuming download from byte {}".format(offset))
+                part.seek(received)
+                journalled = received
+                with tqdm.tqdm(total=int(file_size), initial=received, unit="B", unit_scale=True,
+                               desc="Receiving", file=sys.stdout) as progress:
+                    while True:
+                        message = self.receive_message_from_client(client_id, request_id)
+                        if message.msg_type == MSG_END:
+                            break
+                        if message.msg_type == MSG_ERROR:
+                            raise IOError(message.payload.decode())
+                        part.write(message.payload)
+                        hasher.update(message.payload)
+                        received += len(message.payload)
+                        progress.update(len(message.payload))
+                        if received - journalled >= TRANSFER_JOURNAL_INTERVAL:
+                            self.journal_partial_download(part, journal_path, client_ip, file_path_to_download, received)
+                            journalled = received
+            except Exception:
+                if received:
+                    self.journal_partial_download(part, journal_path, client_ip, file_path_to_download, received)
+                raise
+            finally:
+                self.close_client_request(client_id, request_id)
+        if message.payload.decode() != hasher.hexdigest():
+            os.remove(part_path)
+            self.remove_transfer_journal(journal_path)
+            raise IOError("SHA256 of {} does not match the client, the download has been discarded".format(
+                file_path_to_download))
+        os.replace(part_path, save_path)
+        self.remove_transfer_journal(journal_path)
+        self._server_logger.logger.info("Downloaded {} from {} with matching SHA256 {}".format(
+            file_path_to_download, client_ip, hasher.hexdigest()))
+
+    def journal_partial_download(self, part, journal_path, client_ip, file_path_to_download, received):
+        """
+        Syncs a partial download to disk and records how many bytes of it are saved.
+
+        Args:
+            part (file): The open '.part' file.
+            journal_path (str): The journal beside the '.part' file.
+            client_ip (str): The IP address of the client the file is downloaded from.
+            file_path_to_download (str): The path of the file on the client.
+            received (int): The number of bytes written to the '.part' file.
+        """
+        part.flush()
+        os.fsync(part.fileno())
+        self._file_manager.save_transfer_journal(journal_path, client_ip, file_path_to_download, received)
+
+    @staticmethod
+    def remove_transfer_journal(journal_path):
+        """
+        Removes the journal of a download that has finished or been discarded.
+
+        Args:
+            journal_path (str): The journal beside the '.part' file.
+        """
+        try:
+            os.remove(journal_path)
+        except FileNotFoundError:
+            pass
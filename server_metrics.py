@@ -0,0 +1,309 @@
+"""
+Numeric instrumentation of the server, exposed in the Prometheus text format.
+
+ServerMetrics keeps counters and histograms of the commands sent to clients, the bytes sent and
+received per client and per command, the connections accepted and how long their TLS handshake and
+protocol negotiation took, and heartbeat round trip times. They are rendered on demand, for scrapes
+of a local HTTP endpoint and for a snapshot file rewritten periodically, which can also be read by the
+node_exporter textfile collector. Every update is a few dict operations under one lock, so recording
+costs the event loop next to nothing however many clients are connected.
+"""
+
+import asyncio
+import bisect
+import os
+import threading
+import time
+from collections import Counter
+
+METRICS_HOST = "127.0.0.1"
+METRICS_SNAPSHOT_INTERVAL = 60
+METRICS_SCRAPE_TIMEOUT = 5
+METRICS_PREFIX = "pyprober_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+#Histogram bucket upper bounds in seconds, from a loopback round trip to a long running stream
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class Histogram():
+    """
+    Histogram counts observations in buckets with fixed upper bounds, as a Prometheus histogram.
+
+    Attributes:
+        bounds (tuple): The bucket upper bounds, ascending.
+        counts (list): Observations per bucket, non cumulative, the last bucket is +Inf.
+        total (float): The sum of the observations.
+        count (int): The number of observations.
+    """
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        """
+        Records an observation in the first bucket whose bound is at least the value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.counts, histogram.total, histogram.count = list(self.counts), self.total, self.count
+        return histogram
+
+class ClientMetrics():
+    """
+    ClientMetrics is the view of ServerMetrics given to one client's AsyncProtocolStream, which reports
+    the bytes of every message and the outcome of every request through it.
+
+    Attributes:
+        client (str): The IP address of the client.
+        _metrics (ServerMetrics): The metrics of the server.
+    """
+    __slots__ = ("client", "_metrics")
+
+    def __init__(self, metrics, client):
+        self.client = client
+        self._metrics = metrics
+
+    def count_bytes(self, command, sent, received) -> None:
+        self._metrics.count_bytes(self.client, command, sent, received)
+
+    def observe_request(self, command, outcome, seconds) -> None:
+        self._metrics.observe_request(command, outcome, seconds)
+
+class ServerMetrics():
+    """
+    ServerMetrics holds the server's counters and histograms. Every method is safe to call from any thread.
+
+    Attributes:
+        _lock (Lock): Serialises updates and the copy taken to render them.
+        _started (float): The wall clock time the server started.
+        _requests (Counter): (command, outcome) to the number of requests.
+        _latency (dict): Command to a Histogram of the seconds from sending it to its last reply.
+        _command_bytes (Counter): (command, direction) to bytes, direction is 'sent' or 'received'.
+        _client_bytes (Counter): (client, direction) to bytes.
+        _connections (Counter): Outcome to the number of accepted connections, 'authorised', 'rejected' or 'failed'.
+        _handshake (Histogram): Seconds taken by the TLS handshake and protocol negotiation.
+        _heartbeats (Counter): Outcome to the number of heartbeats, 'answered' or 'missed'.
+        _heartbeat_rtt (Histogram): Heartbeat round trip times in seconds.
+        _gauges (dict): Name to a (description, function) pair, the function is called at render time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._requests = Counter()
+        self._latency = {}
+        self._command_bytes = Counter()
+        self._client_bytes = Counter()
+        self._connections = Counter()
+        self._handshake = Histogram()
+        self._heartbeats = Counter()
+        self._heartbeat_rtt = Histogram()
+        self._gauges = {}
+
+    def client(self, client) -> ClientMetrics:
+        """
+        Returns the observer to give the stream of a client.
+
+        Args:
+            client (str): The IP address of the client.
+        """
+        return ClientMetrics(self, client)
+
+    def add_gauge(self, name, description, function) -> None:
+        """
+        Adds a gauge whose value is read when the metrics are rendered.
+
+        Args:
+            name (str): The metric name without the prefix, i.e. 'sessions'.
+            description (str): The HELP text of the metric.
+            function (callable): Returns the current value.
+        """
+        self._gauges[name] = (description, function)
+
+    def count_bytes(self, client, command, sent, received) -> None:
+        """
+        Adds the bytes of a message to the totals of its client and command.
+
+        Args:
+            client (str): The IP address of the client.
+            command (str): The command the message belongs to.
+            sent (int): Bytes sent to the client, including framing.
+            received (int): Bytes received from the client, including framing.
+        """
+        with self._lock:
+            if sent:
+                self._command_bytes[(command, "sent")] += sent
+                self._client_bytes[(client, "sent")] += sent
+            if received:
+                self._command_bytes[(command, "received")] += received
+                self._client_bytes[(client, "received")] += received
+
+    def observe_request(self, command, outcome, seconds) -> None:
+        """
+        Records a finished request.
+
+        Args:
+            command (str): The command name, i.e. 'disk'.
+            outcome (str): 'ok', 'error', 'noreply', 'sent' or 'disconnected'.
+            seconds (float): The seconds from sending the command to its last reply, None if it had no reply.
+        """
+        with self._lock:
+            self._requests[(command, outcome)] += 1
+            if seconds is not None:
+                histogram = self._latency.get(command)
+                if histogram is None:
+                    histogram = self._latency[command] = Histogram()
+                histogram.observe(seconds)
+
+    def observe_connection(self, outcome, seconds=None) -> None:
+        """
+        Records an accepted connection.
+
+        Args:
+            outcome (str): 'authorised', 'rejected' or 'failed'.
+            seconds (float): The seconds the handshake and negotiation took, None if there was none.
+        """
+        with self._lock:
+            self._connections[outcome] += 1
+            if seconds is not None:
+                self._handshake.observe(seconds)
+
+    def observe_heartbeat(self, seconds) -> None:
+        """
+        Records a heartbeat.
+
+        Args:
+            seconds (float): The round trip time, None if the client did not answer.
+        """
+        with self._lock:
+            if seconds is None:
+                self._heartbeats["missed"] += 1
+            else:
+                self._heartbeats["answered"] += 1
+                self._heartbeat_rtt.observe(seconds)
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        with self._lock:
+            requests, command_bytes = Counter(self._requests), Counter(self._command_bytes)
+            client_bytes, connections, heartbeats = Counter(self._client_bytes), Counter(self._connections), Counter(self._heartbeats)
+            latency = {command:histogram.copy() for command, histogram in self._latency.items()}
+            handshake, heartbeat_rtt = self._handshake.copy(), self._heartbeat_rtt.copy()
+        lines = []
+        self.render_family(lines, "requests_total", "counter", "Commands sent to clients by command and outcome.",
+                           [((("command", command), ("outcome", outcome)), count) for (command, outcome), count in sorted(requests.items())])
+        self.render_family(lines, "request_duration_seconds", "histogram", "Seconds from sending a command to its last reply.",
+                           [((("command", command),), histogram) for command, histogram in sorted(latency.items())])
+        self.render_family(lines, "command_bytes_total", "counter", "Bytes on the wire by command and direction.",
+                           [((("command", command), ("direction", direction)), count) for (command, direction), count in sorted(command_bytes.items())])
+        self.render_family(lines, "client_bytes_total", "counter", "Bytes on the wire by client and direction.",
+                           [((("client", client), ("direction", direction)), count) for (client, direction), count in sorted(client_bytes.items())])
+        self.render_family(lines, "connections_total", "counter", "Accepted connections by outcome.",
+                           [((("outcome", outcome),), count) for outcome, count in sorted(connections.items())])
+        self.render_family(lines, "handshake_duration_seconds", "histogram", "Seconds taken by the TLS handshake and protocol negotiation.",
+                           (((), handshake),))
+        self.render_family(lines, "heartbeats_total", "counter", "Heartbeats by outcome.",
+                           [((("outcome", outcome),), count) for outcome, count in sorted(heartbeats.items())])
+        self.render_family(lines, "heartbeat_rtt_seconds", "histogram", "Heartbeat round trip times in seconds.",
+                           (((), heartbeat_rtt),))
+        for name, (description, function) in self._gauges.items():
+            self.render_family(lines, name, "gauge", description, (((), function()),))
+        self.render_family(lines, "start_time_seconds", "gauge", "Unix time the server started.", (((), self._started),))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def render_family(lines, name, kind, description, samples) -> None:
+        """
+        Appends a metric family to the rendered lines.
+
+        Args:
+            lines (list): The lines rendered so far.
+            name (str): The metric name without the prefix.
+            kind (str): 'counter', 'gauge' or 'histogram'.
+            description (str): The HELP text.
+            samples (iterable): (labels, value) pairs, labels is a tuple of (name, value) pairs and value
+                a number, or a Histogram for histograms.
+        """
+        name = METRICS_PREFIX + name
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(value.bounds + (float("inf"),), value.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", format_value(bound)),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(value.total)))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), value.count))
+
+    def write_snapshot(self, path) -> None:
+        """
+        Writes the rendered metrics to a file, replacing it in one step so readers never see a partial snapshot.
+
+        Args:
+            path (str): The snapshot file.
+        """
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "w") as snapshot:
+            snapshot.write(self.render())
+        os.replace(temp_path, path)
+
+    async def serve_scrape(self, reader, writer) -> None:
+        """
+        Answers one HTTP request on the metrics endpoint, GET /metrics returns the rendered metrics.
+        This is the client connected callback of asyncio.start_server.
+
+        Args:
+            reader (StreamReader): The request stream.
+            writer (StreamWriter): The response stream.
+        """
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), METRICS_SCRAPE_TIMEOUT)
+            method, path = (request.split(b"\r\n", 1)[0].split(b" ") + [b"", b""])[:2]
+            if method not in (b"GET", b"HEAD"):
+                status, body = "405 Method Not Allowed", ""
+            elif path.split(b"?", 1)[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", self.render()
+            else:
+                status, body = "404 Not Found", ""
+            body = body.encode()
+            writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, CONTENT_TYPE, len(body)).encode())
+            if method != b"HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def format_labels(labels) -> str:
+    """
+    Formats (name, value) label pairs as {name="value",...}, escaping the values.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for name, value in labels) + "}"
+
+def format_value(value) -> str:
+    """
+    Formats a sample value or bucket bound, using Prometheus' spelling of infinity.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
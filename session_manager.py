@@ -0,0 +1,182 @@
+import math
+import threading
+import time
+from collections import deque
+
+RTT_WINDOW = 128
+RTT_EWMA_ALPHA = 0.2
+TELEMETRY_WINDOW = 3600
+TELEMETRY_FIELDS = ("time", "cpu", "memory", "disk", "load")
+
+class RoundTripStatistics():
+    """
+    RoundTripStatistics keeps heartbeat round trip times for one client.
+
+    Attributes:
+        last (float): The most recent round trip time in seconds, None until the first sample.
+        ewma (float): Exponentially weighted moving average of the round trip time in seconds.
+        _samples (deque): The most recent RTT_WINDOW samples, used for the p99.
+    """
+    __slots__ = ("last", "ewma", "_samples")
+
+    def __init__(self):
+        self.last = None
+        self.ewma = None
+        self._samples = deque(maxlen=RTT_WINDOW)
+
+    def add_sample(self, rtt) -> None:
+        """
+        Records a round trip time.
+
+        Args:
+            rtt (float): The round trip time in seconds.
+        """
+        self.last = rtt
+        self.ewma = rtt if self.ewma is None else RTT_EWMA_ALPHA * rtt + (1 - RTT_EWMA_ALPHA) * self.ewma
+        self._samples.append(rtt)
+
+    @property
+    def p99(self) -> float:
+        """
+        Returns the 99th percentile of the recent samples, or None if there are none.
+        """
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[max(0, math.ceil(0.99 * len(ordered)) - 1)]
+
+    def __str__(self) -> str:
+        if self.last is None:
+            return "RTT n/a"
+        return "RTT last {:.1f}ms, ewma {:.1f}ms, p99 {:.1f}ms".format(
+            self.last * 1000, self.ewma * 1000, self.p99 * 1000)
+
+class ClientSession():
+    """
+    ClientSession is the record of one connected client. Traffic counters and the last seen time are
+    kept by the connection's stream as messages cross the wire and read through from here.
+
+    Attributes:
+        session_id (int): The ID of the session, never reused while the server is running.
+        stream (AsyncProtocolStream): The connection of the client.
+        address (tuple): The IP address and port of the client.
+        connected_at (float): The wall clock time the client connected.
+        rtt (RoundTripStatistics): Heartbeat round trip times of the client.
+        telemetry (deque): The most recent TELEMETRY_WINDOW pushed samples, as TELEMETRY_FIELDS tuples.
+        subscription (int): The request ID of the telemetry subscription, None if not subscribed.
+    """
+    __slots__ = ("session_id", "stream", "address", "connected_at", "rtt", "telemetry", "subscription")
+
+    def __init__(self, session_id, stream, address):
+        self.session_id = session_id
+        self.stream = stream
+        self.address = address
+        self.connected_at = time.time()
+        self.rtt = RoundTripStatistics()
+        self.telemetry = deque(maxlen=TELEMETRY_WINDOW)
+        self.subscription = None
+
+    @property
+    def last_seen(self) -> float:
+        """
+        Returns the monotonic time the last message was received from the client.
+        """
+        return self.stream.last_received
+
+    @property
+    def bytes_sent(self) -> int:
+        """
+        Returns the number of bytes sent to the client, after compression.
+        """
+        return self.stream.bytes_sent
+
+    @property
+    def bytes_received(self) -> int:
+        """
+        Returns the number of bytes received from the client, before decompression.
+        """
+        return self.stream.bytes_received
+
+class SessionRegistry():
+    """
+    SessionRegistry is the table of connected clients, keyed by session IDs that stay stable for the
+    life of a session, so removing one client never changes the ID of another. Every method is safe to
+    call from any thread. Iteration uses snapshot, an immutable tuple shared by every reader until the
+    next add or remove, so readers never hold the lock while they work through the sessions.
+
+    Attributes:
+        _lock (Lock): Serialises changes to the table.
+        _sessions (dict): Session ID to ClientSession, in the order clients connected.
+        _next_session_id (int): The ID given to the next session.
+        _snapshot (tuple): The cached snapshot, None after a change.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._next_session_id = 0
+        self._snapshot = None
+
+    def add(self, stream, address) -> ClientSession:
+        """
+        Registers a connected client under a new session ID.
+
+        Args:
+            stream (AsyncProtocolStream): The connection of the client.
+            address (tuple): The IP address and port of the client.
+
+        Returns:
+            ClientSession: The new session.
+        """
+        with self._lock:
+            session = ClientSession(self._next_session_id, stream, address)
+            self._next_session_id += 1
+            self._sessions[session.session_id] = session
+            self._snapshot = None
+        return session
+
+    def remove(self, session_id) -> ClientSession:
+        """
+        Removes a session, removing a session that has already gone does nothing.
+
+        Args:
+            session_id (int): The ID of the session.
+
+        Returns:
+            ClientSession: The removed session, or None if it was not registered.
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._snapshot = None
+        return session
+
+    def get(self, session_id) -> ClientSession:
+        """
+        Looks up a session by ID.
+
+        Args:
+            session_id (int): The ID of the session.
+
+        Returns:
+            ClientSession: The session, or None if it is not registered.
+        """
+        return self._sessions.get(session_id)
+
+    def snapshot(self) -> tuple:
+        """
+        Returns every session at this moment, in the order clients connected.
+
+        Returns:
+            tuple: The registered ClientSession records.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot = tuple(self._sessions.values())
+        return snapshot
+
+    def __contains__(self, session_id) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,318 @@
+"""
+Compares sysinfo, disk and process snapshots of a client.
+
+Every dump folder has an index file listing its snapshots in the order they were saved, one
+'<timestamp>\t<client>\t<filename>' line each. The index is read once and then kept up to date as dumps
+are saved, so finding the latest snapshot of a client and the baseline to compare it with is a lookup
+rather than a listing of the folder. Diffs parse each snapshot once into a dict and compare the dicts,
+so they run in time linear in the size of the snapshots.
+"""
+
+import bisect
+import datetime
+import os
+import threading
+
+SNAPSHOT_INDEX_FILE = ".index"
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+ADDED, REMOVED, CHANGED = "+", "-", "~"
+
+#Labels given to the unlabelled lines at the start of a sysinfo dump, in order
+UNLABELLED_FIELDS = ("OS", "OS version")
+
+class SnapshotIndex():
+    """
+    SnapshotIndex keeps the snapshots in one dump folder keyed by client and timestamp.
+
+    Attributes:
+        folder (str): The dump folder i.e. client_disk_dumps.
+        action_type (str): The suffix of the dump filenames in the folder i.e. disk.
+        _lock (Lock): Serialises changes, dumps are saved from the menu thread and the event loop.
+        _snapshots (dict): Client to a (timestamps, filenames) pair of lists in time order, None until loaded.
+    """
+    def __init__(self, folder, action_type):
+        """
+        Args:
+            folder (str): The dump folder.
+            action_type (str): The suffix of the dump filenames in the folder.
+        """
+        self.folder = folder
+        self.action_type = action_type
+        self._lock = threading.Lock()
+        self._snapshots = None
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.folder, SNAPSHOT_INDEX_FILE)
+
+    def load(self) -> dict:
+        """
+        Reads the index file, building it from the dump filenames if the folder predates it.
+
+        Returns:
+            dict: Client to a (timestamps, filenames) pair of lists in time order.
+        """
+        with self._lock:
+            if self._snapshots is not None:
+                return self._snapshots
+            snapshots = {}
+            try:
+                with open(self.index_path, "r") as index:
+                    for line in index:
+                        parts = line.rstrip("\n").split("\t")
+                        if len(parts) == 3:
+                            self.insert(snapshots, *parts)
+            except FileNotFoundError:
+                entries = []
+                for entry in os.scandir(self.folder):
+                    parsed = self.parse_filename(entry.name) if entry.is_file() else None
+                    if parsed:
+                        entries.append(parsed)
+                entries.sort()
+                with open(self.index_path, "w") as index:
+                    for timestamp, client, filename in entries:
+                        index.write("{}\t{}\t{}\n".format(timestamp, client, filename))
+                        self.insert(snapshots, timestamp, client, filename)
+            self._snapshots = snapshots
+            return snapshots
+
+    def parse_filename(self, filename):
+        """
+        Splits a dump filename built by build_filename into its parts.
+
+        Args:
+            filename (str): i.e. 20240101120000_192.168.50.2_disk
+
+        Returns:
+            tuple: (timestamp, client, filename), None if the name is not a dump of this folder's type.
+        """
+        timestamp, _, rest = filename.partition("_")
+        client, _, action_type = rest.rpartition("_")
+        if len(timestamp) != 14 or not timestamp.isdigit() or not client or action_type != self.action_type:
+            return None
+        return timestamp, client, filename
+
+    @staticmethod
+    def insert(snapshots, timestamp, client, filename) -> None:
+        """
+        Adds a snapshot to the in memory index, keeping each client's snapshots in time order. A dump
+        saved in the same second as the previous one overwrote it, so it replaces its entry.
+        """
+        timestamps, filenames = snapshots.setdefault(client, ([], []))
+        if filenames and filenames[-1] == filename:
+            return
+        position = bisect.bisect_right(timestamps, timestamp)
+        timestamps.insert(position, timestamp)
+        filenames.insert(position, filename)
+
+    def add(self, client, filename) -> None:
+        """
+        Records a snapshot that has been saved to the folder.
+
+        Args:
+            client (str): The IP address of the client.
+            filename (str): The filename the dump was saved to.
+        """
+        parsed = self.parse_filename(filename)
+        if parsed is None:
+            return
+        self.load()
+        with self._lock:
+            self.insert(self._snapshots, *parsed)
+            with open(self.index_path, "a") as index:
+                index.write("{}\t{}\t{}\n".format(*parsed))
+
+    def snapshots(self, client) -> tuple:
+        """
+        Returns a (timestamps, filenames) pair of lists of a client's snapshots, oldest first.
+        """
+        return self.load().get(client, ([], []))
+
+    def find_pair(self, client, baseline="1") -> tuple:
+        """
+        Finds a client's latest snapshot and the snapshot to compare it with.
+
+        Args:
+            client (str): The IP address of the client.
+            baseline (str): How many snapshots back to compare with, or a timestamp prefix i.e. 20240101 to
+                compare with the last snapshot taken at or before it.
+
+        Returns:
+            tuple: (baseline filename, latest filename)
+
+        Raises:
+            LookupError: If the client does not have the snapshots needed.
+        """
+        timestamps, filenames = self.snapshots(client)
+        if len(filenames) < 2:
+            raise LookupError("{} has {} {} snapshot(s), 2 are needed to compare".format(
+                client, len(filenames), self.action_type))
+        if len(baseline) < 8:
+            back = int(baseline)
+            if not 0 < back < len(filenames):
+                raise LookupError("{} has {} earlier {} snapshot(s)".format(client, len(filenames) - 1, self.action_type))
+            return filenames[-1 - back], filenames[-1]
+        position = bisect.bisect_right(timestamps, baseline.ljust(14, "9"), 0, len(timestamps) - 1)
+        if position == 0:
+            raise LookupError("{} has no {} snapshot at or before {}".format(client, self.action_type, baseline))
+        return filenames[position - 1], filenames[-1]
+
+    def read(self, filename) -> str:
+        """
+        Returns the contents of a snapshot in the folder.
+        """
+        with open(os.path.join(self.folder, filename), "r") as snapshot:
+            return snapshot.read()
+
+def snapshot_time(filename) -> datetime.datetime:
+    """
+    Returns the time a snapshot was taken from its filename.
+    """
+    return datetime.datetime.strptime(filename[:14], TIMESTAMP_FORMAT)
+
+def parse_processes(data) -> dict:
+    """
+    Parses a process dump, either a process table with a header row or a legacy 'PID: 1, Name: init' list.
+
+    Args:
+        data (str): The dump text.
+
+    Returns:
+        dict: PID to a (name, start time, rss kB) tuple, start time and rss are None for legacy dumps.
+    """
+    processes = {}
+    lines = data.splitlines()
+    if lines and lines[0].startswith("pid\t"):
+        columns = lines[0].split("\t")
+        pid_column, comm_column = columns.index("pid"), columns.index("comm")
+        start_column, rss_column = columns.index("start_time"), columns.index("rss_kb")
+        for line in lines[1:]:
+            row = line.split("\t")
+            if len(row) == len(columns):
+                processes[row[pid_column]] = (row[comm_column], row[start_column], int(row[rss_column] or 0))
+        return processes
+    for line in lines:
+        pid, _, name = line.partition(", Name: ")
+        if pid.startswith("PID: "):
+            processes[pid[5:]] = (name, None, None)
+    return processes
+
+def diff_processes(baseline, latest) -> list:
+    """
+    Lists the processes that started and exited between two process dumps. A PID counts as the same
+    process if its name and, where both dumps have them, its start time are unchanged, so a reused
+    PID shows as one process exiting and another starting.
+
+    Args:
+        baseline (str): The earlier dump.
+        latest (str): The later dump.
+
+    Returns:
+        list: (ADDED|REMOVED|CHANGED, description) tuples.
+    """
+    before, after = parse_processes(baseline), parse_processes(latest)
+    changes = []
+    started = []
+    for pid, (name, start_time, rss_kb) in after.items():
+        previous = before.get(pid)
+        if (previous is None or previous[0] != name or
+                (start_time is not None and previous[1] is not None and previous[1] != start_time)):
+            started.append(pid)
+            changes.append((ADDED, "{} {}{}".format(pid, name, " started {}".format(start_time) if start_time else "")))
+    restarted = set(started)
+    for pid, (name, _, _) in before.items():
+        if pid not in after or pid in restarted:
+            changes.append((REMOVED, "{} {}".format(pid, name)))
+    before_rss = sum(process[2] or 0 for process in before.values())
+    after_rss = sum(process[2] or 0 for process in after.values())
+    changes.append((CHANGED, "{} -> {} processes, {} started, {} exited".format(
+        len(before), len(after), len(started), sum(1 for change in changes if change[0] == REMOVED))))
+    if before_rss and after_rss:
+        changes.append((CHANGED, "Resident memory {} kB -> {} kB ({:+d} kB)".format(
+            before_rss, after_rss, after_rss - before_rss)))
+    return changes
+
+def parse_fields(data) -> dict:
+    """
+    Parses a sysinfo or disk dump into its 'Label: value' fields. Unlabelled lines are named from
+    UNLABELLED_FIELDS, then by line number.
+
+    Args:
+        data (str): The dump text.
+
+    Returns:
+        dict: Label to value, in the order of the dump.
+    """
+    fields = {}
+    unlabelled = 0
+    for number, line in enumerate(data.splitlines(), 1):
+        line = line.strip()
+        label, separator, value = line.partition(":")
+        if separator and label:
+            fields[label.strip()] = value.strip()
+        elif line:
+            fields[UNLABELLED_FIELDS[unlabelled] if unlabelled < len(UNLABELLED_FIELDS) else "Line {}".format(number)] = line
+            unlabelled += 1
+    return fields
+
+def split_quantity(value):
+    """
+    Splits a value such as '6147400 kB' into (6147400.0, 'kB').
+
+    Returns:
+        tuple: (number, unit), None if the value does not start with a number.
+    """
+    number, _, unit = value.partition(" ")
+    try:
+        return float(number), unit.strip()
+    except ValueError:
+        return None
+
+def diff_fields(baseline, latest, elapsed_days=None) -> list:
+    """
+    Lists the fields added, removed or changed between two sysinfo or disk dumps. Numeric fields
+    show the change and, if elapsed_days is given, the change per day.
+
+    Args:
+        baseline (str): The earlier dump.
+        latest (str): The later dump.
+        elapsed_days (float): The days between the dumps, None to leave out rates.
+
+    Returns:
+        list: (ADDED|REMOVED|CHANGED, description) tuples.
+    """
+    before, after = parse_fields(baseline), parse_fields(latest)
+    changes = []
+    for label, value in after.items():
+        previous = before.get(label)
+        if previous is None:
+            changes.append((ADDED, "{}: {}".format(label, value)))
+        elif previous != value:
+            old, new = split_quantity(previous), split_quantity(value)
+            if old and new and old[1] == new[1]:
+                delta = new[0] - old[0]
+                rate = ", {:+.2f} {}/day".format(delta / elapsed_days, new[1]) if elapsed_days else ""
+                changes.append((CHANGED, "{}: {} -> {} ({:+g} {}{})".format(label, previous, value, round(delta, 2), new[1], rate)))
+            else:
+                changes.append((CHANGED, "{}: {} -> {}".format(label, previous, value)))
+    for label, value in before.items():
+        if label not in after:
+            changes.append((REMOVED, "{}: {}".format(label, value)))
+    return changes
+
+def diff_snapshots(action_type, baseline, latest, elapsed_days=None) -> list:
+    """
+    Compares two snapshots of the same type.
+
+    Args:
+        action_type (str): 'processes', 'sysinfo' or 'disk'.
+        baseline (str): The earlier snapshot.
+        latest (str): The later snapshot.
+        elapsed_days (float): The days between the snapshots, used for the disk growth rate.
+
+    Returns:
+        list: (ADDED|REMOVED|CHANGED, description) tuples.
+    """
+    if action_type == "processes":
+        return diff_processes(baseline, latest)
+    return diff_fields(baseline, latest, elapsed_days if action_type == "disk" else None)
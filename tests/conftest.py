@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The modules live beside each other at the top of the repository, as they do on the server and clients
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
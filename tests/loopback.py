@@ -0,0 +1,119 @@
+"""
+Runs a real server on 127.0.0.1 in a temporary folder for tests that drive the controller end to end
+over TLS. Clients run on threads of the test process and share the folder as their working directory.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import server_controller
+from client import Client
+from create_server import CreateServer
+from file_manager import CreateFileManager
+from log_controller import CreateLogger
+from protocol import ProtocolError
+from server_controller import CreateController
+
+CONNECT_TIMEOUT = 30
+
+#Certificates created by the first server, copied to the others so openssl only runs once
+_certificates = {}
+
+def quietly():
+    """
+    Returns a context manager that swallows the progress the server and clients print.
+    """
+    return contextlib.redirect_stdout(io.StringIO())
+
+class LoopbackClient(Client):
+    """
+    LoopbackClient is a Client that stops quietly once its connection is closed.
+    """
+    def run(self) -> None:
+        try:
+            self.ready_to_receive()
+        except (OSError, ProtocolError):
+            pass
+
+@unittest.skipUnless(shutil.which("openssl"), "openssl is needed to create the server certificates")
+class LoopbackTestCase(unittest.TestCase):
+    """
+    LoopbackTestCase starts one server per test class.
+
+    Attributes:
+        heartbeat (tuple): (interval, timeout) in seconds to run the heartbeat with, None keeps the defaults.
+        folder (str): The temporary folder the server and clients run in.
+        controller (CreateController): The controller of the server.
+        port (int): The port the server listens on.
+    """
+    heartbeat = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls._cwd = os.getcwd()
+        cls.folder = tempfile.mkdtemp(prefix="loopback_test_")
+        os.chdir(cls.folder)
+        with open("authorised_ips.txt", "w") as authorised_ips:
+            authorised_ips.write("127.0.0.1\n")
+        for name, certificate in _certificates.items():
+            shutil.copy(certificate, name)
+        cls._heartbeat = server_controller.HEARTBEAT_INTERVAL, server_controller.HEARTBEAT_TIMEOUT
+        if cls.heartbeat:
+            server_controller.HEARTBEAT_INTERVAL, server_controller.HEARTBEAT_TIMEOUT = cls.heartbeat
+        cls._loggers = CreateLogger("server"), CreateLogger("auth")
+        with quietly():
+            cls.controller = CreateController(cls._loggers[0], cls._loggers[1], CreateFileManager(hash_workers=1))
+            server = CreateServer("127.0.0.1", cls._loggers[0], cls.controller, port=0, interactive=False)
+        cls.port = server.server_port
+        if not _certificates:
+            certificates = tempfile.mkdtemp(prefix="loopback_certificates_")
+            for name in ("cert.pem", "key.pem"):
+                _certificates[name] = shutil.copy(name, certificates)
+
+    @classmethod
+    def tearDownClass(cls):
+        server_controller.HEARTBEAT_INTERVAL, server_controller.HEARTBEAT_TIMEOUT = cls._heartbeat
+        for logger in cls._loggers:
+            logger.logger.removeHandler(logger.handler)
+            logger.handler.close()
+        os.chdir(cls._cwd)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def setUp(self):
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client._socket.close()
+
+    def connect_client(self, client_class=LoopbackClient):
+        """
+        Connects a client and waits for its session to negotiate the framed protocol.
+
+        Args:
+            client_class (type): The LoopbackClient subclass to connect.
+
+        Returns:
+            tuple: (client, session)
+        """
+        known = set(session.session_id for session in self.controller._sessions.snapshot())
+        client = client_class()
+        client._server_ip, client._server_port = "127.0.0.1", self.port
+        client.create_client_socket()
+        client.wrap_socket_tls()
+        client.connect_to_server()
+        self.clients.append(client)
+        threading.Thread(target=client.run, daemon=True).start()
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while time.monotonic() < deadline:
+            for session in self.controller._sessions.snapshot():
+                if session.session_id not in known and session.stream.framed:
+                    return client, session
+            time.sleep(0.05)
+        self.fail("The client did not connect within {}s".format(CONNECT_TIMEOUT))
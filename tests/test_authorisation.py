@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from authorisation import AuthorisedIPIndex
+
+class TestAuthorisedIPIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "authorised_ips.txt")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, *lines):
+        with open(self.path, "w") as ips:
+            ips.write("\n".join(lines) + "\n")
+
+    def test_exact_and_cidr_entries(self):
+        self.write("10.0.0.5", "192.168.50.0/24  # lab", "fd00::/64", "", "not an address", "2001:db8::1")
+        index = AuthorisedIPIndex(self.path)
+        self.assertEqual(index.entries, ["10.0.0.5", "192.168.50.0/24", "fd00::/64", "2001:db8::1"])
+        for ip in ("10.0.0.5", "192.168.50.0", "192.168.50.255", "fd00::1234", "2001:db8:0::1"):
+            self.assertTrue(index.is_authorised(ip), ip)
+        for ip in ("10.0.0.6", "192.168.51.1", "fd00:0:0:1::1", "2001:db8::2", "garbage"):
+            self.assertFalse(index.is_authorised(ip), ip)
+
+    def test_ipv4_mapped_addresses(self):
+        self.write("10.1.0.0/16", "::ffff:172.16.0.9")
+        index = AuthorisedIPIndex(self.path)
+        self.assertTrue(index.is_authorised("::ffff:10.1.2.3"))
+        self.assertTrue(index.is_authorised("172.16.0.9"))
+        self.assertFalse(index.is_authorised("::ffff:10.2.0.1"))
+
+    def test_nested_ranges(self):
+        self.write("10.1.2.0/24", "10.0.0.0/8", "10.200.0.0/16")
+        index = AuthorisedIPIndex(self.path)
+        self.assertTrue(index.is_authorised("10.255.255.255"))
+        self.assertFalse(index.is_authorised("11.0.0.0"))
+
+    def test_missing_file_authorises_nobody(self):
+        index = AuthorisedIPIndex(self.path)
+        self.assertFalse(index.is_authorised("127.0.0.1"))
+
+    def test_changes_are_reloaded(self):
+        self.write("10.0.0.1")
+        index = AuthorisedIPIndex(self.path)
+        self.write("10.0.0.2", "10.0.1.0/24")
+        self.assertTrue(index.refresh(force=True))
+        self.assertFalse(index.is_authorised("10.0.0.1"))
+        self.assertTrue(index.is_authorised("10.0.1.7"))
+        self.assertFalse(index.refresh(force=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import hashlib
+import io
+import os
+import random
+import unittest
+
+from delta_sync import (block_size_for, generate_signatures, load_signatures, generate_delta, apply_delta,
+                        DELTA_MIN_BLOCK_SIZE, DELTA_MAX_BLOCK_SIZE, OP_COPY)
+
+def sync(basis, new, block_size, batch_size=64 * 1024) -> tuple:
+    """
+    Runs a delta transfer of new over basis in memory, as the client and server do over the wire.
+
+    Returns:
+        tuple: (rebuilt bytes, literal bytes sent, operation batches)
+    """
+    table = load_signatures(generate_signatures(io.BytesIO(basis), block_size, batch_size))
+    output, hasher = io.BytesIO(), hashlib.sha256()
+    literal_total = 0
+    batches = []
+    for batch, literal_bytes in generate_delta(new, table, block_size, batch_size):
+        apply_delta(batch, io.BytesIO(basis) if basis else None, output, block_size, hasher)
+        literal_total += literal_bytes
+        batches.append(batch)
+    rebuilt = output.getvalue()
+    assert hasher.hexdigest() == hashlib.sha256(rebuilt).hexdigest()
+    return rebuilt, literal_total, batches
+
+class TestDeltaSync(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(488965)
+        self.basis = bytes(self.random.getrandbits(8) for _ in range(300 * 1024))
+
+    def test_block_size_bounds(self):
+        self.assertEqual(block_size_for(0), DELTA_MIN_BLOCK_SIZE)
+        self.assertEqual(block_size_for(10 * 1024**4), DELTA_MAX_BLOCK_SIZE)
+        self.assertEqual(block_size_for(16 * 1024**2) % 1024, 0)
+
+    def test_identical_file_sends_no_literals(self):
+        rebuilt, literal_bytes, _ = sync(self.basis, self.basis, 4096)
+        self.assertEqual(rebuilt, self.basis)
+        self.assertEqual(literal_bytes, len(self.basis) % 4096)
+
+    def test_edited_file_round_trip(self):
+        new = bytearray(self.basis)
+        new[1000:1010] = b"0123456789"
+        new[50000:50000] = b"inserted bytes shift every later block"
+        del new[200000:201234]
+        new += b"appended tail"
+        new = bytes(new)
+        rebuilt, literal_bytes, _ = sync(self.basis, new, 2048)
+        self.assertEqual(rebuilt, new)
+        self.assertLess(literal_bytes, len(new) // 10)
+
+    def test_no_existing_copy(self):
+        new = os.urandom(100 * 1024)
+        rebuilt, literal_bytes, batches = sync(b"", new, 2048)
+        self.assertEqual(rebuilt, new)
+        self.assertEqual(literal_bytes, len(new))
+        self.assertTrue(all(OP_COPY not in batch[:1] for batch in batches))
+
+    def test_copy_without_basis_rejected(self):
+        _, _, batches = sync(self.basis, self.basis, 4096)
+        with self.assertRaises(ValueError):
+            apply_delta(batches[0], None, io.BytesIO(), 4096, hashlib.sha256())
+
+    def test_copy_past_end_of_basis_rejected(self):
+        _, _, batches = sync(self.basis, self.basis, 4096)
+        with self.assertRaises(ValueError):
+            apply_delta(batches[0], io.BytesIO(self.basis[:4096]), io.BytesIO(), 4096, hashlib.sha256())
+
+    def test_unknown_operation_rejected(self):
+        with self.assertRaises(ValueError):
+            apply_delta(b"X", None, io.BytesIO(), 4096, hashlib.sha256())
+
+if __name__ == '__main__':
+    unittest.main()
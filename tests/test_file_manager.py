@@ -0,0 +1,67 @@
+import io
+import os
+import tempfile
+import unittest
+
+from file_manager import CreateFileManager, KnownGoodHashIndex
+
+class TestKnownGoodHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.hashes_file = os.path.join(self.folder.name, "known_good_binary_hashes.txt")
+        with open(self.hashes_file, "w") as hash_file:
+            hash_file.write("/usr/bin/ls:{}\n/usr/bin/cat:{}\n/usr/bin/ssh:{}\nnot a record\n".format(
+                "aa" * 32, "bb" * 32, "cc" * 32))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_diff(self):
+        index = KnownGoodHashIndex(self.hashes_file)
+        self.assertEqual(len(index), 3)
+        report = io.StringIO()
+        counts = index.diff(["/usr/bin/ls:" + "aa" * 32, "/usr/bin/ssh:" + "dd" * 32, "/tmp/implant:" + "ee" * 32], report)
+        self.assertEqual(counts, {'added':1, 'removed':1, 'modified':1, 'unchanged':1})
+        self.assertEqual(report.getvalue().splitlines(), [
+            "MODIFIED /usr/bin/ssh expected {} got {}".format("cc" * 32, "dd" * 32),
+            "ADDED /tmp/implant {}".format("ee" * 32),
+            "REMOVED /usr/bin/cat"])
+
+    def test_diff_of_identical_scan(self):
+        index = KnownGoodHashIndex(self.hashes_file)
+        report = io.StringIO()
+        counts = index.diff(["/usr/bin/cat:" + "bb" * 32, "/usr/bin/ls:" + "aa" * 32, "/usr/bin/ssh:" + "cc" * 32], report)
+        self.assertEqual(counts, {'added':0, 'removed':0, 'modified':0, 'unchanged':3})
+        self.assertEqual(report.getvalue(), "")
+
+class TestTailLines(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.folder.name, "auth.log")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, data):
+        with open(self.log, "wb") as log:
+            log.write(data)
+
+    def test_last_lines_across_blocks(self):
+        self.write("".join("line {}\n".format(number) for number in range(1000)).encode())
+        self.assertEqual(CreateFileManager.tail_lines(self.log, 5, block_size=16),
+                         ["line {}".format(number) for number in range(995, 1000)])
+
+    def test_short_file(self):
+        self.write(b"only\n\nlines\n")
+        self.assertEqual(CreateFileManager.tail_lines(self.log, 5), ["only", "lines"])
+
+    def test_no_trailing_newline(self):
+        self.write(b"first\nsecond\nthird")
+        self.assertEqual(CreateFileManager.tail_lines(self.log, 2, block_size=4), ["second", "third"])
+
+    def test_empty_file(self):
+        self.write(b"")
+        self.assertEqual(CreateFileManager.tail_lines(self.log, 5), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import server_controller
+from client import Client
+from create_server import CreateServer
+from file_manager import CreateFileManager
+from log_controller import CreateLogger
+from protocol import MSG_RESPONSE, MSG_CHUNK, TRANSFER_CHUNK_SIZE
+from server_controller import CreateController
+
+HEARTBEAT_WINDOW = 1
+CHUNK_DELAY = 0.5
+TRANSFER_CHUNKS = 8
+CONNECT_TIMEOUT = 30
+
+class SlowClient(Client):
+    """
+    SlowClient pauses before every chunk it streams, so a transfer outlasts several heartbeat sweeps.
+    """
+    def send_data(self, data, msg_type=MSG_RESPONSE) -> None:
+        if msg_type == MSG_CHUNK:
+            time.sleep(CHUNK_DELAY)
+        super().send_data(data, msg_type)
+
+@unittest.skipUnless(shutil.which("openssl"), "openssl is needed to create the server certificates")
+class TestTransferOutlastsHeartbeat(unittest.TestCase):
+    """
+    Runs a real server and client over TLS on 127.0.0.1 in a temporary folder, with the heartbeat
+    shortened to HEARTBEAT_WINDOW seconds.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp(prefix="heartbeat_test_")
+        os.chdir(self.folder)
+        with open("authorised_ips.txt", "w") as authorised_ips:
+            authorised_ips.write("127.0.0.1\n")
+        self.heartbeat = server_controller.HEARTBEAT_INTERVAL, server_controller.HEARTBEAT_TIMEOUT
+        server_controller.HEARTBEAT_INTERVAL = server_controller.HEARTBEAT_TIMEOUT = HEARTBEAT_WINDOW
+        self.loggers = CreateLogger("server"), CreateLogger("auth")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.controller = CreateController(self.loggers[0], self.loggers[1], CreateFileManager(hash_workers=1))
+            server = CreateServer("127.0.0.1", self.loggers[0], self.controller, port=0, interactive=False)
+        self.client = SlowClient()
+        self.client._server_ip, self.client._server_port = "127.0.0.1", server.server_port
+        self.client.create_client_socket()
+        self.client.wrap_socket_tls()
+        self.client.connect_to_server()
+        threading.Thread(target=self.client.ready_to_receive, daemon=True).start()
+
+    def tearDown(self):
+        server_controller.HEARTBEAT_INTERVAL, server_controller.HEARTBEAT_TIMEOUT = self.heartbeat
+        for logger in self.loggers:
+            logger.logger.removeHandler(logger.handler)
+            logger.handler.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def wait_for_session(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while time.monotonic() < deadline:
+            sessions = self.controller._sessions.snapshot()
+            if sessions and sessions[0].stream.framed:
+                return sessions[0]
+            time.sleep(0.05)
+        self.fail("The client did not connect within {}s".format(CONNECT_TIMEOUT))
+
+    def test_get_longer_than_heartbeat_window(self):
+        session = self.wait_for_session()
+        source = os.path.join(self.folder, "source.bin")
+        with open(source, "wb") as file:
+            file.write(os.urandom(TRANSFER_CHUNK_SIZE * TRANSFER_CHUNKS))
+        started = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.controller.request_file_from_client(session.session_id, source)
+        self.assertGreater(time.monotonic() - started, HEARTBEAT_WINDOW * 3)
+        self.assertIn(session, self.controller._sessions.snapshot())
+        with open(source, "rb") as expected, open("downloaded_files/source.bin", "rb") as downloaded:
+            self.assertEqual(downloaded.read(), expected.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import socket
+import unittest
+
+import protocol
+from protocol import (ProtocolError, ProtocolStream, AsyncProtocolStream, build_header, parse_header, compress_payload,
+                      decompress_payload, HEADER, MAGIC, MAX_PAYLOAD_SIZE, COMPRESSION_THRESHOLD, MSG_COMMAND, MSG_CHUNK,
+                      MSG_RESPONSE, EOM)
+
+class TestHeader(unittest.TestCase):
+    def test_round_trip(self):
+        header = build_header(MSG_CHUNK, 0x10, 2**32 - 1, MAX_PAYLOAD_SIZE)
+        self.assertEqual(len(header), HEADER.size)
+        self.assertEqual(parse_header(header), (MSG_CHUNK, 0x10, 2**32 - 1, MAX_PAYLOAD_SIZE))
+
+    def test_invalid_magic(self):
+        header = b"XX" + build_header(MSG_COMMAND, 0, 1, 0)[len(MAGIC):]
+        with self.assertRaises(ProtocolError):
+            parse_header(header)
+
+    def test_invalid_version(self):
+        header = HEADER.pack(MAGIC, protocol.LEGACY_PROTOCOL_VERSION, MSG_COMMAND, 0, 1, 0)
+        with self.assertRaises(ProtocolError):
+            parse_header(header)
+
+    def test_oversized_payload(self):
+        with self.assertRaises(ProtocolError):
+            parse_header(build_header(MSG_COMMAND, 0, 1, MAX_PAYLOAD_SIZE + 1))
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip_every_codec(self):
+        payload = b"processes and more processes\n" * 4096
+        for codec in protocol.CODECS:
+            with self.subTest(codec=codec):
+                compressed, flags = compress_payload(codec, payload)
+                self.assertTrue(flags)
+                self.assertLess(len(compressed), len(payload))
+                self.assertEqual(bytes(decompress_payload(flags, compressed)), payload)
+
+    def test_small_payload_sent_as_is(self):
+        payload = b"a" * (COMPRESSION_THRESHOLD - 1)
+        self.assertEqual(compress_payload("zlib", payload), (payload, 0))
+
+    def test_incompressible_payload_sent_as_is(self):
+        payload = os.urandom(64 * 1024)
+        self.assertEqual(compress_payload("zlib", payload), (payload, 0))
+
+    def test_no_codec(self):
+        payload = b"a" * 64 * 1024
+        self.assertEqual(compress_payload(None, payload), (payload, 0))
+
+    def test_unflagged_payload_untouched(self):
+        self.assertEqual(decompress_payload(0, b"raw"), b"raw")
+
+    def test_corrupt_payload(self):
+        with self.assertRaises(ProtocolError):
+            decompress_payload(protocol.FLAG_ZLIB, b"not zlib at all")
+
+class TestProtocolStream(unittest.TestCase):
+    def setUp(self):
+        self.left_socket, self.right_socket = socket.socketpair()
+        self.left, self.right = ProtocolStream(self.left_socket), ProtocolStream(self.right_socket)
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_legacy_messages(self):
+        self.left.send_message("first")
+        self.left.send_message(b"second")
+        self.assertEqual(self.right.receive_message(), (MSG_RESPONSE, 0, 0, b"first"))
+        self.assertEqual(self.right.receive_message(), (MSG_RESPONSE, 0, 0, b"second"))
+
+    def test_legacy_delimiter_split_across_reads(self):
+        self.left_socket.sendall(b"split" + EOM[:4])
+        self.left_socket.sendall(EOM[4:])
+        self.assertEqual(self.right.receive_message().payload, b"split")
+
+    def test_framed_messages(self):
+        self.left.framed = self.right.framed = True
+        large = bytes(range(256)) * 128
+        self.left.send_message("listtree|2|*|/", msg_type=MSG_COMMAND, request_id=7)
+        self.left.send_message(large, msg_type=MSG_CHUNK, request_id=7)
+        self.assertEqual(self.right.receive_message(), (MSG_COMMAND, 0, 7, b"listtree|2|*|/"))
+        message = self.right.receive_message()
+        self.assertEqual((message.msg_type, message.flags, message.request_id), (MSG_CHUNK, 0, 7))
+        self.assertEqual(bytes(message.payload), large)
+
+    def test_compressed_framed_messages(self):
+        for stream in (self.left, self.right):
+            stream.framed, stream.codec = True, "zlib"
+        compressible = b"0123456789" * 20000
+        self.left.send_message(compressible, msg_type=MSG_CHUNK, request_id=7)
+        message = self.right.receive_message()
+        self.assertEqual((message.msg_type, message.flags, message.request_id), (MSG_CHUNK, 0, 7))
+        self.assertEqual(bytes(message.payload), compressible)
+
+    def test_peer_closes_mid_message(self):
+        self.right.framed = True
+        self.left_socket.sendall(build_header(MSG_CHUNK, 0, 1, 100) + b"short")
+        self.left_socket.close()
+        with self.assertRaises(ConnectionError):
+            self.right.receive_message()
+
+class TestAsyncProtocolStream(unittest.TestCase):
+    def run_with_streams(self, test, framed):
+        async def run():
+            left_socket, right_socket = socket.socketpair()
+            server = AsyncProtocolStream(*await asyncio.open_connection(sock=left_socket))
+            client = AsyncProtocolStream(*await asyncio.open_connection(sock=right_socket))
+            server.framed = client.framed = framed
+            server.start_dispatcher()
+            try:
+                await test(server, client)
+            finally:
+                server.close()
+                client.close()
+        asyncio.run(run())
+
+    def test_framed_replies_routed_by_request_id(self):
+        async def test(server, client):
+            first = await server.open_request("sysinfo|")
+            second = await server.open_request("disk|")
+            await client.send_message("disk", request_id=second)
+            await client.send_message("sysinfo", request_id=first)
+            self.assertEqual((await server.next_reply(first, 1)).payload, b"sysinfo")
+            self.assertEqual((await server.next_reply(second, 1)).payload, b"disk")
+        self.run_with_streams(test, True)
+
+    def test_legacy_late_reply_absorbed(self):
+        async def test(server, client):
+            with self.assertRaises(asyncio.TimeoutError):
+                await server.request("sysinfo|", timeout=0.05)
+            request_id = await server.open_request("disk|")
+            await client.send_message("late sysinfo")
+            await client.send_message("disk")
+            self.assertEqual((await server.next_reply(request_id, 1)).payload, b"disk")
+        self.run_with_streams(test, False)
+
+    def test_legacy_unanswered_request_dropped(self):
+        async def test(server, client):
+            with self.assertRaises(asyncio.TimeoutError):
+                await server.request("request|missing", timeout=0.05)
+            await asyncio.sleep(0.1)
+            request_id = await server.open_request("disk|")
+            await client.send_message("disk")
+            self.assertEqual((await server.next_reply(request_id, 1)).payload, b"disk")
+        timeout = protocol.LEGACY_LATE_REPLY_TIMEOUT
+        protocol.LEGACY_LATE_REPLY_TIMEOUT = 0.05
+        try:
+            self.run_with_streams(test, False)
+        finally:
+            protocol.LEGACY_LATE_REPLY_TIMEOUT = timeout
+
+    def test_large_payload_compressed_off_the_loop(self):
+        async def test(server, client):
+            server.codec = client.codec = "zlib"
+            payload = b"abcdefgh" * protocol.COMPRESSION_OFFLOAD_SIZE
+            await server.send_message(payload, msg_type=MSG_CHUNK, request_id=3)
+            message = await client.receive_message()
+            self.assertEqual(bytes(message.payload), payload)
+            self.assertLess(server.bytes_sent, len(payload))
+        self.run_with_streams(test, True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+from snapshot_diff import (SnapshotIndex, SNAPSHOT_INDEX_FILE, ADDED, REMOVED, CHANGED, diff_processes,
+                           diff_fields, diff_snapshots, parse_processes)
+
+PROCESS_HEADER = "pid\tppid\tcomm\tstate\tutime\tstime\trss_kb\tstart_time\n"
+
+class TestDiffs(unittest.TestCase):
+    def test_process_table(self):
+        baseline = PROCESS_HEADER + "1\t0\tinit\tS\t1.00\t0.50\t1000\t100\n" + "42\t1\tsshd\tS\t0.10\t0.10\t2000\t200\n"
+        latest = (PROCESS_HEADER + "1\t0\tinit\tS\t1.00\t0.50\t1000\t100\n" + "42\t1\tnc\tS\t0.00\t0.00\t500\t900\n" +
+                  "77\t1\tcron\tS\t0.00\t0.00\t800\t950\n")
+        changes = diff_processes(baseline, latest)
+        self.assertIn((ADDED, "42 nc started 900"), changes)
+        self.assertIn((ADDED, "77 cron started 950"), changes)
+        self.assertIn((REMOVED, "42 sshd"), changes)
+        self.assertIn((CHANGED, "2 -> 3 processes, 2 started, 1 exited"), changes)
+        self.assertIn((CHANGED, "Resident memory 3000 kB -> 2300 kB (-700 kB)"), changes)
+
+    def test_reused_pid_with_new_start_time(self):
+        baseline = PROCESS_HEADER + "42\t1\tbash\tS\t0\t0\t10\t200\n"
+        latest = PROCESS_HEADER + "42\t1\tbash\tS\t0\t0\t10\t300\n"
+        changes = diff_processes(baseline, latest)
+        self.assertIn((ADDED, "42 bash started 300"), changes)
+        self.assertIn((REMOVED, "42 bash"), changes)
+
+    def test_legacy_process_list(self):
+        self.assertEqual(parse_processes("PID: 1, Name: init\nPID: 2, Name: kthreadd\n"),
+                         {'1':("init", None, None), '2':("kthreadd", None, None)})
+        changes = diff_processes("PID: 1, Name: init\n", "PID: 1, Name: init\nPID: 9, Name: sh\n")
+        self.assertIn((ADDED, "9 sh"), changes)
+
+    def test_fields_with_rates(self):
+        baseline = "Linux\n6.1.0-13-amd64\nTotal: 100 GB\nUsed: 40 GB\nMount: /\n"
+        latest = "Linux\n6.1.0-18-amd64\nTotal: 100 GB\nUsed: 50 GB\nInodes: 10%\n"
+        changes = diff_fields(baseline, latest, elapsed_days=2)
+        self.assertEqual(changes, [
+            (CHANGED, "OS version: 6.1.0-13-amd64 -> 6.1.0-18-amd64"),
+            (CHANGED, "Used: 40 GB -> 50 GB (+10 GB, +5.00 GB/day)"),
+            (ADDED, "Inodes: 10%"),
+            (REMOVED, "Mount: /")])
+
+    def test_rates_only_for_disk(self):
+        baseline, latest = "Used: 40 GB\n", "Used: 50 GB\n"
+        self.assertEqual(diff_snapshots("sysinfo", baseline, latest, 2), [(CHANGED, "Used: 40 GB -> 50 GB (+10 GB)")])
+        self.assertEqual(diff_snapshots("disk", baseline, latest, 2), [(CHANGED, "Used: 40 GB -> 50 GB (+10 GB, +5.00 GB/day)")])
+
+class TestSnapshotIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        for filename in ("20240101120000_10.0.0.1_disk", "20240102120000_10.0.0.1_disk", "20240103120000_10.0.0.1_disk",
+                         "20240102120000_10.0.0.2_disk", "20240102120000_10.0.0.1_sysinfo"):
+            with open(os.path.join(self.folder.name, filename), "w") as dump:
+                dump.write(filename)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_index_built_from_folder(self):
+        index = SnapshotIndex(self.folder.name, "disk")
+        self.assertEqual(index.find_pair("10.0.0.1"), ("20240102120000_10.0.0.1_disk", "20240103120000_10.0.0.1_disk"))
+        self.assertEqual(index.find_pair("10.0.0.1", "2"), ("20240101120000_10.0.0.1_disk", "20240103120000_10.0.0.1_disk"))
+        self.assertEqual(index.find_pair("10.0.0.1", "20240101"), ("20240101120000_10.0.0.1_disk", "20240103120000_10.0.0.1_disk"))
+        self.assertTrue(os.path.exists(os.path.join(self.folder.name, SNAPSHOT_INDEX_FILE)))
+
+    def test_missing_snapshots(self):
+        index = SnapshotIndex(self.folder.name, "disk")
+        with self.assertRaises(LookupError):
+            index.find_pair("10.0.0.2")
+        with self.assertRaises(LookupError):
+            index.find_pair("10.0.0.1", "3")
+        with self.assertRaises(LookupError):
+            index.find_pair("10.0.0.1", "20231231")
+
+    def test_added_snapshots_survive_a_reload(self):
+        SnapshotIndex(self.folder.name, "disk").add("10.0.0.2", "20240104120000_10.0.0.2_disk")
+        index = SnapshotIndex(self.folder.name, "disk")
+        self.assertEqual(index.find_pair("10.0.0.2"), ("20240102120000_10.0.0.2_disk", "20240104120000_10.0.0.2_disk"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import unittest
+
+import loopback
+from protocol import MSG_RESPONSE, MSG_CHUNK, MSG_END, MSG_ERROR, TRANSFER_CHUNK_SIZE
+
+FILE_SIZE = TRANSFER_CHUNK_SIZE * 2 + TRANSFER_CHUNK_SIZE // 2
+CHUNK_SIZES = [TRANSFER_CHUNK_SIZE, TRANSFER_CHUNK_SIZE, TRANSFER_CHUNK_SIZE // 2]
+
+class RecordingClient(loopback.LoopbackClient):
+    """
+    RecordingClient keeps the type, size and start of every message it sends and receives while answering a command.
+    """
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.received = []
+
+    def send_data(self, data, msg_type=MSG_RESPONSE) -> None:
+        data = data.encode() if isinstance(data, str) else data
+        self.sent.append((msg_type, len(data), bytes(data[:64])))
+        super().send_data(data, msg_type)
+
+    def receive_request_message(self):
+        message = super().receive_request_message()
+        self.received.append((message.msg_type, len(message.payload), bytes(message.payload[:64])))
+        return message
+
+def chunk_sizes(messages) -> list:
+    return [size for msg_type, size, _ in messages if msg_type == MSG_CHUNK]
+
+class TestStreamedTransfers(loopback.LoopbackTestCase):
+    def create_file(self, path) -> bytes:
+        data = os.urandom(FILE_SIZE)
+        with open(path, "wb") as file:
+            file.write(data)
+        return data
+
+    def test_put_round_trip(self):
+        client, session = self.connect_client(RecordingClient)
+        data = self.create_file("tool_box/put.bin")
+        with loopback.quietly():
+            self.controller.stream_file_to_client(session.session_id, "put.bin")
+        with open("put.bin", "rb") as saved:
+            self.assertEqual(saved.read(), data)
+        self.assertEqual(chunk_sizes(client.received), CHUNK_SIZES)
+        self.assertEqual(client.received[-1][:2], (MSG_END, 0))
+        self.assertEqual(client.sent, [(MSG_RESPONSE, len("putfile|ok|{}".format(FILE_SIZE)),
+                                        "putfile|ok|{}".format(FILE_SIZE).encode())])
+
+    def test_put_refused_by_client(self):
+        client, session = self.connect_client(RecordingClient)
+        self.create_file("tool_box/refused.bin")
+        os.mkdir("refused.bin")
+        with loopback.quietly(), self.assertRaises(IOError):
+            self.controller.stream_file_to_client(session.session_id, "refused.bin")
+        self.assertEqual(chunk_sizes(client.received), CHUNK_SIZES)
+        self.assertEqual(client.received[-1][0], MSG_END)
+        self.assertTrue(client.sent[-1][2].startswith(b"putfile|denied|"))
+        self.create_file("tool_box/after.bin")
+        with loopback.quietly():
+            self.controller.stream_file_to_client(session.session_id, "after.bin")
+        self.assertEqual(os.path.getsize("after.bin"), FILE_SIZE)
+
+    def test_get_round_trip(self):
+        client, session = self.connect_client(RecordingClient)
+        source = os.path.join(self.folder, "get.bin")
+        data = self.create_file(source)
+        with loopback.quietly():
+            self.controller.request_file_from_client(session.session_id, source)
+        with open("downloaded_files/get.bin", "rb") as downloaded:
+            self.assertEqual(downloaded.read(), data)
+        self.assertEqual(client.sent[0][2], "getrange|{}|0".format(FILE_SIZE).encode())
+        self.assertEqual(chunk_sizes(client.sent), CHUNK_SIZES)
+        self.assertEqual(client.sent[-1][:2], (MSG_END, 64))
+
+    def test_get_missing_file(self):
+        client, session = self.connect_client(RecordingClient)
+        with loopback.quietly():
+            self.controller.request_file_from_client(session.session_id, os.path.join(self.folder, "missing.bin"))
+        self.assertEqual([msg_type for msg_type, _, _ in client.sent], [MSG_ERROR])
+        self.assertFalse(os.path.exists("downloaded_files/missing.bin"))
+
+if __name__ == '__main__':
+    unittest.main()